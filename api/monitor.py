@@ -0,0 +1,37 @@
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter
+from service.monitor import MONITOR_SERVICE
+from pydantic import BaseModel
+
+router = APIRouter()
+
+
+class MonitorMetricsRequest(BaseModel):
+    """
+    MonitorMetricsRequest is a Pydantic model that defines the request body for retrieving worker metrics.
+
+    Attributes:
+    ----------
+    since : datetime, optional
+        Only aggregate the deliveries dequeued after this time, defaults to all recorded deliveries.
+    """
+    since:Optional[datetime]=None
+
+
+@router.post("/metrics")
+def monitor_metrics(form: MonitorMetricsRequest):
+    """
+    Get the latency histograms and queue depth of every worker.
+
+    Parameters:
+    ----------
+    form : MonitorMetricsRequest
+        A request containing the optional start of the aggregation window.
+
+    Returns:
+    -------
+    dict : Time-in-queue and processing-time histograms per service, and the current depth of each queue.
+    """
+    return MONITOR_SERVICE.get_metrics(**form.__dict__)
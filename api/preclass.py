@@ -1,6 +1,10 @@
-from fastapi import APIRouter
+from bson import ObjectId
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
 from service.preclass.main import PRECLASS_MAIN
+from service.preclass.processors.pdf2png import get_rendition
 from pydantic import BaseModel
+from typing import Optional
 
 router = APIRouter()
 
@@ -15,9 +19,15 @@ class PreClassTriggerRequest(BaseModel):
         A string that represents the path to the source file.
     parent_service : str
         A string that represents the parent service.
+    previous_lecture_id : str, optional
+        The lecture of which the source file is a revised version.
+    fused : bool, optional
+        Whether to run every stage in a single process.
     """
     source_file:str
     parent_service:str
+    previous_lecture_id:Optional[str]=None
+    fused:Optional[bool]=None
 
 class PreClassGetStatusRequest(BaseModel):
     """
@@ -29,6 +39,37 @@ class PreClassGetStatusRequest(BaseModel):
         A string that uniquely identifies a job.
     """
     job_id:str
+
+class PreClassProgressRequest(BaseModel):
+    """
+    PreClassProgressRequest is a Pydantic model that defines the request body for long-polling the progress of a pre-class session.
+
+    Attributes:
+    ----------
+    job_id : str
+        A string that uniquely identifies a job.
+    cursor : int, optional
+        The cursor of the last progress received. The request is held until the progress moves past it.
+    """
+    job_id:str
+    cursor:Optional[int]=None
+
+class PreClassRenditionRequest(BaseModel):
+    """
+    PreClassRenditionRequest is a Pydantic model that defines the request body for retrieving a rendered slide.
+
+    Attributes:
+    ----------
+    lecture_id : str
+        A string that uniquely identifies a lecture.
+    index : int
+        The index of the slide, starting from 0.
+    tier : str
+        The name of the rendition, one of `RENDITION.TIERS` in `config.py` (e.g. thumbnail, llm, display).
+    """
+    lecture_id:str
+    index:int
+    tier:str="display"
     
 
 @router.post("/trigger")
@@ -63,4 +104,52 @@ def preclass_get_status(form: PreClassGetStatusRequest):
     -------
     JSONResponse : Provides the session status obtained from the PRECLASS_SERVICE.
     """
-    return PRECLASS_MAIN.get_status(**form.__dict__)
\ No newline at end of file
+    return PRECLASS_MAIN.get_status(**form.__dict__)
+
+
+@router.post("/progress")
+def preclass_progress(form: PreClassProgressRequest):
+    """
+    Get the per-stage and per-slide progress of a pre-class session with ETA estimates.
+
+    Without a cursor the current progress is returned at once. With the cursor of the
+    previous response, the request is held until the progress changes (or for at most
+    `PROGRESS.LONG_POLL_TIMEOUT` seconds), so that clients do not have to poll blindly.
+
+    Parameters:
+    ----------
+    form : PreClassProgressRequest
+        A request containing the job ID and the last cursor.
+
+    Returns:
+    -------
+    dict : The progress from `PRECLASS_MAIN.get_progress`, with the cursor to send next.
+    """
+    progress = PRECLASS_MAIN.wait_for_progress(form.job_id, form.cursor)
+    if progress is None:
+        raise HTTPException(status_code=404, detail=f"Job {form.job_id} not found")
+    return progress
+
+
+@router.post("/rendition")
+def preclass_rendition(form: PreClassRenditionRequest):
+    """
+    Get a rendered slide. Renditions that the pipeline did not need are rendered on their first request and cached.
+
+    Parameters:
+    ----------
+    form : PreClassRenditionRequest
+        A request containing the lecture ID, the slide index and the rendition tier.
+
+    Returns:
+    -------
+    FileResponse : The image of the slide.
+    """
+    try:
+        path, mime_type = get_rendition(ObjectId(form.lecture_id), form.index, form.tier)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown rendition tier {form.tier}")
+    except (IndexError, FileNotFoundError, RuntimeError):
+        raise HTTPException(status_code=404, detail=f"Slide {form.index} of lecture {form.lecture_id} not found")
+    return FileResponse(path, media_type=mime_type)
+
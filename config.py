@@ -1,3 +1,4 @@
+import os
 import argparse
 
 try:
@@ -7,14 +8,16 @@ try:
     parser.add_argument("--zhipu_api_key", default="xxx", help="Set ZHIPU service api_key")
     parser.add_argument("--openai_api_key", default="xxx", help="Set OPENAI service api_key")
     parser.add_argument("--openai_baseurl", default="xxx", help="Set OPENAI service baseurl")
-    args = parser.parse_args()
+    parser.add_argument("--openai_mock_latency", type=float, default=None, help="Answer OPENAI requests with the mock LLM after this many seconds")
+    args, _ = parser.parse_known_args()
 except SystemExit:
     # If argparse fails (likely due to missing arguments during import), use default values
     args = argparse.Namespace(
         log="INFO",
         zhipu_api_key="xxx",
         openai_api_key="xxx",
-        openai_baseurl="xxx"
+        openai_baseurl="xxx",
+        openai_mock_latency=None
     )
 
 
@@ -44,6 +47,104 @@ class LLM:
 	class OPENAI:
 		API_KEY=args.openai_api_key
 		BASE_URL=args.openai_baseurl
+		WORKER_THREADS=8 # requests a single llm-openai worker sends to the API concurrently
+		MOCK_LATENCY=args.openai_mock_latency # seconds taken by `service.llm.mock.MockOPENAI` per request, None to call the API
 
 class LOG:
-	LEVEL=args.log
\ No newline at end of file
+	LEVEL=args.log
+class QUEUE:
+	MAX_ATTEMPTS=5
+	RETRY_BASE_DELAY=10 # seconds before the first retry
+	RETRY_BACKOFF=2 # delay multiplier applied on each further attempt
+	RETRY_MAX_DELAY=600
+
+class MONITOR:
+	SAMPLE_INTERVAL=10 # seconds between two queue depth samples
+	LATENCY_BUCKETS=[0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600] # upper bounds in seconds
+
+class STREAM:
+	POLL_INTERVAL=1 # seconds between two checks for the next slide of an upstream stage
+	IDLE_TIMEOUT=3600 # seconds to wait for a single slide before failing the job
+
+class DESCRIPTION:
+	PARALLEL=False # describe slides concurrently instead of one after another
+	FANOUT=8 # slides being described at the same time in parallel mode
+	CONTEXT_WINDOW=2 # neighbouring slides on each side whose text is given as context in parallel mode
+
+class STRUCTURE:
+	CHUNK_SIZE=1 # pages placed in the outline by a single LLM call, 1 places every page with its own call
+	PROTOCOL="json" # `json` asks for schema-validated page placements, `text` for the free-text outline
+	MAX_RETRIES=3 # paid retries for a page before it is appended to the current section
+
+class READSCRIPT:
+	PARALLEL=False # draft every script in parallel and smooth the transitions afterwards, instead of one script after another
+	FANOUT=8 # LLM queries in flight in parallel mode
+	SMOOTH_BATCH=10 # consecutive scripts smoothed by a single query
+	SMOOTH_MODEL="gpt-4o-mini" # text-only model smoothing the transitions
+
+class ASKQUESTION:
+	PARALLEL=False # collect every question site first and generate their questions concurrently
+	FANOUT=8 # LLM queries in flight in parallel mode
+	MAX_RETRIES=3 # regenerations of a site whose reply does not contain 3 questions
+	PROTOCOL="json" # `json` asks for schema-validated questions, `text` for the legacy free-text format
+
+class BUFFER:
+	ROOT=os.path.abspath("buffer") # working files of every lecture, resolved once so that workers do not depend on their cwd
+
+class CONVERTER:
+	POOL_SIZE=2 # long-running LibreOffice processes used by a pptx2pdf worker
+	BASE_PORT=2002 # UNO port of the first process, the others use the following ports
+	TIMEOUT=300 # seconds a single conversion may take before its process is restarted
+	STARTUP_TIMEOUT=30 # seconds to wait for a process to accept UNO connections
+	SOFFICE="soffice"
+	DOCKER_IMAGE="preclass-converter" # image used when the pool is not available
+
+class RENDER:
+	DPI=150 # resolution of the rendered slides
+	COLORSPACE="RGB" # `RGB`, `GRAY` or `CMYK`
+	ALPHA=False # keep an alpha channel (ignored for jpeg)
+	FORMAT="png" # `png`, `jpeg` or `webp` (webp needs Pillow)
+	QUALITY=85 # quality of jpeg and webp images
+	WORKERS=os.cpu_count() or 1 # processes rendering the pages of a deck
+
+class RENDITION:
+	TIERS=dict( # options of `convert_pdf_to_png` for every named rendition of the slides
+		thumbnail=dict(dpi=36, image_format="jpeg", quality=70),
+		llm=dict(dpi=96, image_format="png"),
+		display=dict(dpi=200, image_format="png"),
+	)
+	EAGER=["llm"] # tiers rendered by pdf2png, the others are rendered on their first request
+	LLM_TIER="llm" # tier attached to the file snippets as the vision input of the LLM
+
+class BLOB:
+	ROOT=os.path.abspath("blob") # content-addressed files (slide images) referenced by their SHA-256 from MongoDB documents
+	CHUNK_SIZE=1<<20 # bytes read at a time when hashing or copying a file into the store
+
+class REVISION:
+	MAX_IMAGE_DISTANCE=6 # differing bits (of 64) between the dHash of two renderings of the same slide
+	NEIGHBOURS=1 # slides on either side of a changed slide that are regenerated with it
+
+class PROGRESS:
+	LONG_POLL_TIMEOUT=25 # seconds `/preclass/progress` holds a request open waiting for a change
+
+class FUSED:
+	ENABLED=False # run new lectures with `service.preclass.fused` instead of the staged pipeline
+
+class INGEST:
+	CONCURRENCY=4 # decks of a batch processed at the same time by `service.preclass.ingest`
+	TOKEN_BUDGET=None # LLM tokens a batch may spend before no further deck is started, None for unlimited
+	POLL_INTERVAL=5 # seconds between two checks of the decks in flight
+	DECK_TIMEOUT=4*3600 # seconds a deck may take before it is reported as timed out
+	PRICES={ # USD per million prompt and completion tokens of each model, used for the cost report
+		"gpt-4o-2024-08-06": (2.5, 10.0),
+		"gpt-4o-mini": (0.15, 0.6),
+	}
+
+class BENCHMARK:
+	SIZES=[10, 100, 500] # slides of the synthetic decks run by `service.preclass.benchmark`
+	LATENCY=0.5 # seconds the mock LLM takes per request
+	ROOT=os.path.abspath("benchmark") # generated decks and worker logs
+	WARMUP=5 # seconds given to the workers to connect before the first deck is triggered
+	DECK_TIMEOUT=6*3600 # seconds a single deck may take
+	POLL_INTERVAL=1 # seconds between two checks of the running deck
+	DATABASES=["lecture", "preclass", "llm", "monitor"] # databases whose operations and size are measured
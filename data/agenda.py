@@ -1,4 +1,5 @@
 from pymongo import MongoClient
+from bson import ObjectId
 
 from config import MONGO
 
@@ -12,4 +13,28 @@ from config import MONGO
 client = MongoClient(
     MONGO.HOST,
     MONGO.PORT
-).lecture.agenda
\ No newline at end of file
+).lecture.agenda
+
+lecture_info = MongoClient(
+    MONGO.HOST,
+    MONGO.PORT
+).lecture.info
+
+
+def published_query(lecture_id, **query):
+    """
+    Builds a query matching only the nodes of the published agenda tree of a lecture.
+
+    A republished tree is written next to the previous one and swapped in by `data.lecture.publish_agenda`,
+    so the nodes of a tree that is still being written are never matched.
+
+    Args:
+        lecture_id: The lecture ID.
+        **query: Further conditions on the nodes.
+
+    Returns:
+        dict: The query.
+    """
+    info = lecture_info.find_one(dict(_id=ObjectId(lecture_id)), dict(agenda_version=1)) or {}
+    # Trees published before versioning have no version, None also matches the missing field
+    return dict(query, lecture_id=lecture_id, agenda_version=info.get("agenda_version"))
@@ -0,0 +1,118 @@
+import os
+import mmap
+import base64
+import hashlib
+import tempfile
+from abc import ABC, abstractmethod
+
+from config import BLOB
+
+class BlobStore(ABC):
+	"""A content-addressed store of immutable blobs.
+
+	A blob is identified by the SHA-256 hex digest of its bytes, so documents only
+	keep the digest and identical blobs are stored once.
+	"""
+	@abstractmethod
+	def put(self, data: bytes) -> str:
+		"""Store bytes and return their digest."""
+
+	@abstractmethod
+	def put_file(self, path: str) -> str:
+		"""Store the content of a file and return its digest."""
+
+	@abstractmethod
+	def open(self, digest: str):
+		"""Open a blob for reading.
+
+		Returns:
+			A read-only bytes-like object supporting the context manager protocol
+		"""
+
+	@abstractmethod
+	def exists(self, digest: str) -> bool:
+		"""Whether a blob with the digest is stored."""
+
+	def get(self, digest: str) -> bytes:
+		with self.open(digest) as blob:
+			return bytes(blob)
+
+	def get_base64(self, digest: str) -> str:
+		"""Read a blob as a Base64 string, as expected by the `image_url` of the LLM services."""
+		with self.open(digest) as blob:
+			return base64.b64encode(blob).decode('utf-8')
+
+class LocalBlobStore(BlobStore):
+	"""A `BlobStore` on the local filesystem.
+
+	Blobs are stored under `root/ab/cd/abcd...` and are memory-mapped when read, so
+	that large blobs are paged in lazily instead of being copied on every read.
+
+	Args:
+		root (str): Directory of the store
+	"""
+	def __init__(self, root=BLOB.ROOT):
+		self.root = root
+
+	def path(self, digest):
+		return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+	def _write(self, digest, chunks):
+		path = self.path(digest)
+		if os.path.exists(path):
+			return
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		# Write under a unique name and move in place, so that concurrent writers of the
+		# same blob never expose a partial file
+		fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				for chunk in chunks:
+					f.write(chunk)
+			os.replace(temp_file, path)
+		except BaseException:
+			os.remove(temp_file)
+			raise
+
+	def put(self, data):
+		digest = hashlib.sha256(data).hexdigest()
+		self._write(digest, [data])
+		return digest
+
+	def put_file(self, path):
+		sha256 = hashlib.sha256()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(BLOB.CHUNK_SIZE), b""):
+				sha256.update(chunk)
+		digest = sha256.hexdigest()
+
+		def chunks():
+			with open(path, 'rb') as f:
+				yield from iter(lambda: f.read(BLOB.CHUNK_SIZE), b"")
+		self._write(digest, chunks())
+		return digest
+
+	def open(self, digest):
+		with open(self.path(digest), 'rb') as f:
+			if os.fstat(f.fileno()).st_size == 0:
+				# Empty files cannot be memory-mapped
+				return memoryview(b"")
+			return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	def exists(self, digest):
+		return os.path.exists(self.path(digest))
+
+blob_store = LocalBlobStore()
+
+def read_base64(digest):
+	"""Read a blob referenced by a document as a Base64 string.
+
+	Args:
+		digest (str): Digest stored in the document, or None
+
+	Returns:
+		str: The Base64 string, or None when the document references no blob
+	"""
+	if digest is None:
+		return None
+	return blob_store.get_base64(digest)
@@ -1,4 +1,4 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne
 from bson import ObjectId
 
 from config import MONGO
@@ -8,13 +8,41 @@ client = MongoClient(
 	MONGO.PORT
 	).lecture
 
-def create_lecture(source_file_name):
+def create_lecture(source_file_name, previous_lecture_id=None):
 	lecture_id = client.info.insert_one(dict(
 		lecture_name=source_file_name,
 		creation_date = now(),
+		previous_lecture_id=previous_lecture_id,
 	)).inserted_id
 	return lecture_id
 
+def update_info(
+	lecture_id: ObjectId,
+	**kwargs
+	):
+	client.info.update_one(
+		dict(_id=lecture_id),
+		{"$set": kwargs}
+	)
+
+def publish_agenda(
+	lecture_id: ObjectId,
+	agenda_version: ObjectId
+	):
+	# A single update swaps the agenda tree that readers see, see `data.agenda.published_query`.
+	# The slide order cached by the classroom belongs to the previous tree.
+	client.info.update_one(
+		dict(_id=lecture_id),
+		{
+			"$set": dict(
+				agenda_version=agenda_version,
+				agenda_published=True,
+				agenda_publish_time=now(),
+			),
+			"$unset": dict(sorted_list=""),
+		}
+	)
+
 def insert_file_snippet(
 	lecture_id: ObjectId,
 	content: any,
@@ -22,14 +50,72 @@ def insert_file_snippet(
 	file_type: str,
 	**kwargs
 	):
-	file_snippet_id = client.file_snippet.insert_one(dict(
-		lecture_id=lecture_id,
-		content=content,
-		idx=idx,
-		file_type=file_type,
-		**kwargs
-	)).inserted_id
-	return file_snippet_id
+	# (lecture_id, idx, file_type) identifies a snippet, so re-extracting a page overwrites it
+	file_snippet = client.file_snippet.find_one_and_update(
+		dict(
+			lecture_id=lecture_id,
+			idx=idx,
+			file_type=file_type,
+		),
+		{"$set": dict(
+			content=content,
+			**kwargs
+		)},
+		projection=dict(_id=1),
+		upsert=True,
+		return_document=ReturnDocument.AFTER,
+	)
+	return file_snippet["_id"]
+
+def update_file_snippet(
+	lecture_id: ObjectId,
+	idx: int,
+	file_type: str,
+	**kwargs
+	):
+	"""Set fields of the snippet of page `idx`, creating the snippet if it is not extracted yet."""
+	file_snippet = client.file_snippet.find_one_and_update(
+		dict(
+			lecture_id=lecture_id,
+			idx=idx,
+			file_type=file_type,
+		),
+		{"$set": kwargs},
+		projection=dict(_id=1),
+		upsert=True,
+		return_document=ReturnDocument.AFTER,
+	)
+	return file_snippet["_id"]
+
+def upsert_file_snippets(
+	lecture_id: ObjectId,
+	file_type: str,
+	snippets: list,
+	):
+	"""Set the fields of the snippets of many pages with a single bulk write.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		file_type (str): File type of the snippets
+		snippets (list): One dict per page, with its `idx` and the fields to set
+	"""
+	if not snippets:
+		return
+	client.file_snippet.bulk_write(
+		[
+			UpdateOne(
+				dict(
+					lecture_id=lecture_id,
+					idx=snippet["idx"],
+					file_type=file_type,
+				),
+				{"$set": {k: v for k, v in snippet.items() if k != "idx"}},
+				upsert=True,
+			)
+			for snippet in snippets
+		],
+		ordered=False,
+	)
 
 def find_info(
 	query,
@@ -41,4 +127,15 @@ def find_file_snippet(
 	query,
 	**kwargs
 	):
-	return client.file_snippet.find_one(query,**kwargs)
\ No newline at end of file
+	return client.file_snippet.find_one(query,**kwargs)
+def find_file_snippets(
+	query,
+	**kwargs
+	):
+	return list(client.file_snippet.find(query,**kwargs))
+
+def count_file_snippets(
+	query,
+	**kwargs
+	):
+	return client.file_snippet.count_documents(query,**kwargs)
@@ -1,7 +1,9 @@
 from api.inclass import router as inclass_router
 from api.preclass import router as preclass_router
+from api.monitor import router as monitor_router
 from fastapi import FastAPI
 
 app = FastAPI()
 app.include_router(inclass_router, prefix="/inclass")
-app.include_router(preclass_router, prefix="/preclass")
\ No newline at end of file
+app.include_router(preclass_router, prefix="/preclass")
+app.include_router(monitor_router, prefix="/monitor")
@@ -10,6 +10,7 @@ def get_services():
 	from service.preclass.processors.gen_showfile import SERVICE as PRECLASS_GEN_SHOWFILE
 	from service.preclass.processors.gen_readscript import SERVICE as PRECLASS_GEN_READSCRIPT
 	from service.preclass.processors.gen_askquestion import SERVICE as PRECLASS_GEN_ASKQUESTION
+	from service.preclass.fused import PRECLASS_FUSED
 	
 	SERVICE_LIST = dict(
 		# LLM API Service
@@ -24,7 +25,8 @@ def get_services():
 		preclass_gen_structure = PRECLASS_GEN_STRUCTURE,
 		preclass_gen_showfile = PRECLASS_GEN_SHOWFILE,
 		preclass_gen_readscript = PRECLASS_GEN_READSCRIPT,
-		preclass_gen_askquestion = PRECLASS_GEN_ASKQUESTION
+		preclass_gen_askquestion = PRECLASS_GEN_ASKQUESTION,
+		preclass_fused = PRECLASS_FUSED
 	)
 
 	return SERVICE_LIST
\ No newline at end of file
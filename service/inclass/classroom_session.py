@@ -622,7 +622,7 @@ class ClassroomSession:
         if not sorted_list:
             sorted_agenda_list = []
             agenda_list = agenda_db.client.find(
-                dict(lecture_id=self.lecture_id, parent_id=self.parent_lecture_id),
+                agenda_db.published_query(self.lecture_id, parent_id=self.parent_lecture_id),
                 sort=[("index", 1)],
             )
             for agenda in agenda_list:
@@ -1,3 +1,10 @@
+import re
+import json
+import time
+
+from service.llm.base import BASE_LLM_CACHE
+
+
 class MockLLMService:
     @classmethod
     def trigger(cls, *args, **kwargs):
@@ -14,3 +21,82 @@ class MockLLMService:
         print('mock get_llm_job_reponse' + '=' * 20)
         return 'mock response'
 
+
+class MockOPENAI(BASE_LLM_CACHE):
+    """
+    A local stand-in for `OPENAI` that answers every request after a fixed latency, without calling an API.
+
+    The replies are shaped after the request so that the preclass pipeline runs through:
+    the structured outputs of `gen_structure` (`outline_placement`), `gen_askquestion`
+    (`questions`) and the smoothing of `gen_readscript` (`smoothed_scripts`) follow their
+    schemas, every other request gets a short text. The cache is never consulted, so
+    every request takes `latency` seconds. Used by the `llm-openai` worker when
+    `LLM.OPENAI.MOCK_LATENCY` is set.
+    """
+    def __init__(self, latency=0.0, section_size=5, **kwargs):
+        """
+        Initializes the MockOPENAI class.
+
+        Args:
+            latency (float): Seconds every request takes.
+            section_size (int, optional): Consecutive pages placed in the same section of the outline.
+        """
+        self.latency = latency
+        self.section_size = section_size
+        self.cost = dict()
+
+    @staticmethod
+    def _text(messages):
+        texts = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                texts.append(content)
+            else:
+                texts += [part["text"] for part in content if part.get("type") == "text"]
+        return "\n".join(texts)
+
+    def _reply(self, query):
+        prompt = self._text(query["messages"])
+        name = query.get("response_format", {}).get("json_schema", {}).get("name")
+        if name == "outline_placement":
+            current = prompt.rsplit("Future Pages:", 1)[0].rsplit("Current Page", 1)[-1]
+            pages = [int(page) for page in re.findall(r"P(\d+):", current)]
+            return json.dumps(dict(placements=[
+                dict(page=page, path=[f"Section {page // self.section_size + 1}"])
+                for page in pages
+            ]))
+        if name == "questions":
+            return json.dumps(dict(questions=[
+                dict(
+                    question=f"Mock question {i + 1}",
+                    question_type="single choice",
+                    selects=["Option A", "Option B", "Option C", "Option D"],
+                    answer=["A"],
+                    reference=prompt[:100],
+                )
+                for i in range(3)
+            ]))
+        if name == "smoothed_scripts":
+            drafts = re.findall(r"Script \d+:\n(.*?)(?=\n\nScript \d+:\n|$)", prompt, re.S)
+            return json.dumps(dict(scripts=drafts))
+        return f"Mock reply to a request of {len(prompt)} characters."
+
+    def _call_model(self, query, use_cache, return_usage=False):
+        """
+        Answers a query like `OPENAI._call_model`, after `latency` seconds.
+
+        Token usage is estimated as one token per 4 characters of text.
+        """
+        time.sleep(self.latency)
+        response = self._reply(query)
+        usage = dict(
+            prompt_tokens=len(self._text(query["messages"])) // 4,
+            completion_tokens=len(response) // 4,
+        )
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        for k, v in usage.items():
+            self.cost[k] = self.cost.get(k, 0) + v
+        if return_usage:
+            return response, usage
+        return response
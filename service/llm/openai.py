@@ -8,9 +8,11 @@ from openai import OpenAI, RateLimitError
 from retry import retry
 
 from config import LLM, MONGO
-from utils import get_channel, now, get_logger
+from utils import now, get_logger, message_properties, notify_parent, declare_retry_queues, retry_on_failure, run_in_threads
 
 from service.llm.base import BASE_LLM_CACHE, NO_CACHE_YET
+from service.llm.mock import MockOPENAI
+from service.monitor import instrument
 
 
 class OPENAI(BASE_LLM_CACHE):
@@ -40,18 +42,22 @@ class OPENAI(BASE_LLM_CACHE):
 				).llm.openai_cache
 
 	@retry(RateLimitError, tries=3)
-	def _call_model(self, query, use_cache):
+	def _call_model(self, query, use_cache, return_usage=False):
 		"""
 		Calls the OpenAI model with the given query.
 
 		Args:
 			query (dict): The query to send to the OpenAI model.
 			use_cache (bool): Whether to use cached responses if available.
+			return_usage (bool, optional): Whether to also return the token usage of the request.
 
 		Returns:
 			str: The response from the model, either from cache or a new request.
+				With `return_usage`, a tuple of the response and the token usage reported
+				by the API, None when the response came from the cache.
 		"""
 		response = NO_CACHE_YET
+		usage = None
 		if use_cache:
 			response = self.check_cache(query)
 		if response==NO_CACHE_YET:
@@ -68,6 +74,8 @@ class OPENAI(BASE_LLM_CACHE):
 							self.cost[k+"."+inner_k] = self.cost.get(k+"."+inner_k,0)+inner_v
 			response = response.choices[0].message.content
 			self.write_cache(query, response, usage)
+		if return_usage:
+			return response, usage
 		return response
 
 class OPENAI_SERVICE:
@@ -90,6 +98,7 @@ class OPENAI_SERVICE:
 		parent_service: str,
 		parent_job_id= None, # set this to be ObjectId if need callback
 		use_cache=False,
+		lecture_id=None,
 		**query
 		) -> str:
 		"""
@@ -98,6 +107,7 @@ class OPENAI_SERVICE:
 		Args:
 			caller_service (str): The service initiating the request.
 			use_cache (bool, optional): Whether to use cached responses if available.
+			lecture_id (ObjectId, optional): The lecture the request is made for, see `usage_by_lecture`.
 			**query: The query to send to the LLM.
 
 		Returns:
@@ -118,6 +128,7 @@ class OPENAI_SERVICE:
 				parent_job_id=parent_job_id,
 				created_time = now(),
 				use_cache=use_cache,
+				lecture_id=lecture_id,
 				query=query,
 			)
 		).inserted_id
@@ -126,7 +137,8 @@ class OPENAI_SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=OPENAI_SERVICE.queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 
@@ -138,6 +150,7 @@ class OPENAI_SERVICE:
 		"""
 		Launches a worker to process jobs from the RabbitMQ queue.
 		The worker interacts with the LLM and stores the response back in MongoDB.
+		With `--openai_mock_latency` it answers with `MockOPENAI` instead.
 		"""
 		try:
 			connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
@@ -147,10 +160,15 @@ class OPENAI_SERVICE:
 				queue=OPENAI_SERVICE.queue_name,
 				durable=True
 			)
-			llm_controller = OPENAI(
-				api_key=LLM.OPENAI.API_KEY,
-				base_url = LLM.OPENAI.BASE_URL,
-			)
+			declare_retry_queues(channel, OPENAI_SERVICE.queue_name)
+			if LLM.OPENAI.MOCK_LATENCY is not None:
+				OPENAI_SERVICE.logger.warning(f"Answering With The Mock LLM After {LLM.OPENAI.MOCK_LATENCY} Seconds")
+				llm_controller = MockOPENAI(latency=LLM.OPENAI.MOCK_LATENCY)
+			else:
+				llm_controller = OPENAI(
+					api_key=LLM.OPENAI.API_KEY,
+					base_url = LLM.OPENAI.BASE_URL,
+				)
 			def callback(ch, method, properties, body):
 				job_id = ObjectId(body.decode())
 				OPENAI_SERVICE.logger.info(f"Recieved LLM Query - {job_id}")
@@ -163,30 +181,42 @@ class OPENAI_SERVICE:
 
 				OPENAI_SERVICE.logger.debug(f"Recieved LLM Query - {query}")
 
-				ret = llm_controller._call_model(
+				ret, usage = llm_controller._call_model(
 					query=query,
 					use_cache=use_cache,
+					return_usage=True,
 					)
 				OPENAI_SERVICE.collection.update_one(
 					dict(_id=job_id),
 					{"$set":dict(
 						completion_time=now(),
-						response=ret
+						response=ret,
+						usage=usage,
 					)}
 				)
 				OPENAI_SERVICE.logger.debug(f"LLM Output - {ret}")
 				if parent_job_id:
-					parent_connection, parent_channel = get_channel(parent_service)
-					parent_channel.basic_publish(
-						exchange="",
-						routing_key=parent_service,
-						body=str(parent_job_id)
-					)
-					parent_connection.close()
+					notify_parent(parent_service, parent_job_id)
 				ch.basic_ack(delivery_tag = method.delivery_tag)
+			# Requests mostly wait on the API, so several of them are sent concurrently
 			channel.basic_consume(
 				queue=OPENAI_SERVICE.queue_name,
-				on_message_callback=callback,
+				on_message_callback=run_in_threads(
+					retry_on_failure(
+						instrument(
+							callback,
+							queue_name=OPENAI_SERVICE.queue_name,
+							collection=OPENAI_SERVICE.collection,
+						),
+						queue_name=OPENAI_SERVICE.queue_name,
+						collection=OPENAI_SERVICE.collection,
+						logger=OPENAI_SERVICE.logger,
+					),
+					connection=connection,
+					channel=channel,
+					workers=LLM.OPENAI.WORKER_THREADS,
+					logger=OPENAI_SERVICE.logger,
+				),
 				auto_ack=False,
 			)
 			OPENAI_SERVICE.logger.info('Worker Launched. To exit press CTRL+C')
@@ -243,6 +273,85 @@ class OPENAI_SERVICE:
 		OPENAI_SERVICE.logger.error(f"Retrieving Response From Job {job_id} Timed Out After {timeout} Seconds")
 		return None
 	
+	@staticmethod
+	def map_sync(queries, parent_service, fanout=LLM.OPENAI.WORKER_THREADS, timeout=300):
+		"""
+		Sends several queries with at most `fanout` of them in flight and waits for all of their responses.
+
+		Args:
+			queries (list[dict]): Keyword arguments of `trigger` for each query, without `parent_service`.
+			parent_service (str): The service initiating the requests.
+			fanout (int, optional): Maximum number of queries waiting for a response at the same time.
+			timeout (int, optional): The maximum time to wait for each query once it is sent.
+
+		Returns:
+			list: The response of each query in order, None for the queries that timed out.
+		"""
+		responses = [None] * len(queries)
+		in_flight = dict() # job id -> (position of the query, time it was sent)
+		next_query = 0
+		while next_query < len(queries) or in_flight:
+			while next_query < len(queries) and len(in_flight) < fanout:
+				job_id = OPENAI_SERVICE.trigger(
+					parent_service=parent_service,
+					**queries[next_query]
+				)
+				in_flight[job_id] = (next_query, time.time())
+				next_query += 1
+
+			completed = OPENAI_SERVICE.collection.find(
+				{"_id": {"$in": list(in_flight)}, "completion_time": {"$exists": True}},
+				dict(response=1)
+			)
+			completed_count = 0
+			for record in completed:
+				position, _ = in_flight.pop(record["_id"])
+				responses[position] = record["response"]
+				completed_count += 1
+
+			for job_id, (position, sent_time) in list(in_flight.items()):
+				if (time.time() - sent_time) >= timeout:
+					OPENAI_SERVICE.logger.error(f"Retrieving Response From Job {job_id} Timed Out After {timeout} Seconds")
+					del in_flight[job_id]
+			if in_flight and not completed_count:
+				time.sleep(1)  # Wait 1 second between checks
+		return responses
+
+	@staticmethod
+	def usage_by_lecture(lecture_ids):
+		"""
+		Sums up the token usage of the finished requests made for the given lectures.
+
+		Requests answered from the cache are counted in `cached_calls` and do not add tokens.
+
+		Args:
+			lecture_ids (list[ObjectId]): The lectures to account.
+
+		Returns:
+			dict: Maps each lecture with requests to a dict mapping each model to its `calls`,
+				`cached_calls`, `prompt_tokens`, `completion_tokens` and `total_tokens`.
+		"""
+		usage = dict()
+		for record in OPENAI_SERVICE.collection.aggregate([
+			{"$match": {"lecture_id": {"$in": list(lecture_ids)}, "completion_time": {"$exists": True}}},
+			{"$group": dict(
+				_id=dict(lecture_id="$lecture_id", model="$query.model"),
+				calls={"$sum": 1},
+				cached_calls={"$sum": {"$cond": [{"$eq": [{"$ifNull": ["$usage", None]}, None]}, 1, 0]}},
+				prompt_tokens={"$sum": {"$ifNull": ["$usage.prompt_tokens", 0]}},
+				completion_tokens={"$sum": {"$ifNull": ["$usage.completion_tokens", 0]}},
+				total_tokens={"$sum": {"$ifNull": ["$usage.total_tokens", 0]}},
+			)},
+		]):
+			usage.setdefault(record["_id"]["lecture_id"], dict())[record["_id"]["model"]] = dict(
+				calls=record["calls"],
+				cached_calls=record["cached_calls"],
+				prompt_tokens=record["prompt_tokens"],
+				completion_tokens=record["completion_tokens"],
+				total_tokens=record["total_tokens"],
+			)
+		return usage
+	
 if __name__=="__main__":
 	OPENAI_SERVICE.logger.warning("STARTING LLM SERVICE")
 	OPENAI_SERVICE.launch_worker()
\ No newline at end of file
@@ -0,0 +1,287 @@
+import sys
+import os
+import functools
+from datetime import datetime
+
+import pika
+from pika.exceptions import ChannelClosedByBroker
+from pymongo import MongoClient
+from bson import ObjectId
+
+from config import MONGO, MONITOR
+from utils import get_logger, now
+
+
+def instrument(callback, queue_name, collection):
+	"""Wrap a worker callback so that every delivery records its timings.
+
+	Four timestamps are taken for each delivery:
+	- enqueue: when the message was published (the `x-enqueued-at` header, see `utils.message_properties`)
+	- dequeue: when the worker received the message
+	- start: when the callback started processing, after the dequeue was recorded on the job
+	- finish: when the callback returned or raised
+
+	The job document keeps the first `dequeue_time` and `start_time` and the last
+	`finish_time` of all its deliveries. Every delivery is also stored in
+	`monitor.delivery`, which `MONITOR_SERVICE.latency_histogram` aggregates.
+
+	Args:
+		callback (callable): The `on_message_callback` of the worker
+		queue_name (str): Name of the queue consumed by the worker
+		collection: MongoDB collection holding the jobs of the worker
+
+	Returns:
+		callable: The wrapped callback
+	"""
+	@functools.wraps(callback)
+	def wrapper(ch, method, properties, body):
+		dequeue_time = now()
+		headers = properties.headers or {}
+		enqueued_at = headers.get("x-enqueued-at")
+		enqueue_time = datetime.fromtimestamp(enqueued_at) if enqueued_at else None
+
+		job_id = ObjectId(body.decode())
+		collection.update_one(
+			dict(_id=job_id),
+			{"$min": dict(dequeue_time=dequeue_time)}
+		)
+
+		start_time = now()
+		status = "failed"
+		try:
+			ret = callback(ch, method, properties, body)
+			status = "done"
+			return ret
+		finally:
+			finish_time = now()
+			collection.update_one(
+				dict(_id=job_id),
+				{
+					"$min": dict(start_time=start_time),
+					"$max": dict(finish_time=finish_time),
+				}
+			)
+			MONITOR_SERVICE.record_delivery(
+				service=queue_name,
+				job_id=job_id,
+				attempt=headers.get("x-attempt", 0) + 1,
+				status=status,
+				enqueue_time=enqueue_time,
+				dequeue_time=dequeue_time,
+				start_time=start_time,
+				finish_time=finish_time,
+			)
+	return wrapper
+
+
+class MONITOR_SERVICE:
+	"""
+	A service class for the latency and queue depth metrics of all queue workers.
+
+	Per-delivery timings are written by `instrument`. This service samples the depth of
+	every work and dead-letter queue from RabbitMQ and aggregates both into
+	per-service histograms for the `/monitor/metrics` endpoint.
+	"""
+	_delivery_collection = MongoClient(
+		MONGO.HOST,
+		MONGO.PORT
+		).monitor.delivery
+
+	_queue_depth_collection = MongoClient(
+		MONGO.HOST,
+		MONGO.PORT
+		).monitor.queue_depth
+
+	_logger = get_logger(
+		__name__=__name__,
+		__file__=__file__,
+	)
+
+	@staticmethod
+	def get_queue_names():
+		"""
+		Returns:
+			list: The work queue of every service in `get_services()`
+		"""
+		from service import get_services
+		queue_names = []
+		for service in get_services().values():
+			queue_name = getattr(service, "_queue_name", None) or getattr(service, "queue_name", None)
+			if queue_name:
+				queue_names.append(queue_name)
+		return queue_names
+
+	@staticmethod
+	def record_delivery(service, job_id, attempt, status, enqueue_time, dequeue_time, start_time, finish_time):
+		"""
+		Stores the timings of a single delivery.
+
+		Args:
+			service (str): Queue name of the worker
+			job_id (ObjectId): ID of the delivered job
+			attempt (int): Delivery attempt of the job, starting from 1
+			status (str): `done` or `failed`
+			enqueue_time (datetime): When the message was published, None if unknown
+			dequeue_time (datetime): When the worker received the message
+			start_time (datetime): When the callback started processing
+			finish_time (datetime): When the callback returned or raised
+		"""
+		MONITOR_SERVICE._delivery_collection.insert_one(
+			dict(
+				service=service,
+				job_id=job_id,
+				attempt=attempt,
+				status=status,
+				enqueue_time=enqueue_time,
+				dequeue_time=dequeue_time,
+				start_time=start_time,
+				finish_time=finish_time,
+				# A publisher with a clock ahead of the worker would record a negative wait
+				queue_time=max(0, (dequeue_time - enqueue_time).total_seconds()) if enqueue_time else None,
+				processing_time=(finish_time - start_time).total_seconds(),
+			)
+		)
+
+	@staticmethod
+	def latency_histogram(field, service=None, since=None):
+		"""
+		Aggregates a latency of the recorded deliveries into histograms.
+
+		Args:
+			field (str): `queue_time` or `processing_time`
+			service (str, optional): Only aggregate the deliveries of this queue
+			since (datetime, optional): Only aggregate deliveries dequeued after this time
+
+		Returns:
+			dict: Maps each service to its `count`, `mean`, `max` and `buckets`.
+				`buckets` maps the upper bound (in seconds) of each bucket to its delivery count.
+		"""
+		match = {field: {"$ne": None}}
+		if service:
+			match["service"] = service
+		if since:
+			match["dequeue_time"] = {"$gte": since}
+
+		boundaries = [0] + MONITOR.LATENCY_BUCKETS
+		histograms = dict()
+		for record in MONITOR_SERVICE._delivery_collection.aggregate([
+			{"$match": match},
+			{"$group": dict(
+				_id="$service",
+				count={"$sum": 1},
+				mean={"$avg": f"${field}"},
+				max={"$max": f"${field}"},
+			)},
+		]):
+			histograms[record["_id"]] = dict(
+				count=record["count"],
+				mean=record["mean"],
+				max=record["max"],
+				buckets=dict(),
+			)
+
+		for service_name, histogram in histograms.items():
+			for bucket in MONITOR_SERVICE._delivery_collection.aggregate([
+				{"$match": dict(match, service=service_name)},
+				{"$bucket": dict(
+					groupBy=f"${field}",
+					boundaries=boundaries,
+					default="inf",
+					output=dict(count={"$sum": 1}),
+				)},
+			]):
+				if bucket["_id"] == "inf":
+					upper_bound = "inf"
+				else:
+					upper_bound = str(boundaries[boundaries.index(bucket["_id"]) + 1])
+				histogram["buckets"][upper_bound] = bucket["count"]
+		return histograms
+
+	@staticmethod
+	def sample_queue_depth(connection, queue_names=None):
+		"""
+		Reads the number of ready messages and consumers of each queue from RabbitMQ.
+
+		Queues are declared passively, so sampling never creates a queue. Queues that do
+		not exist (yet), such as the dead-letter queue of a worker that never started, are left out.
+
+		Args:
+			connection: An open RabbitMQ connection
+			queue_names (list, optional): Queues to sample. Defaults to every work queue
+				and its dead-letter queue.
+
+		Returns:
+			dict: Maps each queue name to its `messages` and `consumers` count
+		"""
+		if queue_names is None:
+			queue_names = []
+			for queue_name in MONITOR_SERVICE.get_queue_names():
+				queue_names += [queue_name, f"{queue_name}.dead"]
+
+		depth = dict()
+		channel = connection.channel()
+		for queue_name in queue_names:
+			try:
+				declared = channel.queue_declare(
+					queue=queue_name,
+					passive=True
+				)
+			except ChannelClosedByBroker:
+				# The broker closes the channel when the queue does not exist
+				channel = connection.channel()
+				continue
+			depth[queue_name] = dict(
+				messages=declared.method.message_count,
+				consumers=declared.method.consumer_count,
+			)
+		channel.close()
+		return depth
+
+	@staticmethod
+	def get_metrics(since=None):
+		"""
+		Collects the latency histograms and the current queue depth of every service.
+
+		Args:
+			since (datetime, optional): Only aggregate deliveries dequeued after this time
+
+		Returns:
+			dict: `queue_time` and `processing_time` histograms per service and the `queue_depth` of each queue
+		"""
+		connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
+		queue_depth = MONITOR_SERVICE.sample_queue_depth(connection)
+		connection.close()
+		return dict(
+			queue_time=MONITOR_SERVICE.latency_histogram("queue_time", since=since),
+			processing_time=MONITOR_SERVICE.latency_histogram("processing_time", since=since),
+			queue_depth=queue_depth,
+		)
+
+	@staticmethod
+	def launch_worker():
+		"""
+		Launches a worker that samples the depth of every queue each `MONITOR.SAMPLE_INTERVAL`
+		seconds and stores it in `monitor.queue_depth`. Can be terminated with CTRL+C.
+		"""
+		try:
+			connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
+			MONITOR_SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
+			while True:
+				MONITOR_SERVICE._queue_depth_collection.insert_one(
+					dict(
+						time=now(),
+						queues=MONITOR_SERVICE.sample_queue_depth(connection),
+					)
+				)
+				# Keeps the connection heartbeat alive while waiting
+				connection.sleep(MONITOR.SAMPLE_INTERVAL)
+		except KeyboardInterrupt:
+			MONITOR_SERVICE._logger.warning('Shutting Off Worker')
+			try:
+				sys.exit(0)
+			except SystemExit:
+				os._exit(0)
+
+if __name__ == "__main__":
+	MONITOR_SERVICE._logger.warning("STARTING MONITOR SERVICE")
+	MONITOR_SERVICE.launch_worker()
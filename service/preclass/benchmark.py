@@ -0,0 +1,303 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+from pptx import Presentation
+from pptx.util import Inches, Pt
+from PIL import Image, ImageDraw
+
+from config import MONGO, BENCHMARK
+from utils import get_logger, now, buffer_path
+from service import get_services
+from data.lecture import find_file_snippets, count_file_snippets
+from data.blob import blob_store
+
+logger = get_logger(
+	__name__=__name__,
+	__file__=__file__,
+)
+
+client = MongoClient(
+	MONGO.HOST,
+	MONGO.PORT
+	)
+
+# Workers of the staged and the fused pipeline, started by `launch_workers`
+WORKERS = [
+	"service.llm.openai",
+	"service.preclass.main",
+	"service.preclass.processors.pptx2pdf",
+	"service.preclass.processors.pdf2png",
+	"service.preclass.processors.gen_description",
+	"service.preclass.processors.gen_structure",
+	"service.preclass.processors.gen_readscript",
+	"service.preclass.processors.gen_showfile",
+	"service.preclass.processors.gen_askquestion",
+	"service.preclass.fused",
+]
+
+# Operations counted per collection by the `top` command
+OPERATIONS = ["queries", "getmore", "insert", "update", "remove", "commands"]
+
+WORDS = (
+	"model data learning network gradient layer training loss function vector matrix "
+	"sample feature label inference optimizer attention sequence token embedding batch"
+).split()
+
+def make_image(rng, index, size=(640, 360)):
+	"""
+	Returns:
+		bytes: A PNG with random shapes and the slide number, different for every slide
+	"""
+	image = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+	draw = ImageDraw.Draw(image)
+	for _ in range(8):
+		x, y = rng.randrange(size[0]), rng.randrange(size[1])
+		box = [x, y, x + rng.randrange(20, 200), y + rng.randrange(20, 200)]
+		color = tuple(rng.randrange(256) for _ in range(3))
+		if rng.random() < 0.5:
+			draw.rectangle(box, fill=color)
+		else:
+			draw.ellipse(box, fill=color)
+	draw.text((10, 10), f"Figure {index}", fill=(0, 0, 0))
+	stream = io.BytesIO()
+	image.save(stream, format="PNG")
+	return stream.getvalue()
+
+def make_deck(path, slide_count, seed=0, run_id=None):
+	"""Write a synthetic deck with a title, bullet points and a picture on every slide.
+
+	Args:
+		path (str): Path of the `.pptx` to write
+		slide_count (int): Number of slides
+		seed (int): Seed of the generated text and pictures
+		run_id (str, optional): Stored in the document properties, so that the decks of
+			different runs are not byte-identical and are not cloned from each other
+	"""
+	rng = random.Random(seed)
+	presentation = Presentation()
+	presentation.core_properties.subject = run_id or ""
+	layout = presentation.slide_layouts[1] # title and content
+	for index in range(slide_count):
+		slide = presentation.slides.add_slide(layout)
+		slide.shapes.title.text = f"Topic {index // 5 + 1}: {' '.join(rng.sample(WORDS, 3)).title()}"
+		body = slide.placeholders[1]
+		body.width = Inches(4.5)
+		text_frame = body.text_frame
+		for i in range(4):
+			paragraph = text_frame.paragraphs[0] if i == 0 else text_frame.add_paragraph()
+			paragraph.text = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(6, 14))).capitalize() + "."
+			paragraph.font.size = Pt(18)
+		slide.shapes.add_picture(io.BytesIO(make_image(rng, index)), Inches(5.2), Inches(2), width=Inches(4.3))
+		slide.notes_slide.notes_text_frame.text = f"Notes of slide {index}."
+	presentation.save(path)
+
+def launch_workers(latency, log_dir):
+	"""Start every worker in `WORKERS` as a subprocess, with the mock LLM answering after `latency` seconds.
+
+	Returns:
+		list[subprocess.Popen]: The started workers
+	"""
+	os.makedirs(log_dir, exist_ok=True)
+	processes = []
+	for module in WORKERS:
+		log_file = open(os.path.join(log_dir, f"{module}.log"), "w")
+		processes.append(subprocess.Popen(
+			[sys.executable, "-m", module, "--openai_mock_latency", str(latency)],
+			stdout=log_file,
+			stderr=subprocess.STDOUT,
+		))
+	return processes
+
+def stop_workers(processes):
+	for process in processes:
+		process.terminate()
+	for process in processes:
+		try:
+			process.wait(timeout=10)
+		except subprocess.TimeoutExpired:
+			process.kill()
+
+def mongo_snapshot():
+	"""
+	Returns:
+		dict: The server-wide `opcounters`, the operation counts of every collection of
+			`BENCHMARK.DATABASES` (None where the `top` command is not supported) and the
+			`dataSize` of every database
+	"""
+	try:
+		namespaces = dict()
+		for namespace, counters in client.admin.command("top")["totals"].items():
+			if namespace.split(".", 1)[0] in BENCHMARK.DATABASES:
+				namespaces[namespace] = {op: counters.get(op, {}).get("count", 0) for op in OPERATIONS}
+	except OperationFailure:
+		namespaces = None
+	return dict(
+		opcounters=dict(client.admin.command("serverStatus")["opcounters"]),
+		namespaces=namespaces,
+		data_size={database: client[database].command("dbStats")["dataSize"] for database in BENCHMARK.DATABASES},
+	)
+
+def mongo_delta(before, after):
+	"""
+	Returns:
+		dict: The operations run between two `mongo_snapshot`s, in total and per collection
+			(collections without operations are left out), and the bytes added to every database
+	"""
+	namespaces = None
+	if before["namespaces"] is not None and after["namespaces"] is not None:
+		namespaces = dict()
+		for namespace, counters in after["namespaces"].items():
+			previous = before["namespaces"].get(namespace, dict())
+			delta = {op: count - previous.get(op, 0) for op, count in counters.items()}
+			if any(delta.values()):
+				namespaces[namespace] = delta
+	return dict(
+		operations={op: count - before["opcounters"].get(op, 0) for op, count in after["opcounters"].items()},
+		namespaces=namespaces,
+		bytes_stored={database: size - before["data_size"][database] for database, size in after["data_size"].items()},
+	)
+
+def queue_hops(start_time, finish_time):
+	"""
+	Returns:
+		dict: Maps each queue to the number of deliveries dequeued between both times and their total `queue_time`
+	"""
+	hops = dict()
+	for record in client.monitor.delivery.aggregate([
+		{"$match": {"dequeue_time": {"$gte": start_time, "$lte": finish_time}}},
+		{"$group": dict(
+			_id="$service",
+			deliveries={"$sum": 1},
+			queue_time={"$sum": {"$ifNull": ["$queue_time", 0]}},
+		)},
+	]):
+		hops[record["_id"]] = dict(deliveries=record["deliveries"], queue_time=record["queue_time"])
+	return hops
+
+def file_bytes(lecture_id):
+	"""
+	Returns:
+		dict: Bytes of the buffer directory of the lecture and of the blobs its file snippets reference
+	"""
+	buffer_bytes = 0
+	for root, _, files in os.walk(buffer_path(lecture_id)):
+		buffer_bytes += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+	digests = {
+		snippet["image_sha256"]
+		for snippet in find_file_snippets(dict(lecture_id=lecture_id), projection=dict(image_sha256=1))
+		if snippet.get("image_sha256")
+	}
+	return dict(
+		buffer=buffer_bytes,
+		blobs=sum(os.path.getsize(blob_store.path(digest)) for digest in digests if blob_store.exists(digest)),
+	)
+
+def run_deck(source_file, fused=False, timeout=BENCHMARK.DECK_TIMEOUT):
+	"""Run a deck through preclass and measure it.
+
+	Decks have to be run one at a time, since operations, queue hops and database sizes
+	are measured server-wide.
+
+	Args:
+		source_file (str): Path of the deck, moved into the buffer by `PRECLASS_MAIN.trigger`
+		fused (bool): Run the deck with the fused runner
+		timeout (int): Maximum time to wait for the deck in seconds
+
+	Returns:
+		dict: The `wall_time` of the deck and of each of its `stages`, its `mongo` operations
+			and bytes stored, `queue_hops`, `llm` usage and `files` bytes
+
+	Raises:
+		TimeoutError: If the deck does not finish within the timeout period
+		RuntimeError: If a stage of the deck failed
+	"""
+	main = get_services()["preclass_main"]
+	before = mongo_snapshot()
+	start_time = now()
+	job_id = main.trigger(parent_service="benchmark", source_file=source_file, fused=fused)
+	while True:
+		job = main._collection.find_one(dict(_id=job_id))
+		if job["stage"] == main.STAGE.FINISHED:
+			break
+		if job.get("failed") or job.get("dead_lettered"):
+			raise RuntimeError(f"Deck {source_file} failed - {job.get('failure_reason')}")
+		if (now() - start_time).total_seconds() >= timeout:
+			raise TimeoutError(f"Deck {source_file} did not finish after {timeout} seconds")
+		time.sleep(BENCHMARK.POLL_INTERVAL)
+	finish_time = now()
+	after = mongo_snapshot()
+
+	lecture_id = job["lecture_id"]
+	stages = dict()
+	for name, state in job["stages"].items():
+		stage_start, stage_finish = state.get("start_time"), state.get("completion_time")
+		stages[name] = dict(
+			start=(stage_start - start_time).total_seconds() if stage_start else None,
+			wall_time=(stage_finish - stage_start).total_seconds() if stage_start and stage_finish else None,
+		)
+	return dict(
+		job_id=str(job_id),
+		lecture_id=str(lecture_id),
+		slides=count_file_snippets(dict(lecture_id=lecture_id)),
+		wall_time=(finish_time - start_time).total_seconds(),
+		stages=stages,
+		mongo=mongo_delta(before, after),
+		queue_hops=queue_hops(start_time, finish_time),
+		llm=get_services()["openai"].usage_by_lecture([lecture_id]).get(lecture_id, dict()),
+		files=file_bytes(lecture_id),
+	)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmark preclass on synthetic decks with the mock LLM.")
+	parser.add_argument("--sizes", type=int, nargs="+", default=BENCHMARK.SIZES, help="Slides of each synthetic deck")
+	parser.add_argument("--latency", type=float, default=BENCHMARK.LATENCY, help="Seconds the mock LLM takes per request")
+	parser.add_argument("--fused", action="store_true", help="Run the decks with the fused runner")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--external_workers", action="store_true", help="Use running workers instead of starting them (start llm-openai with --openai_mock_latency)")
+	parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+	args, _ = parser.parse_known_args()
+
+	run_id = now().strftime("%Y%m%d-%H%M%S")
+	run_dir = os.path.join(BENCHMARK.ROOT, run_id)
+	os.makedirs(run_dir)
+	processes = []
+	if not args.external_workers:
+		processes = launch_workers(args.latency, os.path.join(run_dir, "logs"))
+		time.sleep(BENCHMARK.WARMUP)
+
+	results = []
+	try:
+		for size in args.sizes:
+			source_file = os.path.join(run_dir, f"synthetic-{size}.pptx")
+			make_deck(source_file, size, seed=args.seed, run_id=run_id)
+			deck_bytes = os.path.getsize(source_file)
+			logger.warning(f"Running Synthetic Deck Of {size} Slides")
+			result = run_deck(source_file, fused=args.fused)
+			result.update(size=size, deck_bytes=deck_bytes)
+			logger.warning(f"Deck Of {size} Slides Finished In {result['wall_time']:.1f}s")
+			results.append(result)
+	finally:
+		stop_workers(processes)
+
+	output = json.dumps(
+		dict(
+			run_id=run_id,
+			latency=args.latency,
+			fused=args.fused,
+			decks=results,
+		),
+		indent=2,
+	)
+	if args.output:
+		with open(args.output, "w", encoding="utf-8") as f:
+			f.write(output)
+	else:
+		sys.stdout.write(output + "\n")
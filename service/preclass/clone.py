@@ -0,0 +1,105 @@
+import os
+import shutil
+
+from pymongo import MongoClient
+from bson import ObjectId
+
+from config import MONGO
+from utils import buffer_path
+from data.lecture import find_info, publish_agenda
+
+client = MongoClient(
+	MONGO.HOST,
+	MONGO.PORT
+	)
+
+# Per-slide results, keyed by (lecture_id, index), that are copied as they are
+SLIDE_RESULTS = [
+	client.preclass.gen_description_result,
+	client.preclass.gen_readscript_result,
+	client.preclass.gen_askquestion_result,
+	client.preclass.slide_event,
+	client.preclass.stage_event,
+]
+
+def find_completed_lecture(source_sha256: str, main_collection):
+	"""Find a lecture whose seed file has the given digest and whose preclass pipeline finished.
+
+	Args:
+		source_sha256 (str): SHA-256 of the seed file
+		main_collection: The `preclass.main` collection
+
+	Returns:
+		ObjectId: The lecture finished last, or None
+	"""
+	lecture_ids = [
+		info["_id"]
+		for info in client.lecture.info.find(dict(source_sha256=source_sha256), dict(_id=1))
+	]
+	if not lecture_ids:
+		return None
+	job = main_collection.find_one(
+		dict(
+			lecture_id={"$in": lecture_ids},
+			completion_time={"$exists": True},
+		),
+		dict(lecture_id=1),
+		sort=[("completion_time", -1)],
+	)
+	return job["lecture_id"] if job else None
+
+def _clone_tree(collection, source_lecture_id, lecture_id, id_map, references=("parent_id",)):
+	"""Copy the documents of a lecture with a single `insert_many`.
+
+	New ObjectIds are allocated up front and recorded in `id_map`, so that the fields
+	in `references` can point to the copies before any of them is inserted.
+	"""
+	documents = list(collection.find(dict(lecture_id=source_lecture_id)))
+	for document in documents:
+		id_map[document["_id"]] = ObjectId()
+	for document in documents:
+		document["_id"] = id_map[document["_id"]]
+		document["lecture_id"] = lecture_id
+		for reference in references:
+			if document.get(reference) is not None:
+				document[reference] = id_map.get(document[reference], document[reference])
+	if documents:
+		collection.insert_many(documents, ordered=True)
+
+def clone_lecture(source_lecture_id: ObjectId, lecture_id: ObjectId):
+	"""Copy the preclass artifacts of a finished lecture to a lecture with the same seed file.
+
+	The file snippets, per-slide results and both agenda trees are copied with one bulk
+	insert per collection, and the rendered PDF is linked into the buffer of the new
+	lecture so that its renditions can be served. Images are shared through the blob store.
+
+	Args:
+		source_lecture_id (ObjectId): The finished lecture
+		lecture_id (ObjectId): The new lecture, which has no artifacts yet
+	"""
+	id_map = dict()
+	_clone_tree(client.lecture.file_snippet, source_lecture_id, lecture_id, id_map, references=())
+
+	for collection in SLIDE_RESULTS:
+		documents = list(collection.find(dict(lecture_id=source_lecture_id), dict(_id=0)))
+		for document in documents:
+			document["lecture_id"] = lecture_id
+			for source_file in document.get("source_content", {}).get("source_file", []):
+				source_file["file_id"] = id_map.get(source_file["file_id"], source_file["file_id"])
+		if documents:
+			collection.insert_many(documents, ordered=False)
+
+	# The preclass tree is copied first, the lecture tree refers to its nodes
+	_clone_tree(client.preclass.agenda, source_lecture_id, lecture_id, id_map)
+	_clone_tree(client.lecture.agenda, source_lecture_id, lecture_id, id_map, references=("parent_id", "preclass_agenda_id"))
+	# The copied nodes keep the version of the source tree
+	publish_agenda(lecture_id, find_info(dict(_id=source_lecture_id)).get("agenda_version"))
+
+	source_pdf = buffer_path(source_lecture_id, "pdf", "seed_file.pdf")
+	if os.path.exists(source_pdf):
+		pdf = buffer_path(lecture_id, "pdf", "seed_file.pdf")
+		os.makedirs(os.path.dirname(pdf), exist_ok=True)
+		try:
+			os.link(source_pdf, pdf)
+		except OSError:
+			shutil.copyfile(source_pdf, pdf)
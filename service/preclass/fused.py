@@ -0,0 +1,355 @@
+import sys
+import os
+
+from pymongo import MongoClient
+from bson import ObjectId
+
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure, preclass_context_size as context_size
+from config import MONGO
+from service.monitor import instrument
+from service import get_services
+from data.lecture import find_info, find_file_snippets
+from data.blob import read_base64
+from service.preclass.model import AgendaStruct, ReadScript, FunctionBase, prefetch_pages
+from service.preclass.stream import publish_slide, finish_stage, dead_letter_handler
+from service.preclass.processors.gen_description import system_summarize, format_script, append_recent_scripts
+from service.preclass.processors.gen_structure import Structurelizor
+from service.preclass.processors.gen_showfile import SourceFileBinder
+from service.preclass.processors.gen_readscript import PPTScriptGenerator
+from service.preclass.processors.gen_askquestion import QAGenerator
+
+def count_pages(agenda):
+	"""
+	Returns:
+		int: Number of slides in an agenda
+	"""
+	page_count = 0
+	def count(node):
+		nonlocal page_count
+		if node.type=="ppt":
+			page_count += 1
+	agenda.dfs_recursive_call(count)
+	return page_count
+
+class PRECLASS_FUSED:
+	"""Runs every preclass stage of a lecture in a single process.
+
+	The staged pipeline of `PRECLASS_MAIN.PIPELINE` hands every stage over through
+	RabbitMQ and re-reads the agenda of the previous stage from MongoDB. This runner
+	calls the same processors one after another and passes the live `AgendaStruct`
+	from stage to stage instead. Only the per-slide results (which redeliveries and
+	revised decks reuse), a checkpoint after every stage and the final agenda are
+	written, so a redelivered job resumes after its last finished stage.
+
+	It is selected per job with `PRECLASS_MAIN.trigger(..., fused=True)`, which pays
+	off for small decks and batch re-generation, where the queue hops dominate.
+
+	Every stage publishes the same slide and stage events (see `service.preclass.stream`)
+	and stores the same per-slide results as its staged counterpart, so the progress of a
+	fused job is reported per slide and its lecture can be cloned or revised like any other.
+	"""
+
+	# Stages in execution order, each run by the static method of the same name
+	STEPS = ["pptx2pdf", "pdf2png", "gen_description", "gen_structure", "gen_showfile", "gen_readscript", "gen_askquestion"]
+
+	_collection = MongoClient(
+		MONGO.HOST,
+		MONGO.PORT
+		).preclass.fused
+	_queue_name = "preclass-fused"
+
+	_logger = get_logger(
+		__name__=__name__,
+		__file__=__file__,
+	)
+
+	@staticmethod
+	def trigger(
+			parent_service: str,
+			lecture_id: ObjectId,
+			parent_job_id: ObjectId
+			) -> str:
+		"""Trigger a new fused preclass job.
+
+		Args:
+			parent_service (str): Name of the parent service
+			lecture_id (ObjectId): MongoDB ObjectId of the lecture
+			parent_job_id (ObjectId): MongoDB ObjectId of the parent job
+
+		Returns:
+			str: The job ID of the created job
+		"""
+		connection, channel = get_channel(PRECLASS_FUSED._queue_name)
+
+		PRECLASS_FUSED._logger.info("Pushing job to MONGO")
+		job_id = PRECLASS_FUSED._collection.insert_one(
+			dict(
+				parent_service=parent_service,
+				created_time = now(),
+				lecture_id=lecture_id,
+				parent_job_id=parent_job_id,
+				checkpoint=None,
+			)
+		).inserted_id
+
+		PRECLASS_FUSED._logger.info("Pushing job to RabbitMQ")
+		channel.basic_publish(
+			exchange="",
+			routing_key=PRECLASS_FUSED._queue_name,
+			body=str(job_id),
+			properties=message_properties()
+		)
+		connection.close()
+
+		PRECLASS_FUSED._logger.info("Job pushed to RabbitMQ")
+		return job_id
+
+	@staticmethod
+	def pptx2pdf(lecture_id, agenda):
+		get_services()["preclass_pptx2pdf"].convert(lecture_id)
+
+	@staticmethod
+	def pdf2png(lecture_id, agenda):
+		get_services()["preclass_pdf2png"].process(lecture_id)
+
+	@staticmethod
+	def gen_description(lecture_id, agenda):
+		"""Describes the slides in order, each with the descriptions of the previous slides as context."""
+		description_service = get_services()["preclass_gen_description"]
+		description_service.reuse_descriptions(lecture_id)
+		described = {
+			result["index"]: result["description"]
+			for result in description_service._result_collection.find(dict(lecture_id=lecture_id), dict(index=1, description=1))
+		}
+
+		recent_scripts = []
+		page_count = 0
+		for file_snippet in find_file_snippets(dict(lecture_id=lecture_id), sort=[("idx", 1)]):
+			page_count += 1
+			description = described.get(file_snippet["idx"])
+			if description is None:
+				messages = system_summarize + recent_scripts + format_script(
+					role="user",
+					message=file_snippet["content"],
+					image_url=read_base64(file_snippet.get("image_sha256")),
+					image_mime_type=file_snippet.get("image_mime_type", "image/png"),
+					)
+				openai_job_id = get_services()["openai"].trigger(
+					parent_service=PRECLASS_FUSED._queue_name,
+					lecture_id=lecture_id,
+					model="gpt-4o-2024-08-06",
+					messages=messages,
+					max_tokens=4096,
+					use_cache=True
+					)
+				description = get_services()["openai"].get_response_sync(openai_job_id)
+				if description is None:
+					raise TimeoutError(f"Describing slide {file_snippet['idx']} of {lecture_id} timed out")
+				description_service.save_description(lecture_id, file_snippet, description)
+			else:
+				publish_slide(lecture_id, "gen_description", file_snippet["idx"])
+			recent_scripts = append_recent_scripts(recent_scripts, file_snippet, description)
+		finish_stage(lecture_id, "gen_description", total=page_count)
+
+	@staticmethod
+	def gen_structure(lecture_id, agenda):
+		results = list(get_services()["preclass_gen_description"]._result_collection.find(
+			dict(lecture_id=lecture_id),
+			dict(index=1, description=1),
+			sort=[("index", 1)],
+		))
+		if not results:
+			raise LookupError(f"No pre-results found for lecture_id: {lecture_id}")
+		def publish_placement(page, structure):
+			# Same event as the staged gen_structure
+			publish_slide(
+				lecture_id,
+				"gen_structure",
+				page.content["index"],
+				section=len(structure.children) - 1,
+				top_level=structure.children[-1] is page,
+			)
+		agenda = Structurelizor(
+			root_agenda_title=find_info(dict(_id=lecture_id))["lecture_name"],
+			input_scripts=results,
+			on_page_placed=publish_placement,
+			lecture_id=lecture_id,
+			).extract()
+		for child in agenda.children:
+			child.flatten()
+		finish_stage(lecture_id, "gen_structure", total=count_pages(agenda))
+		return agenda
+
+	@staticmethod
+	def gen_showfile(lecture_id, agenda):
+		agenda = SourceFileBinder(agenda).extract()
+		finish_stage(lecture_id, "gen_showfile", total=count_pages(agenda))
+		return agenda
+
+	@staticmethod
+	def gen_readscript(lecture_id, agenda):
+		"""Writes the script of every slide in agenda order, keeping the scripts written earlier."""
+		readscript_service = get_services()["preclass_gen_readscript"]
+		readscript_service.reuse_scripts(lecture_id)
+		existing = {
+			result["index"]: result["script"]
+			for result in readscript_service._result_collection.find(dict(lecture_id=lecture_id), dict(index=1, script=1))
+		}
+		descriptions = prefetch_pages(readscript_service._script_collection, agenda, projection=dict(source_content=1))
+
+		generator = PPTScriptGenerator(agenda, lecture_id=lecture_id)
+		def attach_script(node):
+			if node.type=="ppt":
+				index = node.content["index"]
+				script = generator.generate_script(
+					descriptions[node.content["_id"]]["source_content"],
+					script=existing.get(index),
+				)
+				if index not in existing:
+					readscript_service._result_collection.update_one(
+						dict(lecture_id=lecture_id, index=index),
+						{"$set": dict(
+							script=script,
+							time=now(),
+						)},
+						upsert=True
+					)
+				node.function.append(ReadScript(script=script))
+				publish_slide(lecture_id, "gen_readscript", index)
+		agenda.dfs_recursive_call(attach_script)
+		finish_stage(lecture_id, "gen_readscript", total=count_pages(agenda))
+		return agenda
+
+	@staticmethod
+	def gen_askquestion(lecture_id, agenda):
+		"""Asks the questions of every section like the staged gen_askquestion, reusing and storing them per slide."""
+		askquestion_service = get_services()["preclass_gen_askquestion"]
+		questions = {
+			result["index"]: result["questions"]
+			for result in askquestion_service._result_collection.find(dict(lecture_id=lecture_id), dict(index=1, questions=1))
+		}
+		# Questions are asked after the last page of every section with at least 3 pages
+		sites = {
+			section.children[-1].content["index"]
+			for section in agenda.children
+			if section.type != "ppt" and len(section.children) >= 3
+		}
+
+		generator = QAGenerator(lecture_id=lecture_id)
+		recent_scripts = []
+		def ask_questions(node):
+			nonlocal recent_scripts
+			if node.type=="ppt":
+				index = node.content["index"]
+				script = next(function.value["script"] for function in node.function if function.call == "ReadScript")
+				recent_scripts = recent_scripts[-context_size:] + [script]
+				if index in sites:
+					if index not in questions and askquestion_service.reuse_questions(lecture_id, index, len(recent_scripts)):
+						questions[index] = askquestion_service._result_collection.find_one(dict(lecture_id=lecture_id, index=index))["questions"]
+					if index not in questions:
+						generated = generator.generate_questions(recent_scripts)
+						askquestion_service.save_questions(lecture_id, index, generated)
+						questions[index] = [func.to_dict() for func in generated]
+					node.function += [FunctionBase.from_dict(func) for func in questions[index]]
+				publish_slide(lecture_id, "gen_askquestion", index)
+		agenda.dfs_recursive_call(ask_questions)
+		return agenda
+
+	@staticmethod
+	def callback(ch, method, properties, body):
+		"""Runs the stages of a job that are not checkpointed yet, then pushes the agenda.
+
+		Args:
+			ch: RabbitMQ channel
+			method: RabbitMQ method frame
+			properties: RabbitMQ properties
+			body: Message body containing the job ID
+		"""
+		job_id = ObjectId(body.decode())
+		job = PRECLASS_FUSED._collection.find_one(dict(_id=job_id))
+		lecture_id, parent_service, parent_job_id = job["lecture_id"], job["parent_service"], job["parent_job_id"]
+		PRECLASS_FUSED._logger.debug(f"Recieved PreClass FUSED Job - {lecture_id}")
+
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			PRECLASS_FUSED._logger.info(f"Fused Run Already Done For {lecture_id}")
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+
+		checkpoint = job.get("checkpoint")
+		agenda, start = None, 0
+		if checkpoint:
+			agenda = AgendaStruct.from_dict(checkpoint["agenda"]) if checkpoint["agenda"] else None
+			start = PRECLASS_FUSED.STEPS.index(checkpoint["step"]) + 1
+			PRECLASS_FUSED._logger.info(f"Resuming Fused Run For {lecture_id} After {checkpoint['step']}")
+
+		for step in PRECLASS_FUSED.STEPS[start:]:
+			PRECLASS_FUSED._logger.info(f"Running {step} For {lecture_id}")
+			agenda = getattr(PRECLASS_FUSED, step)(lecture_id, agenda) or agenda
+			PRECLASS_FUSED._collection.update_one(
+				dict(_id=job_id),
+				{"$set": dict(
+					checkpoint=dict(
+						step=step,
+						agenda=agenda.to_dict() if agenda else None,
+					),
+				)}
+			)
+
+		get_services()["preclass_gen_askquestion"].push_agenda(lecture_id, agenda)
+
+		PRECLASS_FUSED._collection.update_one(
+			dict(_id=job_id),
+			{"$set": dict(
+				completion_time=now(),
+			)}
+		)
+		# Like the staged gen_askquestion, the last stage finishes once the agenda is pushed
+		finish_stage(lecture_id, "gen_askquestion", total=count_pages(agenda))
+		PRECLASS_FUSED._logger.info(f"Fused Run Complete For {lecture_id}")
+		notify_parent(parent_service, parent_job_id)
+		ch.basic_ack(delivery_tag = method.delivery_tag)
+
+	@staticmethod
+	def launch_worker():
+		"""Launch the worker to process fused preclass jobs.
+
+		Starts its own converter pool when LibreOffice is available, like the
+		pptx2pdf worker. Can be terminated with CTRL+C.
+		"""
+		pptx2pdf = get_services()["preclass_pptx2pdf"]
+		try:
+			pptx2pdf.start_converter_pool(size=1)
+			connection, channel = get_channel(PRECLASS_FUSED._queue_name)
+			declare_retry_queues(channel, PRECLASS_FUSED._queue_name)
+
+			channel.basic_consume(
+				queue=PRECLASS_FUSED._queue_name,
+				on_message_callback=retry_on_failure(
+					instrument(
+						PRECLASS_FUSED.callback,
+						queue_name=PRECLASS_FUSED._queue_name,
+						collection=PRECLASS_FUSED._collection,
+					),
+					queue_name=PRECLASS_FUSED._queue_name,
+					collection=PRECLASS_FUSED._collection,
+					logger=PRECLASS_FUSED._logger,
+					on_dead_letter=dead_letter_handler(PRECLASS_FUSED._collection, "fused"),
+				),
+				auto_ack=False,
+			)
+			PRECLASS_FUSED._logger.info('Worker Launched. To exit press CTRL+C')
+			channel.start_consuming()
+		except KeyboardInterrupt:
+			PRECLASS_FUSED._logger.warning('Shutting Off Worker')
+			if pptx2pdf._converter_pool:
+				pptx2pdf._converter_pool.close()
+			try:
+				sys.exit(0)
+			except SystemExit:
+				os._exit(0)
+
+if __name__ == "__main__":
+	PRECLASS_FUSED._logger.warning("STARTING PRECLASS-FUSED SERVICE")
+	PRECLASS_FUSED.launch_worker()
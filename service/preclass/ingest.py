@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from bson import ObjectId
+
+from config import INGEST
+from utils import get_logger, now
+from service import get_services
+from data.lecture import count_file_snippets
+
+logger = get_logger(
+	__name__=__name__,
+	__file__=__file__,
+)
+
+def load_decks(source):
+	"""List the decks of a batch.
+
+	Args:
+		source (str): A directory, whose `.ppt` and `.pptx` files are taken in name order,
+			or a manifest. A `.json` manifest holds a list of paths or of dicts with the
+			`source_file` and optionally the `previous_lecture_id` and `fused` of each deck.
+			Any other manifest lists one path per line, `#` starts a comment. Relative paths
+			are resolved against the directory of the manifest.
+
+	Returns:
+		list[dict]: The `source_file` and trigger options of every deck
+	"""
+	if os.path.isdir(source):
+		return [
+			dict(source_file=os.path.join(source, name))
+			for name in sorted(os.listdir(source))
+			if os.path.splitext(name)[1].lower() in (".ppt", ".pptx")
+		]
+
+	root = os.path.dirname(os.path.abspath(source))
+	with open(source, "r", encoding="utf-8") as f:
+		if source.endswith(".json"):
+			entries = json.load(f)
+		else:
+			entries = [line.split("#", 1)[0].strip() for line in f]
+			entries = [entry for entry in entries if entry]
+
+	decks = []
+	for entry in entries:
+		deck = dict(source_file=entry) if isinstance(entry, str) else dict(entry)
+		deck["source_file"] = os.path.join(root, deck["source_file"])
+		decks.append(deck)
+	return decks
+
+def deck_cost(usage):
+	"""
+	Args:
+		usage (dict): Token usage of a deck per model, see `OPENAI_SERVICE.usage_by_lecture`
+
+	Returns:
+		float: The cost of the usage in USD, None if a model with tokens has no price in `INGEST.PRICES`
+	"""
+	cost = 0.0
+	for model, model_usage in usage.items():
+		if not model_usage["total_tokens"]:
+			continue
+		if model not in INGEST.PRICES:
+			return None
+		prompt_price, completion_price = INGEST.PRICES[model]
+		cost += (model_usage["prompt_tokens"] * prompt_price + model_usage["completion_tokens"] * completion_price) / 1e6
+	return cost
+
+def ingest(
+		decks,
+		parent_service="ingest",
+		concurrency=INGEST.CONCURRENCY,
+		token_budget=INGEST.TOKEN_BUDGET,
+		deck_timeout=INGEST.DECK_TIMEOUT,
+		fused=None,
+		keep_source=True
+		):
+	"""Run a batch of decks through preclass with a global concurrency limit and a shared token budget.
+
+	At most `concurrency` decks are in flight at a time, the next deck is triggered as soon
+	as one finishes. A new deck is only started while the tokens spent by the batch, plus the
+	average spend of a finished deck for every deck in flight, stay below `token_budget`.
+	The remaining decks are reported as `skipped` once the budget is used up.
+
+	Args:
+		decks (list[dict]): The `source_file` and trigger options of every deck, see `load_decks`
+		parent_service (str): Parent service recorded on the preclass jobs
+		concurrency (int): Maximum number of decks in flight
+		token_budget (int, optional): LLM tokens the batch may spend, None for unlimited
+		deck_timeout (int): Seconds after which a deck in flight is reported as `timeout`
+		fused (bool, optional): Default of the `fused` option of the decks
+		keep_source (bool): Trigger a copy of every deck, since `PRECLASS_MAIN.trigger`
+			moves its source file into the buffer
+
+	Returns:
+		list[dict]: The report of every deck in order: its `status` (`finished`, `cloned`,
+			`failed`, `timeout` or `skipped`), ids, `slides`, `wall_time`, `slides_per_minute`,
+			token `usage` per model, `tokens` and `cost` in USD, and the `failure_reason`
+			of a failed deck
+	"""
+	main = get_services()["preclass_main"]
+	openai = get_services()["openai"]
+	staging = tempfile.mkdtemp(prefix="preclass-ingest-") if keep_source else None
+
+	reports = [dict(source_file=deck["source_file"], status="pending") for deck in decks]
+	in_flight = dict() # job id -> position of the deck
+	finished_tokens = []
+	next_deck = 0
+
+	def spent_tokens():
+		lecture_ids = [report["lecture_id"] for report in reports if report.get("lecture_id")]
+		usage = openai.usage_by_lecture(lecture_ids)
+		for report in reports:
+			if report.get("lecture_id"):
+				report["usage"] = usage.get(report["lecture_id"], dict())
+				report["tokens"] = sum(model_usage["total_tokens"] for model_usage in report["usage"].values())
+		return sum(report.get("tokens", 0) for report in reports)
+
+	def close(position, status):
+		report = reports[position]
+		report["status"] = status
+		report["completion_time"] = now()
+		report["wall_time"] = (report["completion_time"] - report["start_time"]).total_seconds()
+		report["slides"] = count_file_snippets(dict(lecture_id=report["lecture_id"]))
+		report["slides_per_minute"] = report["slides"] / report["wall_time"] * 60 if report["wall_time"] else None
+		logger.info(f"Deck {position + 1}/{len(decks)} {status.capitalize()} In {report['wall_time']:.0f}s - {report['source_file']}")
+
+	try:
+		while next_deck < len(decks) or in_flight:
+			spent = spent_tokens()
+			for job in main._collection.find(
+					{"_id": {"$in": list(in_flight)}},
+					dict(stage=1, failed=1, dead_lettered=1, failure_reason=1)
+					):
+				if job["stage"] == main.STAGE.FINISHED:
+					position = in_flight.pop(job["_id"])
+					close(position, "finished")
+					finished_tokens.append(reports[position].get("tokens", 0))
+				elif job.get("failed") or job.get("dead_lettered"):
+					position = in_flight.pop(job["_id"])
+					reports[position]["failure_reason"] = job.get("failure_reason")
+					close(position, "failed")
+			for job_id, position in list(in_flight.items()):
+				if (now() - reports[position]["start_time"]).total_seconds() >= deck_timeout:
+					del in_flight[job_id]
+					close(position, "timeout")
+
+			while next_deck < len(decks) and len(in_flight) < concurrency:
+				if token_budget is not None:
+					expected = sum(finished_tokens) / len(finished_tokens) if finished_tokens else 0
+					if spent + expected * len(in_flight) >= token_budget:
+						break
+				deck, report = decks[next_deck], reports[next_deck]
+				source_file = deck["source_file"]
+				if staging:
+					source_file = os.path.join(staging, str(next_deck), os.path.basename(source_file))
+					os.makedirs(os.path.dirname(source_file))
+					shutil.copy2(deck["source_file"], source_file)
+				report["start_time"] = now()
+				job_id = main.trigger(
+					parent_service=parent_service,
+					source_file=source_file,
+					previous_lecture_id=deck.get("previous_lecture_id"),
+					fused=deck.get("fused", fused),
+				)
+				job = main._collection.find_one(dict(_id=job_id))
+				report.update(job_id=job_id, lecture_id=job["lecture_id"], status="running")
+				if job.get("cloned_from"):
+					close(next_deck, "cloned")
+				else:
+					in_flight[job_id] = next_deck
+				logger.info(f"Deck {next_deck + 1}/{len(decks)} Started - {deck['source_file']}")
+				next_deck += 1
+
+			if token_budget is not None and next_deck < len(decks) and not in_flight:
+				logger.warning(f"Token Budget Of {token_budget} Used Up, Skipping {len(decks) - next_deck} Decks")
+				break
+			if in_flight:
+				time.sleep(INGEST.POLL_INTERVAL)
+	finally:
+		if staging:
+			shutil.rmtree(staging, ignore_errors=True)
+
+	spent_tokens()
+	for report in reports:
+		if report["status"] == "pending":
+			report["status"] = "skipped"
+		if "usage" in report:
+			report["cost"] = deck_cost(report["usage"])
+	return reports
+
+def summarize(reports, wall_time):
+	"""
+	Args:
+		reports (list[dict]): The deck reports returned by `ingest`
+		wall_time (float): Seconds the whole batch took
+
+	Returns:
+		dict: Deck counts per status, the total `slides`, `tokens` and `cost` and the overall `slides_per_minute`
+	"""
+	statuses = dict()
+	for report in reports:
+		statuses[report["status"]] = statuses.get(report["status"], 0) + 1
+	slides = sum(report.get("slides", 0) for report in reports)
+	costs = [report.get("cost") for report in reports if "cost" in report]
+	return dict(
+		decks=len(reports),
+		statuses=statuses,
+		wall_time=wall_time,
+		slides=slides,
+		slides_per_minute=slides / wall_time * 60 if wall_time else None,
+		tokens=sum(report.get("tokens", 0) for report in reports),
+		cost=None if None in costs else sum(costs),
+	)
+
+def to_json(value):
+	if isinstance(value, ObjectId):
+		return str(value)
+	if hasattr(value, "isoformat"):
+		return value.isoformat()
+	raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run a course of decks through preclass.")
+	parser.add_argument("source", help="Directory of decks or manifest (.json, or one path per line)")
+	parser.add_argument("--concurrency", type=int, default=INGEST.CONCURRENCY, help="Decks in flight at the same time")
+	parser.add_argument("--token_budget", type=int, default=INGEST.TOKEN_BUDGET, help="LLM tokens the batch may spend")
+	parser.add_argument("--deck_timeout", type=int, default=INGEST.DECK_TIMEOUT, help="Seconds a single deck may take")
+	parser.add_argument("--fused", action="store_true", default=None, help="Run every deck with the fused runner")
+	parser.add_argument("--move", action="store_true", help="Move the decks into the buffer instead of copying them")
+	parser.add_argument("--parent_service", default="ingest")
+	parser.add_argument("--report", help="Write the JSON report to this file instead of stdout")
+	args, _ = parser.parse_known_args()
+
+	decks = load_decks(args.source)
+	logger.warning(f"Ingesting {len(decks)} Decks With Concurrency {args.concurrency}")
+	start_time = time.time()
+	reports = ingest(
+		decks,
+		parent_service=args.parent_service,
+		concurrency=args.concurrency,
+		token_budget=args.token_budget,
+		deck_timeout=args.deck_timeout,
+		fused=args.fused,
+		keep_source=not args.move,
+	)
+	output = json.dumps(
+		dict(summary=summarize(reports, time.time() - start_time), decks=reports),
+		default=to_json,
+		ensure_ascii=False,
+		indent=2,
+	)
+	if args.report:
+		with open(args.report, "w", encoding="utf-8") as f:
+			f.write(output)
+	else:
+		sys.stdout.write(output + "\n")
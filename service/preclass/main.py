@@ -2,14 +2,18 @@ from bson import ObjectId
 import pika
 import sys
 import os
+import time
 
 from pymongo import MongoClient
 
 from service import get_services
-from utils import get_logger, now, change_file_path, get_channel
-from config import MONGO
+from utils import get_logger, message_properties, now, move_file_with_sha256, get_channel, declare_retry_queues, retry_on_failure, buffer_path
+from config import MONGO, STREAM, PROGRESS, FUSED
+from service.monitor import instrument
 
-from data.lecture import create_lecture
+from data.lecture import create_lecture, update_info, count_file_snippets
+from service.preclass.stream import stage_progress
+from service.preclass.clone import find_completed_lecture, clone_lecture
 
 class PRECLASS_MAIN:
 	"""Main service class for handling the pre-class lecture processing pipeline.
@@ -33,9 +37,79 @@ class PRECLASS_MAIN:
 		GEN_READSCRIPT=7
 		GEN_ASKQUESTION=8
 
+		FUSED=9
+
 		PUSH_AGENDA=99
 
 		FINISHED=100
+
+	class STATUS:
+		"""Enumeration of the status of a single stage of a job."""
+		PENDING="pending"
+		RUNNING="running"
+		DONE="done"
+		FAILED="failed"
+
+	# Declarative stage graph of the pipeline. A stage is triggered as soon as every
+	# stage listed in its `after` is done and every stage listed in its `streams` has
+	# started, so independent branches run concurrently. A streaming stage consumes the
+	# per-slide events of its upstream (see `service.preclass.stream`) while the upstream
+	# is still working on later slides.
+	# Adding a stage only takes a new entry here and a service in `get_services()`.
+	PIPELINE = dict(
+		pptx2pdf=dict(
+			stage=STAGE.PPTX2PDF,
+			service="preclass_pptx2pdf",
+			after=[],
+		),
+		pdf2png=dict(
+			stage=STAGE.PDF2PNG,
+			service="preclass_pdf2png",
+			after=["pptx2pdf"],
+		),
+		# pdf2png also extracts the text, notes and text blocks of the slides, see `ppt2text.extract_slides`
+		gen_description=dict(
+			stage=STAGE.GEN_DESCRIPTION,
+			service="preclass_gen_description",
+			after=["pdf2png"],
+		),
+		gen_structure=dict(
+			stage=STAGE.GEN_STRUCTURE,
+			service="preclass_gen_structure",
+			after=[],
+			streams=["gen_description"],
+		),
+		gen_showfile=dict(
+			stage=STAGE.GEN_SHOWFILE,
+			service="preclass_gen_showfile",
+			after=["gen_structure"],
+		),
+		# Waits for gen_showfile by itself before attaching its scripts to the agenda
+		gen_readscript=dict(
+			stage=STAGE.GEN_READSCRIPT,
+			service="preclass_gen_readscript",
+			after=[],
+			streams=["gen_structure"],
+		),
+		# Also reads the section of each slide from the gen_structure events
+		gen_askquestion=dict(
+			stage=STAGE.GEN_ASKQUESTION,
+			service="preclass_gen_askquestion",
+			after=[],
+			streams=["gen_readscript"],
+		),
+	)
+
+	# Stage graph of the jobs triggered with `fused=True`, whose stages all run in a
+	# single process (see `service.preclass.fused`)
+	FUSED_PIPELINE = dict(
+		fused=dict(
+			stage=STAGE.FUSED,
+			service="preclass_fused",
+			after=[],
+		),
+	)
+
 	_collection = MongoClient(
 		MONGO.HOST,
 		MONGO.PORT
@@ -55,19 +129,167 @@ class PRECLASS_MAIN:
 		return job["stage"]
 
 	@staticmethod
-	def trigger(parent_service: str, source_file: str) -> str:
+	def get_progress(job_id: str):
+		"""Reports the progress of every stage of a job, with an estimate of its remaining time.
+
+		Stages that publish slide events (see `service.preclass.stream`) report how many
+		slides they finished. Their ETA extrapolates the time they took per slide so far.
+		A stage whose sub job was dead-lettered is reported as failed, with its reason.
+		
+		Args:
+			job_id (str): The ID of the job
+
+		Returns:
+			dict: The `stage` and `stages` of the job, whether it `failed` with which
+				`failure_reason`, and its overall `eta` in seconds (the largest ETA known so far).
+				Each stage has its `status`, `done` and `total` slides, timestamps, `eta` and
+				`failure_reason`.
+				`cursor` changes whenever any of them advances, see `wait_for_progress`.
+				None if the job does not exist.
+		"""
+		job = PRECLASS_MAIN._collection.find_one(dict(_id=ObjectId(job_id)))
+		if job is None:
+			return None
+		lecture_id = job["lecture_id"]
+		job_stages = job.get("stages") or PRECLASS_MAIN.legacy_stages(job["stage"])
+		events = stage_progress(lecture_id)
+		slide_count = None
+		if job_stages.get("pdf2png", {}).get("status") == PRECLASS_MAIN.STATUS.DONE:
+			slide_count = count_file_snippets(dict(lecture_id=lecture_id))
+
+		ranks = {
+			PRECLASS_MAIN.STATUS.PENDING: 0,
+			PRECLASS_MAIN.STATUS.RUNNING: 1,
+			PRECLASS_MAIN.STATUS.DONE: 2,
+			PRECLASS_MAIN.STATUS.FAILED: 3,
+		}
+		cursor = 0
+		states = dict(job_stages)
+		# Stages run in-process by the fused runner only have their slide events
+		for name, event in events.items():
+			if name not in states:
+				finished = event["total"] is not None
+				status = PRECLASS_MAIN.STATUS.DONE if finished else PRECLASS_MAIN.STATUS.RUNNING
+				if event["failed"]:
+					status = PRECLASS_MAIN.STATUS.FAILED
+				states[name] = dict(
+					status=status,
+					start_time=event["first_time"],
+					completion_time=event["last_time"] if finished else None,
+				)
+
+		stages = dict()
+		for name, state in states.items():
+			event = events.get(name)
+			done = event["done"] if event else None
+			total = (event["total"] or slide_count) if event else None
+			start_time = state.get("start_time")
+
+			eta = None
+			if state["status"] == PRECLASS_MAIN.STATUS.DONE:
+				eta = 0
+			elif event and done and total and start_time:
+				per_slide = (event["last_time"] - start_time).total_seconds() / done
+				since_last = (now() - event["last_time"]).total_seconds()
+				eta = max(0, per_slide * (total - done) - since_last)
+
+			cursor += ranks[state["status"]] + (done or 0)
+			stages[name] = dict(
+				status=state["status"],
+				done=done,
+				total=total,
+				start_time=start_time,
+				completion_time=state.get("completion_time"),
+				eta=eta,
+				failure_reason=state.get("failure_reason"),
+			)
+
+		# Streaming stages overlap, so the job finishes with its slowest stage
+		etas = [stage["eta"] for stage in stages.values() if stage["eta"] is not None]
+		failed = bool(job.get("failed") or job.get("dead_lettered"))
+		return dict(
+			job_id=str(job["_id"]),
+			lecture_id=str(lecture_id),
+			stage=job["stage"],
+			stages=stages,
+			failed=failed,
+			failure_reason=job.get("failure_reason"),
+			eta=None if failed else (max(etas) if etas else None),
+			cursor=cursor,
+		)
+
+	@staticmethod
+	def legacy_stages(stage: int) -> dict:
+		"""Derives the `stages` of a job created before the stage graph from its `stage`.
+
+		Those jobs ran the stages of `PIPELINE` one after another in `STAGE` order, so
+		the stages before `stage` are done and `stage` itself is running.
+
+		Args:
+			stage (int): The `stage` field of the job
+
+		Returns:
+			dict: The state of every stage of `PIPELINE`, as in the `stages` field of a job
+		"""
+		stages = dict()
+		for name, node in PRECLASS_MAIN.PIPELINE.items():
+			if node["stage"] < stage:
+				status = PRECLASS_MAIN.STATUS.DONE
+			elif node["stage"] == stage:
+				status = PRECLASS_MAIN.STATUS.RUNNING
+			else:
+				status = PRECLASS_MAIN.STATUS.PENDING
+			stages[name] = dict(status=status, job_id=None)
+		return stages
+
+	@staticmethod
+	def wait_for_progress(job_id: str, cursor: int = None, timeout: float = PROGRESS.LONG_POLL_TIMEOUT):
+		"""Long-polls the progress of a job.
+
+		Args:
+			job_id (str): The ID of the job
+			cursor (int, optional): The `cursor` of the last progress seen by the caller.
+				Without it, the current progress is returned at once.
+			timeout (float): Maximum time to wait for a change in seconds
+
+		Returns:
+			dict: The progress as `get_progress`, as soon as its cursor differs from `cursor`,
+				the job is finished or failed or the timeout is reached. None if the job does not exist.
+		"""
+		start_time = time.time()
+		while True:
+			progress = PRECLASS_MAIN.get_progress(job_id)
+			if (
+				progress is None
+				or cursor is None
+				or progress["cursor"] != cursor
+				or progress["stage"] == PRECLASS_MAIN.STAGE.FINISHED
+				or progress["failed"]
+				or (time.time() - start_time) >= timeout
+			):
+				return progress
+			time.sleep(STREAM.POLL_INTERVAL)
+
+	@staticmethod
+	def trigger(parent_service: str, source_file: str, previous_lecture_id: str = None, fused: bool = None) -> str:
 		"""Initiates a new pre-class processing job.
 		
 		Args:
 			parent_service (str): Identifier of the parent service initiating this job
 			source_file (str): Path to the source presentation file to be processed
+			previous_lecture_id (str, optional): Lecture of which the file is a revised version.
+				The results of its unchanged slides are reused, see `service.preclass.revision`.
+			fused (bool, optional): Run every stage in a single process instead of through
+				`PIPELINE`. Defaults to `FUSED.ENABLED`.
 			
 		Returns:
 			str: The ID of the created job
 			
 		Notes:
 			Creates a new job in MongoDB and pushes it to RabbitMQ queue for processing.
-			Moves the source file to a buffer location for processing.
+			Moves the source file to a buffer location for processing. If a lecture with a
+			byte-identical source file has finished, its artifacts are cloned instead and
+			the returned job is already finished.
 		"""
 		
 		connection, channel = get_channel(PRECLASS_MAIN._queue_name)
@@ -77,22 +299,61 @@ class PRECLASS_MAIN:
 		filename = os.path.basename(source_file)
 		basename, _ = os.path.splitext(filename)
 
-		lecture_id = create_lecture(source_file_name=basename)
+		lecture_id = create_lecture(
+			source_file_name=basename,
+			previous_lecture_id=ObjectId(previous_lecture_id) if previous_lecture_id else None,
+		)
 
-		buffer_path = f"buffer/{lecture_id}"
-		change_file_path(
+		_, source_sha256 = move_file_with_sha256(
 			source_file,
-			buffer_path,
+			buffer_path(lecture_id),
 			"seed_file"
 		)
+		update_info(lecture_id, source_sha256=source_sha256)
+
+		# A byte-identical deck that was already processed only has its artifacts copied
+		source_lecture_id = find_completed_lecture(source_sha256, PRECLASS_MAIN._collection)
+		if source_lecture_id is not None and source_lecture_id != lecture_id:
+			PRECLASS_MAIN._logger.info(f"Cloning Lecture {source_lecture_id} Into {lecture_id}")
+			clone_lecture(source_lecture_id, lecture_id)
+			job_id = PRECLASS_MAIN._collection.insert_one(
+				dict(
+					parent_service=parent_service,
+					created_time=now(),
+					lecture_id=lecture_id,
+					cloned_from=source_lecture_id,
+					stage=PRECLASS_MAIN.STAGE.FINISHED,
+					stages={
+						name: dict(
+							status=PRECLASS_MAIN.STATUS.DONE,
+							job_id=None,
+						)
+						for name in PRECLASS_MAIN.PIPELINE
+					},
+					value=dict(),
+					completion_time=now(),
+				)
+			).inserted_id
+			connection.close()
+			return job_id
 		
+		if fused is None:
+			fused = FUSED.ENABLED
 		PRECLASS_MAIN._logger.info("Pushing job to MONGO")
 		job_id = PRECLASS_MAIN._collection.insert_one(
 			dict(
 				parent_service=parent_service,
 				created_time = now(),
 				lecture_id=lecture_id,
+				fused=fused,
 				stage=PRECLASS_MAIN.STAGE.START,
+				stages={
+					name: dict(
+						status=PRECLASS_MAIN.STATUS.PENDING,
+						job_id=None,
+					)
+					for name in (PRECLASS_MAIN.FUSED_PIPELINE if fused else PRECLASS_MAIN.PIPELINE)
+				},
 				value=dict(),
 			)
 		).inserted_id
@@ -101,21 +362,88 @@ class PRECLASS_MAIN:
 		channel.basic_publish(
 			exchange="",
 			routing_key=PRECLASS_MAIN._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
 		PRECLASS_MAIN._logger.info("Job pushed to RabbitMQ")
 		return job_id
 
+	@staticmethod
+	def get_node(name) -> dict:
+		"""The node of a stage in `PIPELINE` or `FUSED_PIPELINE`."""
+		return PRECLASS_MAIN.PIPELINE.get(name) or PRECLASS_MAIN.FUSED_PIPELINE[name]
+
+	@staticmethod
+	def ready_stages(stages) -> list:
+		"""Lists the pending stages whose `after` stages are all done and whose `streams` stages have all started and not failed.
+		
+		Args:
+			stages (dict): The `stages` field of a job, mapping stage names to their state
+			
+		Returns:
+			list: Names of the stages that can be triggered now
+		"""
+		return [
+			name for name, state in stages.items()
+			if state["status"] == PRECLASS_MAIN.STATUS.PENDING
+			and all(stages[dep]["status"] == PRECLASS_MAIN.STATUS.DONE for dep in PRECLASS_MAIN.get_node(name)["after"])
+			and all(
+				stages[dep]["status"] in (PRECLASS_MAIN.STATUS.RUNNING, PRECLASS_MAIN.STATUS.DONE)
+				for dep in PRECLASS_MAIN.get_node(name).get("streams", [])
+			)
+		]
+
+	@staticmethod
+	def _sub_job(name, sub_job_id) -> dict:
+		"""The `completion_time`, `dead_lettered` and `failure_reason` of the sub job of a stage, as far as they are set."""
+		return get_services()[PRECLASS_MAIN.get_node(name)["service"]]._collection.find_one(
+			dict(_id=sub_job_id),
+			dict(completion_time=1, dead_lettered=1, failure_reason=1)
+		) or dict()
+
+	@staticmethod
+	def _trigger_stage(job_id, lecture_id, name):
+		"""Claims a pending stage of a job and triggers its sub job.
+		
+		The stage is first moved from pending to running with a conditional update, so
+		that a stage is triggered once even if several notifications race for it.
+		
+		Args:
+			job_id (ObjectId): ID of the main job
+			lecture_id (ObjectId): ID of the lecture being processed
+			name (str): Name of the stage in `PIPELINE`
+		"""
+		claimed = PRECLASS_MAIN._collection.update_one(
+			{"_id": job_id, f"stages.{name}.status": PRECLASS_MAIN.STATUS.PENDING},
+			{"$set": {
+				f"stages.{name}.status": PRECLASS_MAIN.STATUS.RUNNING,
+				f"stages.{name}.start_time": now(),
+			}}
+		).modified_count
+		if not claimed:
+			return
+		service_name = PRECLASS_MAIN.get_node(name)["service"]
+		sub_job_id = get_services()[service_name].trigger(
+			parent_service=PRECLASS_MAIN._queue_name,
+			lecture_id=lecture_id,
+			parent_job_id=job_id,
+			)
+		PRECLASS_MAIN._collection.update_one(
+			dict(_id=job_id),
+			{"$set": {f"stages.{name}.job_id": sub_job_id}}
+		)
+		PRECLASS_MAIN._logger.debug(f"{job_id} Trigger {service_name} Service {sub_job_id}")
+
 	@staticmethod
 	def launch_worker():
 		"""Launches the worker process for handling pre-class processing jobs.
 		
 		
 		Establishes a connection to RabbitMQ and begins consuming messages from the queue.
-		Each message triggers the appropriate stage of processing based on the job's
-		current stage. The worker can be terminated using CTRL+C.
+		Each message marks the stages whose sub job finished as done and triggers every
+		stage of `PIPELINE` unblocked by them. The worker can be terminated using CTRL+C.
 		
 		Raises:
 			KeyboardInterrupt: When the worker is manually stopped
@@ -128,131 +456,93 @@ class PRECLASS_MAIN:
 				queue=PRECLASS_MAIN._queue_name,
 				durable=True
 			)
+			declare_retry_queues(channel, PRECLASS_MAIN._queue_name)
 			
 			def callback(ch, method, properties, body):
 				job_id = ObjectId(body.decode())
 				job = PRECLASS_MAIN._collection.find_one(dict(_id=job_id))
-				lecture_id, stage, value = job["lecture_id"], job["stage"], job["value"]
+				lecture_id, stages = job["lecture_id"], job["stages"]
 				PRECLASS_MAIN._logger.debug(f"Recieved PreClass Main Job - {lecture_id}")
-				if stage==PRECLASS_MAIN.STAGE.START:
-					PRECLASS_MAIN._collection.update_one(
-						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.PPTX2PDF
-						)}
-					)
-					sub_job_id = get_services()["preclass_pptx2pdf"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id,
-						)
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger PPTX2PDF Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				elif stage==PRECLASS_MAIN.STAGE.PPTX2PDF:
-					PRECLASS_MAIN._collection.update_one(
-						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.PDF2PNG
-						)}
-					)
-					
-					sub_job_id = get_services()["preclass_pdf2png"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id,
+
+				# Mark the stages whose sub job has finished as done, or as failed once it was dead-lettered
+				for name, state in stages.items():
+					if state["status"] != PRECLASS_MAIN.STATUS.RUNNING:
+						continue
+					if state["job_id"] is None:
+						# The worker stopped between claiming the stage and triggering it
+						PRECLASS_MAIN._logger.warning(f"{job_id} Re-Triggering Stage {name}")
+						PRECLASS_MAIN._collection.update_one(
+							dict(_id=job_id),
+							{"$set": {f"stages.{name}.status": PRECLASS_MAIN.STATUS.PENDING}}
 						)
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger PDF2PNG Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				elif stage==PRECLASS_MAIN.STAGE.PDF2PNG:
-					PRECLASS_MAIN._collection.update_one(
-						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.PPT2TEXT
-						)}
-					)
-					sub_job_id = get_services()["preclass_ppt2text"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id,
+						state["status"] = PRECLASS_MAIN.STATUS.PENDING
+						continue
+					sub_job = PRECLASS_MAIN._sub_job(name, state["job_id"])
+					if sub_job.get("completion_time"):
+						PRECLASS_MAIN._collection.update_one(
+							dict(_id=job_id),
+							{"$set": {
+								f"stages.{name}.status": PRECLASS_MAIN.STATUS.DONE,
+								f"stages.{name}.completion_time": now(),
+							}}
 						)
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger PPT2TEXT Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				elif stage==PRECLASS_MAIN.STAGE.PPT2TEXT:
-					PRECLASS_MAIN._collection.update_one(
-						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.GEN_DESCRIPTION
-						)}
-					)
-					sub_job_id = get_services()["preclass_gen_description"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id,
+						state["status"] = PRECLASS_MAIN.STATUS.DONE
+					elif sub_job.get("dead_lettered"):
+						# Reported by the `on_dead_letter` callback of the stage worker
+						PRECLASS_MAIN._logger.error(f"{job_id} Stage {name} Failed - {sub_job.get('failure_reason')}")
+						PRECLASS_MAIN._collection.update_one(
+							dict(_id=job_id),
+							{"$set": {
+								f"stages.{name}.status": PRECLASS_MAIN.STATUS.FAILED,
+								f"stages.{name}.failure_reason": sub_job.get("failure_reason"),
+								f"stages.{name}.completion_time": now(),
+								"failed": True,
+								"failure_reason": f"{name}: {sub_job.get('failure_reason')}",
+							}}
 						)
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger GEN_DESCRIPTION Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				elif stage==PRECLASS_MAIN.STAGE.GEN_DESCRIPTION:
-					PRECLASS_MAIN._collection.update_one(
-						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.GEN_STRUCTURE
-						)}
-					)
-					sub_job_id = get_services()["preclass_gen_structure"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id
-						)
-					
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger GEN_STRUCTURE Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				elif stage==PRECLASS_MAIN.STAGE.GEN_STRUCTURE:
+						state["status"] = PRECLASS_MAIN.STATUS.FAILED
+
+				# Trigger every stage unblocked by them, including the streaming stages unblocked
+				# by the stages just triggered. Duplicated notifications unblock nothing.
+				ready_stages = PRECLASS_MAIN.ready_stages(stages)
+				while ready_stages:
+					for name in ready_stages:
+						PRECLASS_MAIN._trigger_stage(job_id, lecture_id, name)
+						stages[name]["status"] = PRECLASS_MAIN.STATUS.RUNNING
+					ready_stages = PRECLASS_MAIN.ready_stages(stages)
+
+				unfinished = [
+					PRECLASS_MAIN.get_node(name)["stage"]
+					for name, state in stages.items()
+					if state["status"] != PRECLASS_MAIN.STATUS.DONE
+				]
+				if unfinished:
 					PRECLASS_MAIN._collection.update_one(
 						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.GEN_SHOWFILE
-						)}
+						{"$set": dict(stage=min(unfinished))}
 					)
-					sub_job_id = get_services()["preclass_gen_showfile"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id
-						)
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger GEN_SHOWFILE Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				elif stage==PRECLASS_MAIN.STAGE.GEN_SHOWFILE:
+				elif job["stage"] != PRECLASS_MAIN.STAGE.FINISHED:
 					PRECLASS_MAIN._collection.update_one(
 						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.GEN_READSCRIPT
+						{"$set": dict(
+							stage=PRECLASS_MAIN.STAGE.FINISHED,
+							completion_time=now(),
 						)}
 					)
-					sub_job_id = get_services()["preclass_gen_readscript"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id
-						)
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger GEN_READSCRIPT Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				elif stage==PRECLASS_MAIN.STAGE.GEN_READSCRIPT:
-					PRECLASS_MAIN._collection.update_one(
-						dict(_id=job_id),
-						{"$set":dict(
-							stage=PRECLASS_MAIN.STAGE.GEN_ASKQUESTION
-						)}
-					)	
-					sub_job_id = get_services()["preclass_gen_askquestion"].trigger(
-						parent_service=PRECLASS_MAIN._queue_name,
-						lecture_id=lecture_id,
-						parent_job_id=job_id
-						)
-					PRECLASS_MAIN._logger.debug(f"{job_id} Trigger GEN_ASKQUESTION Service {sub_job_id}")
-					ch.basic_ack(delivery_tag = method.delivery_tag)
-				else:
-					PRECLASS_MAIN._logger.info(f"Stage: {stage}")
+					PRECLASS_MAIN._logger.info(f"{job_id} PreClass Pipeline Finished For {lecture_id}")
+				ch.basic_ack(delivery_tag = method.delivery_tag)
 			channel.basic_consume(
 				queue=PRECLASS_MAIN._queue_name,
-				on_message_callback=callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						callback,
+						queue_name=PRECLASS_MAIN._queue_name,
+						collection=PRECLASS_MAIN._collection,
+					),
+					queue_name=PRECLASS_MAIN._queue_name,
+					collection=PRECLASS_MAIN._collection,
+					logger=PRECLASS_MAIN._logger,
+				),
 				auto_ack=False,
 			)
 			PRECLASS_MAIN._logger.info('Worker Launched. To exit press CTRL+C')
@@ -145,6 +145,31 @@ class AgendaStruct:
 			)
 
 
+def prefetch_pages(collection, agenda, projection=None) -> dict:
+	"""Fetch the documents of every page of an agenda with a single query.
+
+	The page ids are gathered in one DFS pass and looked up with one `$in` query,
+	instead of one query per page while walking the agenda.
+
+	Args:
+		collection: MongoDB collection keyed by the `_id` in the content of the pages
+		agenda (AgendaStruct): The agenda to walk
+		projection (dict, optional): Fields to fetch
+
+	Returns:
+		dict: Maps the `_id` of every page found to its document
+	"""
+	page_ids = []
+	def collect(node):
+		if node.type=="ppt":
+			page_ids.append(node.content["_id"])
+	agenda.dfs_recursive_call(collect)
+	return {
+		document["_id"]: document
+		for document in collection.find({"_id": {"$in": page_ids}}, projection)
+	}
+
+
 class PPTPageStruct:
 	"""Represents a PowerPoint page/slide in the agenda structure.
 	
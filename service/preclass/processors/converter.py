@@ -0,0 +1,215 @@
+import os
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from config import CONVERTER
+from utils import get_logger
+
+try:
+	# Python bindings shipped with LibreOffice (python3-uno), only needed by the pool
+	import uno
+	from com.sun.star.beans import PropertyValue
+except ImportError:
+	uno = None
+
+logger = get_logger(
+	__name__=__name__,
+	__file__=__file__,
+)
+
+def _properties(**kwargs):
+	properties = []
+	for name, value in kwargs.items():
+		prop = PropertyValue()
+		prop.Name = name
+		prop.Value = value
+		properties.append(prop)
+	return tuple(properties)
+
+class Converter:
+	"""A long-running headless LibreOffice process converting documents to PDF over UNO.
+
+	The process listens on its own port and uses its own user profile, so that several
+	converters can run side by side. A single document is converted at a time.
+
+	Args:
+		port (int): Port of the UNO listener
+	"""
+	def __init__(self, port):
+		self.port = port
+		self.process = None
+		self.desktop = None
+		self.profile = tempfile.mkdtemp(prefix=f"preclass-converter-{port}-")
+
+	def start(self):
+		"""Start the LibreOffice process and connect to it.
+
+		Raises:
+			TimeoutError: If the listener is not reachable within `CONVERTER.STARTUP_TIMEOUT` seconds
+		"""
+		self.process = subprocess.Popen(
+			[
+				CONVERTER.SOFFICE,
+				"--headless", "--invisible", "--nologo", "--norestore", "--nodefault", "--nolockcheck",
+				f"-env:UserInstallation={uno.systemPathToFileUrl(self.profile)}",
+				f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+			],
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL,
+		)
+		local_context = uno.getComponentContext()
+		resolver = local_context.ServiceManager.createInstanceWithContext(
+			"com.sun.star.bridge.UnoUrlResolver", local_context
+		)
+		start_time = time.time()
+		while (time.time() - start_time) < CONVERTER.STARTUP_TIMEOUT:
+			if self.process.poll() is not None:
+				break
+			try:
+				context = resolver.resolve(
+					f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+				)
+				self.desktop = context.ServiceManager.createInstanceWithContext(
+					"com.sun.star.frame.Desktop", context
+				)
+				logger.info(f"Converter Started On Port {self.port}")
+				return
+			except Exception:
+				time.sleep(0.5)
+		self.stop()
+		raise TimeoutError(f"Converter on port {self.port} did not start after {CONVERTER.STARTUP_TIMEOUT} seconds")
+
+	def stop(self):
+		"""Kill the LibreOffice process."""
+		self.desktop = None
+		if self.process and self.process.poll() is None:
+			self.process.kill()
+			self.process.wait()
+		self.process = None
+
+	def restart(self):
+		logger.warning(f"Restarting Converter On Port {self.port}")
+		self.stop()
+		shutil.rmtree(self.profile, ignore_errors=True)
+		self.start()
+
+	def is_healthy(self):
+		"""
+		Returns:
+			bool: Whether the process is alive and answers over UNO
+		"""
+		if self.process is None or self.process.poll() is not None or self.desktop is None:
+			return False
+		try:
+			self.desktop.getComponents()
+			return True
+		except Exception:
+			return False
+
+	def convert(self, input_file, output_file, timeout=CONVERTER.TIMEOUT):
+		"""Convert a document to PDF.
+
+		The PDF is written next to `output_file` first and then moved in place, so that
+		`output_file` is either complete or missing.
+
+		Args:
+			input_file (str): Path of the document
+			output_file (str): Path of the PDF to write
+			timeout (int): Maximum conversion time in seconds. The process is killed
+				when it is exceeded, since a hung conversion cannot be cancelled over UNO.
+
+		Raises:
+			TimeoutError: If the conversion does not finish within the timeout period
+		"""
+		temp_file = f"{output_file}.{self.port}.tmp"
+		error = []
+		def run():
+			try:
+				document = self.desktop.loadComponentFromURL(
+					uno.systemPathToFileUrl(os.path.abspath(input_file)),
+					"_blank",
+					0,
+					_properties(Hidden=True, ReadOnly=True),
+				)
+				try:
+					document.storeToURL(
+						uno.systemPathToFileUrl(os.path.abspath(temp_file)),
+						_properties(FilterName="impress_pdf_Export"),
+					)
+				finally:
+					document.close(True)
+			except Exception as e:
+				error.append(e)
+
+		thread = threading.Thread(target=run, daemon=True)
+		thread.start()
+		try:
+			thread.join(timeout)
+			if thread.is_alive():
+				self.stop()
+				raise TimeoutError(f"Converting {input_file} timed out after {timeout} seconds")
+			if error:
+				raise error[0]
+			os.replace(temp_file, output_file)
+		finally:
+			# Left behind by a failed or timed out conversion
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+
+class ConverterPool:
+	"""A pool of `Converter` processes shared by the threads of a worker.
+
+	Converters are health-checked when they are taken from the pool and restarted when
+	they crashed, hung or failed a conversion.
+
+	Args:
+		size (int): Number of converter processes
+		base_port (int): Port of the first converter, the others use the following ports
+	"""
+	def __init__(self, size=CONVERTER.POOL_SIZE, base_port=CONVERTER.BASE_PORT):
+		self.idle = queue.Queue()
+		try:
+			for i in range(size):
+				converter = Converter(base_port + i)
+				converter.start()
+				self.idle.put(converter)
+		except Exception:
+			# Do not leave the converters that did start running
+			self.close()
+			raise
+
+	@staticmethod
+	def available():
+		"""
+		Returns:
+			bool: Whether the UNO bindings and the LibreOffice executable are installed
+		"""
+		return uno is not None and shutil.which(CONVERTER.SOFFICE) is not None
+
+	def convert(self, input_file, output_file, timeout=CONVERTER.TIMEOUT):
+		"""Convert a document to PDF with the next idle converter.
+
+		Args:
+			input_file (str): Path of the document
+			output_file (str): Path of the PDF to write
+			timeout (int): Maximum conversion time in seconds
+		"""
+		converter = self.idle.get()
+		try:
+			if not converter.is_healthy():
+				converter.restart()
+			try:
+				converter.convert(input_file, output_file, timeout=timeout)
+			except Exception:
+				converter.restart()
+				raise
+		finally:
+			self.idle.put(converter)
+
+	def close(self):
+		while not self.idle.empty():
+			self.idle.get().stop()
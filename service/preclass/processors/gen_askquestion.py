@@ -3,24 +3,29 @@ from bson import ObjectId
 import sys
 import os
 from tqdm import tqdm
-from service.preclass.model import AgendaStruct, ReadScript, AskQuestion
-from service.preclass.processors.qa_utils import parse_qa
-from config import MONGO
-from utils import get_channel, get_logger, now, preclass_context_size as context_size
+from service.preclass.model import AgendaStruct, AskQuestion, FunctionBase
+from service.preclass.processors.qa_utils import parse_qa_reply, QA_RESPONSE_FORMAT
+from config import MONGO, ASKQUESTION
+from service.monitor import instrument
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure, preclass_context_size as context_size
 from service import get_services
+from service.preclass.stream import iter_slides, wait_for_slide, wait_for_stage, publish_slide, finish_stage, dead_letter_handler, use_connection
+from service.preclass.revision import reused_slides
+from data.lecture import publish_agenda
 
 class QAGenerator:
 	"""
 	Generator for creating AskQuestion functions during preclass generation.
 	
-	This class processes an agenda structure and generates multiple-choice questions
-	based on the teaching content (scripts) found within the agenda nodes.
+	This class generates multiple-choice questions based on the teaching content (scripts)
+	of the slides before a question site. The sites are chosen by the callers, see
+	`SERVICE.callback` and `PRECLASS_FUSED.gen_askquestion`.
 	
 	Args:
-		agenda (AgendaStruct): The agenda structure containing teaching content and nodes
+		lecture_id (ObjectId, optional): Lecture the LLM queries are accounted to
 	"""
-	def __init__(self, agenda: AgendaStruct) -> None:
-		self.agenda = agenda
+	def __init__(self, lecture_id: ObjectId = None) -> None:
+		self.lecture_id = lecture_id
 
 	def get_prompt(self, recent_scripts):
 		"""
@@ -101,6 +106,30 @@ class QAGenerator:
 		return prompt    
 
 
+	def qa_query(self, recent_scripts, use_cache=True):
+		"""
+		Builds the LLM query generating the questions for the given scripts.
+		
+		Args:
+			recent_scripts (list[str]): List of recent teaching scripts
+			use_cache (bool, optional): Whether to use cached LLM responses. Defaults to True
+			
+		Returns:
+			dict: Keyword arguments for the `trigger` of the openai service
+		"""
+		content = self.get_prompt(recent_scripts)
+		query = dict(
+			model="gpt-4o-2024-08-06",
+			max_tokens=4096,
+			use_cache=use_cache,
+			lecture_id=self.lecture_id,
+		)
+		if ASKQUESTION.PROTOCOL == "json":
+			content += "\n请按照给定的JSON格式输出以上内容：question为问题描述（不含单选或多选的标注），question_type为single choice或multiple choice，selects为各选项的内容（不含选项字母），answer为正确选项的字母，reference为出题所引用的教学内容文本。"
+			query["response_format"] = QA_RESPONSE_FORMAT
+		query["messages"] = [{"role": "user", "content": content}]
+		return query
+
 	def gen_qa(self, recent_scripts, use_cache=True, timeout=300):
 		"""
 		Generates questions and answers using an LLM based on the provided scripts.
@@ -116,14 +145,9 @@ class QAGenerator:
 		Raises:
 			TimeoutError: If the response is not received within the timeout period
 		"""
-		content = self.get_prompt(recent_scripts)
-		messages = [{"role": "user", "content": content}]
 		openai_job_id = get_services()["openai"].trigger(
 			parent_service=SERVICE._queue_name,
-			model="gpt-4o-2024-08-06",
-			messages=messages,
-			max_tokens=4096,
-			use_cache=use_cache
+			**self.qa_query(recent_scripts, use_cache=use_cache)
 		)
 		
 		response = get_services()["openai"].get_response_sync(openai_job_id)
@@ -132,77 +156,93 @@ class QAGenerator:
 		
 		raise TimeoutError(f"OpenAI response timed out after {timeout} seconds")
 
+	@staticmethod
+	def to_questions(qas):
+		"""
+		Converts parsed questions into AskQuestion functions.
+		
+		Args:
+			qas (list[dict]): Questions parsed by `parse_qa_reply`
+		
+		Returns:
+			list[AskQuestion]: One AskQuestion function per question
+		"""
+		questions = []
+		for qa in qas:
+			question, question_type, selects, answer, reference = qa.values()
+			# create 3 AskQuestion functions per page
+			questions.append(
+				AskQuestion(
+					question,
+					question_type,
+					selects,
+					answer,
+					reference,
+					# recent_scripts
+				)
+			)
+		return questions
 
-	def extract(self):
+	def generate_questions(self, recent_scripts):
 		"""
-		Processes the agenda structure to generate and insert questions at appropriate nodes.
+		Generates the questions asked after the last of the given scripts.
 		
-		Traverses the agenda tree, identifies nodes requiring questions, generates Q&A content
-		using the LLM, and attaches AskQuestion functions to the nodes.
+		Args:
+			recent_scripts (list[str]): List of recent teaching scripts, with the last one
+				being the current content to focus on
 		
 		Returns:
-			AgendaStruct: The modified agenda structure with added question functions
+			list[AskQuestion]: The generated questions, normally 3
 		"""
-		# only keep the last 5 records
-		recent_scripts = []  
+		# generate qa based on recent_scripts
+		raw_reply = self.gen_qa(recent_scripts) 
+		# format qa
+		qas = parse_qa_reply(raw_reply)  
 
-		agenda = self.agenda
+		cnt = 0
+		while len(qas) != 3 and cnt < ASKQUESTION.MAX_RETRIES:
+			raw_reply = self.gen_qa(recent_scripts, use_cache=False)
+			qas = parse_qa_reply(raw_reply)
+			cnt += 1
+
+		return self.to_questions(qas)
+
+	def generate_questions_concurrently(self, sites, fanout=ASKQUESTION.FANOUT):
+		"""
+		Generates the questions of several question sites at the same time.
+
+		All sites are sent with at most `fanout` queries in flight. The sites whose reply
+		does not parse into 3 questions are sent again without cache, together, at most
+		`ASKQUESTION.MAX_RETRIES` times.
 		
-		ppt_num = 0
-		def cnt_ppt_num(node):
-			nonlocal ppt_num
-			if node.type=="ppt":
-				ppt_num+=1
-		agenda.dfs_recursive_call(cnt_ppt_num)
-		bar = tqdm(total=ppt_num, desc="Question Generating")
-
-		for i in range(len(agenda.children)):
-			if agenda.children[i].type=="ppt":
-				continue
-			if len(agenda.children[i].children) >= 3:
-				agenda.children[i].children[-1].function.append(AskQuestion)
-
-		def generate_question(node):
-			nonlocal recent_scripts
-			if node.type=="ppt":
-				function_list = node.function
-				for function in function_list:
-					if function.call == "ReadScript":
-						script = function.value['script']
-						recent_scripts = recent_scripts[-context_size:]
-						recent_scripts.append(script)
-						# assume ReadScript function only appears once in each ppt
-						break
-				
-				if node.function[-1] == AskQuestion:
-					node.function = node.function[:-1]
-					# generate qa based on recent_scripts
-					raw_reply = self.gen_qa(recent_scripts) 
-					# format qa
-					qas = parse_qa(raw_reply)  
+		Args:
+			sites (list[list[str]]): The `recent_scripts` window of every question site
+			fanout (int, optional): Maximum number of LLM queries in flight
 		
-					cnt = 0
-					max_retries = 3
-					while len(qas) != 3 and cnt < max_retries:
-						raw_reply = self.gen_qa(recent_scripts, use_cache=False)
-						qas = parse_qa(raw_reply)
-
-					for qa in qas:
-						question, question_type, selects, answer, reference = qa.values()
-						# create 3 AskQuestion functions per page
-						node.function.append(
-							AskQuestion(
-								question,
-								question_type,
-								selects,
-								answer,
-								reference,
-								# recent_scripts
-							)
-						)
-				bar.update()
-		agenda.dfs_recursive_call(generate_question)
-		return agenda
+		Returns:
+			list[list[AskQuestion]]: The generated questions of every site, in order
+		"""
+		replies = get_services()["openai"].map_sync(
+			[self.qa_query(recent_scripts) for recent_scripts in sites],
+			parent_service=SERVICE._queue_name,
+			fanout=fanout,
+		)
+		qas = [parse_qa_reply(reply) if reply else [] for reply in replies]
+
+		for _ in range(ASKQUESTION.MAX_RETRIES):
+			retry = [i for i in range(len(sites)) if len(qas[i]) != 3]
+			if not retry:
+				break
+			replies = get_services()["openai"].map_sync(
+				[self.qa_query(sites[i], use_cache=False) for i in retry],
+				parent_service=SERVICE._queue_name,
+				fanout=fanout,
+			)
+			for i, reply in zip(retry, replies):
+				if reply:
+					qas[i] = parse_qa_reply(reply)
+
+		return [self.to_questions(site_qas) for site_qas in qas]
 
 class SERVICE:
 	"""
@@ -221,6 +261,16 @@ class SERVICE:
 		MONGO.PORT
 		).preclass.gen_readscript
 
+	_script_collection = MongoClient(
+		MONGO.HOST,
+		MONGO.PORT
+		).preclass.gen_readscript_result
+
+	_result_collection = MongoClient(
+		MONGO.HOST,
+		MONGO.PORT
+		).preclass.gen_askquestion_result
+
 	_agenda_collection = MongoClient(
 		MONGO.HOST,
 		MONGO.PORT
@@ -242,7 +292,8 @@ class SERVICE:
 	def trigger(
 			parent_service: str,
 			lecture_id: ObjectId,
-			parent_job_id: ObjectId
+			parent_job_id: ObjectId,
+			parallel: bool = None
 			) -> str:
 		"""
 		Triggers a new question generation job.
@@ -251,6 +302,8 @@ class SERVICE:
 			parent_service (str): Name of the parent service
 			lecture_id (ObjectId): ID of the lecture being processed
 			parent_job_id (ObjectId): ID of the parent job
+			parallel (bool, optional): Collect every question site first and generate their
+				questions concurrently. Defaults to `ASKQUESTION.PARALLEL`
 			
 		Returns:
 			str: ID of the created job
@@ -264,7 +317,8 @@ class SERVICE:
 				created_time = now(),
 				lecture_id=lecture_id,
 				parent_job_id=parent_job_id,
-				result_askquestion=None
+				result_askquestion=None,
+				parallel=ASKQUESTION.PARALLEL if parallel is None else parallel,
 			)
 		).inserted_id
 
@@ -272,7 +326,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -299,75 +354,240 @@ class SERVICE:
 		parent_job_id = job["parent_job_id"]
 		SERVICE._logger.debug(f"Recieved PreClass GEN_ASKQUESTION Job - {lecture_id}")
 
-		readscript_job = SERVICE._pre_collection.find_one(dict(lecture_id=lecture_id))
-		agenda = AgendaStruct.from_dict(readscript_job["result_readscript"])
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"AskQuestion Generation Already Done For {lecture_id}")
+			# The result is written before the stage event, a delivery may have died in between
+			if job.get("page_count") is not None:
+				finish_stage(lecture_id, "gen_askquestion", total=job["page_count"])
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+
+		if job.get("result_askquestion") is None:
+			# Questions are asked after the last page of every section with at least 3 pages.
+			# Pages are taken in order as soon as gen_readscript has written them, the
+			# section of each page and of the page after it comes from gen_structure.
+			generator = QAGenerator(lecture_id=lecture_id)
+			# Resume after the last slide checkpointed by an earlier delivery, if any
+			checkpoint = job.get("checkpoint") or dict(next_index=0, recent_scripts=[], section_size=0, sites=[])
+			recent_scripts = checkpoint["recent_scripts"]
+			section_size = checkpoint["section_size"]
+			sites = [tuple(site) for site in checkpoint["sites"]]
+			for index, _ in tqdm(iter_slides(lecture_id, "gen_readscript", start=checkpoint["next_index"]), desc="Question Generating"):
+				script = SERVICE._script_collection.find_one(dict(
+					lecture_id=lecture_id,
+					index=index,
+				))["script"]
+				recent_scripts = recent_scripts[-context_size:]
+				recent_scripts.append(script)
+
+				placement = wait_for_slide(lecture_id, "gen_structure", index)
+				next_placement = wait_for_slide(lecture_id, "gen_structure", index + 1)
+				section_size += 1
+				if not (next_placement and next_placement["section"] == placement["section"]):
+					if not placement["top_level"] and section_size >= 3:
+						if (
+							SERVICE._result_collection.find_one(dict(lecture_id=lecture_id, index=index)) is None
+							and not SERVICE.reuse_questions(lecture_id, index, len(recent_scripts))
+						):
+							if job.get("parallel"):
+								# Generated together once every question site is known
+								sites.append((index, list(recent_scripts)))
+							else:
+								SERVICE.save_questions(lecture_id, index, generator.generate_questions(recent_scripts))
+					section_size = 0
+				publish_slide(lecture_id, "gen_askquestion", index)
+				SERVICE.save_checkpoint(job_id, index, recent_scripts, section_size, sites)
+
+			if sites:
+				questions = generator.generate_questions_concurrently([site for _, site in sites])
+				for (index, _), site_questions in zip(sites, questions):
+					SERVICE.save_questions(lecture_id, index, site_questions)
+
+			page_count = wait_for_stage(lecture_id, "gen_readscript")
+			readscript_job = SERVICE._pre_collection.find_one(dict(
+				lecture_id=lecture_id,
+				result_readscript={"$ne": None},
+			))
+			if readscript_job is None:
+				raise LookupError(f"No readscript result found for lecture_id: {lecture_id}")
+			scripts = AgendaStruct.from_dict(readscript_job["result_readscript"])
+
+			results = {
+				result["index"]: result["questions"]
+				for result in SERVICE._result_collection.find(dict(lecture_id=lecture_id), dict(index=1, questions=1))
+			}
+			def attach_questions(node):
+				if node.type=="ppt" and node.content["index"] in results:
+					node.function += [FunctionBase.from_dict(func) for func in results[node.content["index"]]]
+			scripts.dfs_recursive_call(attach_questions)
+
+			SERVICE._collection.update_one(
+				dict(_id=job_id),
+				{"$set": dict(
+					result_askquestion=scripts.to_dict(),
+					page_count=page_count,
+				)}
+			)
+		else:
+			# Questions were generated by an earlier delivery, only the push is left
+			scripts = AgendaStruct.from_dict(job["result_askquestion"])
+			page_count = wait_for_stage(lecture_id, "gen_readscript")
 
-		scripts = QAGenerator(
-			agenda=agenda
-		).extract()
+		SERVICE.push_agenda(lecture_id, scripts)
 
 		SERVICE._collection.update_one(
 			dict(_id=job_id),
 			{"$set": dict(
-				completed_time=now(),
-				result_askquestion=scripts.to_dict()
+				completion_time=now(),
 			)}
 		)
+		# The stage only counts as finished once its agenda is pushed and the job completed
+		finish_stage(lecture_id, "gen_askquestion", total=page_count)
 
-		# push agenda to mongo
-		def push(node, lecture_agenda_parent_id=None, agenda_parent_id=None, index=0):
-			if node.type == "ppt":
-				d = dict(
-					lecture_id=lecture_id,
-					parent_id=agenda_parent_id,
-					index=index,
-					description=node.content["description"],
-					type="ppt",
-					function=[func.to_dict() for func in node.function]
-				)
-				agenda_id = SERVICE._agenda_collection.insert_one(d).inserted_id
+		notify_parent(parent_service, parent_job_id)
+		SERVICE._logger.info(f"AskQuestion Generation Complete For {lecture_id}")
+		ch.basic_ack(delivery_tag = method.delivery_tag)
+			
+		
 
-				d_lecture = d.copy()
-				del d_lecture["_id"]
-				d_lecture["preclass_agenda_id"] = agenda_id
-				d_lecture["parent_id"] = lecture_agenda_parent_id
-				lecture_agenda_id = SERVICE._lecture_agenda_collection.insert_one(d_lecture).inserted_id
+	@staticmethod
+	def push_agenda(lecture_id, scripts):
+		"""
+		Writes the agenda of a lecture to `preclass.agenda` and `lecture.agenda`, then publishes it.
 
+		The ObjectIds of all nodes are allocated up front, so that the tree can be flattened
+		with its parent links and each collection written with a single ordered `insert_many`,
+		parents before their children. Every node carries the `agenda_version` of the push.
+		The new tree is written next to the published one and swapped in with a single update
+		of `lecture.info` once both collections are complete, then the other versions are
+		dropped. Readers select the published version with `data.agenda.published_query`,
+		so they never see a partial tree.
+
+		Args:
+			lecture_id (ObjectId): ID of the lecture
+			scripts (AgendaStruct): The agenda with every function attached
+		"""
+		agenda_version = ObjectId()
+		agenda, lecture_agenda = [], []
+		def flatten(node, agenda_parent_id=None, lecture_agenda_parent_id=None, index=0):
+			agenda_id, lecture_agenda_id = ObjectId(), ObjectId()
+			d = dict(
+				_id=agenda_id,
+				lecture_id=lecture_id,
+				agenda_version=agenda_version,
+				parent_id=agenda_parent_id,
+				index=index,
+				type=node.type,
+				function=[func.to_dict() for func in node.function]
+			)
+			if node.type == "ppt":
+				d["description"] = node.content["description"]
 			else:
-				d = dict(
-					lecture_id=lecture_id,
-					index=index,
-					parent_id=agenda_parent_id,
-					title=node.title,
-					type="node",
-					function=[func.to_dict() for func in node.function]
-				)
-				agenda_id = SERVICE._agenda_collection.insert_one(d).inserted_id
-
-				d_lecture = d.copy()
-				del d_lecture["_id"]
-				d_lecture["preclass_agenda_id"] = agenda_id
-				d_lecture["parent_id"] = lecture_agenda_parent_id
-				lecture_agenda_id = SERVICE._lecture_agenda_collection.insert_one(d_lecture).inserted_id
-
-				index = 0
-				for child in node.children:
-					push(child, lecture_agenda_id, agenda_id, index)
-					index += 1
+				d["title"] = node.title
+			agenda.append(d)
+			lecture_agenda.append(dict(
+				d,
+				_id=lecture_agenda_id,
+				parent_id=lecture_agenda_parent_id,
+				preclass_agenda_id=agenda_id,
+			))
+			if node.type != "ppt":
+				for child_index, child in enumerate(node.children):
+					flatten(child, agenda_id, lecture_agenda_id, child_index)
+		flatten(scripts)
+
+		SERVICE._agenda_collection.insert_many(agenda, ordered=True)
+		SERVICE._lecture_agenda_collection.insert_many(lecture_agenda, ordered=True)
+		publish_agenda(lecture_id, agenda_version)
+		# The previous tree and the nodes of interrupted pushes are no longer read
+		SERVICE._agenda_collection.delete_many(dict(lecture_id=lecture_id, agenda_version={"$ne": agenda_version}))
+		SERVICE._lecture_agenda_collection.delete_many(dict(lecture_id=lecture_id, agenda_version={"$ne": agenda_version}))
+
+	@staticmethod
+	def reuse_questions(lecture_id, index, window):
+		"""
+		Copies the questions asked after a slide in the previous version of the lecture.
+
+		The questions are only reused when every script they were generated from belongs
+		to a slide that is unchanged, see `revision.record_revision`.
+
+		Args:
+			lecture_id (ObjectId): ID of the lecture
+			index (int): Index of the slide the questions are asked after
+			window (int): Number of recent scripts the questions are generated from
+
+		Returns:
+			bool: Whether questions were reused
+		"""
+		previous_lecture_id, reused = reused_slides(lecture_id)
+		if not all(i in reused for i in range(index - window + 1, index + 1)):
+			return False
+		previous = SERVICE._result_collection.find_one(dict(
+			lecture_id=previous_lecture_id,
+			index=reused[index],
+		))
+		if previous is None:
+			return False
+		SERVICE._result_collection.update_one(
+			dict(
+				lecture_id=lecture_id,
+				index=index,
+			),
+			{"$set": dict(
+				questions=previous["questions"],
+				time=now(),
+			)},
+			upsert=True
+		)
+		return True
+
+	@staticmethod
+	def save_checkpoint(job_id, index, recent_scripts, section_size, sites):
+		"""
+		Records how far a job went through the slides, so that a redelivery resumes after `index`.
 		
-		push(scripts)
+		Args:
+			job_id (ObjectId): ID of the job
+			index (int): Index of the last slide handled
+			recent_scripts (list): The scripts of the recent slides
+			section_size (int): Number of slides of the current section handled so far
+			sites (list): The question sites collected so far in parallel mode
+		"""
+		SERVICE._collection.update_one(
+			dict(_id=job_id),
+			{"$set": dict(
+				checkpoint=dict(
+					next_index=index + 1,
+					recent_scripts=recent_scripts,
+					section_size=section_size,
+					sites=[list(site) for site in sites],
+				),
+			)}
+		)
 
-		parent_connection, parent_channel = get_channel(parent_service)
-		parent_channel.basic_publish(
-				exchange="",
-				routing_key=parent_service,
-				body=str(parent_job_id)
-			)
-		parent_connection.close()
-		SERVICE._logger.info(f"AskQuestion Generation Complete For {lecture_id}")
-		ch.basic_ack(delivery_tag = method.delivery_tag)
-			
+	@staticmethod
+	def save_questions(lecture_id, index, questions):
+		"""
+		Stores the questions asked after a slide.
 		
+		Args:
+			lecture_id (ObjectId): ID of the lecture
+			index (int): Index of the slide the questions are asked after
+			questions (list[AskQuestion]): The generated questions
+		"""
+		SERVICE._result_collection.update_one(
+			dict(
+				lecture_id=lecture_id,
+				index=index,
+			),
+			{"$set": dict(
+				questions=[func.to_dict() for func in questions],
+				time=now(),
+			)},
+			upsert=True
+		)
 
 	@staticmethod
 	def launch_worker():
@@ -378,10 +598,23 @@ class SERVICE:
 		"""
 		try:
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
+			# Keeps the heartbeats answered while the callback waits for an upstream stage
+			use_connection(connection)
 			
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						SERVICE.callback,
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+					),
+					queue_name=SERVICE._queue_name,
+					collection=SERVICE._collection,
+					logger=SERVICE._logger,
+					on_dead_letter=dead_letter_handler(SERVICE._collection, "gen_askquestion"),
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
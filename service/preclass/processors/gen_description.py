@@ -1,14 +1,18 @@
 import os
 import sys
 
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 from bson import ObjectId
 
-from utils import get_channel, get_logger, now
-from config import MONGO
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure
+from config import MONGO, DESCRIPTION
+from service.monitor import instrument
 
 from service import get_services
-from data.lecture import find_file_snippet
+from data.lecture import find_file_snippet, find_file_snippets
+from data.blob import read_base64
+from service.preclass.stream import publish_slide, finish_stage, dead_letter_handler
+from service.preclass.revision import reused_slides
 
 prompt_summarize = f"这个GPT的任务是接受一张关于教学场景的PPT页面的图片和该PPT页面中的文本作为输入，然后用中文输出对这页PPT的描述和总结。它将专注于提取和理解PPT页面上的关键信息，并以简洁、准确的方式进行总结，确保总结内容在2-3句话以内。"
 # prompt_summarize = f"The task of this GPT is to accept an image of a PPT slide about a teaching scenario and the text from that PPT slide as input, then output a description and summary of the slide in English. It will focus on extracting and understanding the key information from the slide and provide a concise and accurate summary, ensuring the summary is within 2-3 sentences."
@@ -22,13 +26,14 @@ system_summarize = [
 			}
 		]
 
-def format_script(role: str, message: str, image_url: str = None):
+def format_script(role: str, message: str, image_url: str = None, image_mime_type: str = "image/png"):
 	"""Format a message for GPT conversation with optional image support.
 
 	Args:
 		role (str): The role of the message sender ('system', 'user', or 'assistant')
 		message (str): The text content of the message
 		image_url (str, optional): Base64 encoded image data. Defaults to None.
+		image_mime_type (str, optional): MIME type of the image. Defaults to "image/png".
 
 	Returns:
 		list: A list containing a single dictionary with the formatted message
@@ -55,12 +60,59 @@ def format_script(role: str, message: str, image_url: str = None):
 					),
 				dict(
 					type="image_url",
-					image_url=dict(url=f"data:image/png;base64,{image_url}")
+					image_url=dict(url=f"data:{image_mime_type};base64,{image_url}")
 					)
 			],
 		)
 	]
 
+def append_recent_scripts(recent_scripts, file_snippet, description):
+	"""Append a described slide to the conversation context carried between slides.
+
+	The slide image is dropped from the context and only the last 6 messages are kept.
+
+	Args:
+		recent_scripts (list): Messages carried over from the previous slides
+		file_snippet (dict): The `lecture.file_snippet` document of the described slide
+		description (str): The generated description of the slide
+
+	Returns:
+		list: The updated conversation context
+	"""
+	new_input = format_script(
+		role="user",
+		message=file_snippet["content"],
+		)
+	recent_scripts = recent_scripts + new_input + format_script(
+		role="assistant",
+		message=description)
+	return recent_scripts[-6:]
+
+def format_neighbour_context(file_snippet, neighbours):
+	"""Format the raw text of the slides around a slide as context for its description.
+
+	Used by the parallel mode, where the descriptions of the previous slides are not
+	available yet when a slide is described.
+
+	Args:
+		file_snippet (dict): The `lecture.file_snippet` document of the slide to describe
+		neighbours (list): The `lecture.file_snippet` documents of the neighbouring slides
+
+	Returns:
+		list: The context messages, empty when the slide has no neighbours
+	"""
+	before = [n for n in neighbours if n["idx"] < file_snippet["idx"]]
+	after = [n for n in neighbours if n["idx"] > file_snippet["idx"]]
+	if not before and not after:
+		return []
+	message = ""
+	if before:
+		message += "前几页PPT的文本：\n" + "\n".join(f"第{n['idx']+1}页：{n['content']}" for n in before) + "\n"
+	if after:
+		message += "后几页PPT的文本：\n" + "\n".join(f"第{n['idx']+1}页：{n['content']}" for n in after) + "\n"
+	message += "以上内容仅作为上下文参考，请只描述和总结接下来给出的这一页PPT。"
+	return format_script(role="user", message=message)
+
 class SERVICE:
 	"""Service class for generating descriptions of lecture slides using GPT-4 Vision.
 	
@@ -89,7 +141,8 @@ class SERVICE:
 	def trigger(
 			parent_service: str,
 			lecture_id: ObjectId,
-			parent_job_id: ObjectId
+			parent_job_id: ObjectId,
+			parallel: bool = None
 			) -> str:
 		"""Trigger a new description generation job.
 
@@ -97,6 +150,8 @@ class SERVICE:
 			parent_service (str): Name of the parent service that triggered this job
 			lecture_id (ObjectId): MongoDB ID of the lecture to process
 			parent_job_id (ObjectId): MongoDB ID of the parent job
+			parallel (bool, optional): Describe the slides concurrently, each with the raw text
+				of its neighbouring slides as context. Defaults to `DESCRIPTION.PARALLEL`
 
 		Returns:
 			str: The ID of the newly created job
@@ -113,6 +168,8 @@ class SERVICE:
 				progress=-1,
 				recent_scripts=[],
 				openai_job_id=None,
+				parallel=DESCRIPTION.PARALLEL if parallel is None else parallel,
+				pending=[],
 			)
 		).inserted_id
 
@@ -120,7 +177,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -153,52 +211,64 @@ class SERVICE:
 		parent_job_id = job["parent_job_id"]
 		SERVICE._logger.info(f"Recieved PreClass GEN_DESCRIPTION Job - {lecture_id}, Progress: {progress}")
 
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"Description Already Done For {lecture_id}")
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+
+		if progress == -1:
+			SERVICE.reuse_descriptions(lecture_id)
+
+		if job.get("parallel"):
+			SERVICE.describe_parallel(job)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+
 		# Recieved LLM generated content and add to db
 		if progress!=-1:
+			openai_job = get_services()["openai"].collection.find_one(dict(_id=openai_job_id))
+			if openai_job is None:
+				raise LookupError(f"OpenAI Job {openai_job_id} Not Found")
+			if "completion_time" not in openai_job:
+				# The slide in progress is still being described, this delivery is a duplicate
+				SERVICE._logger.info(f"Skipping Duplicate Delivery For {lecture_id}, Progress: {progress}")
+				ch.basic_ack(delivery_tag = method.delivery_tag)
+				return
+			summarization = openai_job["response"]
+
 			current_file_snippet = find_file_snippet(query=dict(lecture_id=lecture_id,idx=progress))
-			new_input = format_script(
-				role="user",
-				message=current_file_snippet["content"],
-				image_url=current_file_snippet.get("png_base64", None),
-				)
-			
-			summarization = get_services()["openai"].get_response(openai_job_id)
-			new_input[0]["content"] = new_input[0]["content"][:1]
-			recent_scripts += new_input
-			recent_scripts = recent_scripts + format_script(
-				role="assistant",
-				message=summarization)
-			recent_scripts = recent_scripts[-6:]
-			script_info = dict(
-				lecture_id=lecture_id,
-				index=current_file_snippet["idx"],
-				description=summarization,
-				source_content=dict(
-					text=current_file_snippet["content"],
-					pic=current_file_snippet.get("png_base64",None),
-					source_file=[
-						{
-							"file_id": current_file_snippet["_id"],
-							"file_type": "png",
-							"index": current_file_snippet["idx"],
-						}
-					],
-				),
-			)
-			SERVICE._result_collection.insert_one(script_info)
+			recent_scripts = append_recent_scripts(recent_scripts, current_file_snippet, summarization)
+			SERVICE.save_description(lecture_id, current_file_snippet, summarization)
 		
 		progress += 1
 		new_file_snippet = find_file_snippet(query=dict(lecture_id=lecture_id,idx=progress))
+		# Skip over slides that an earlier run already described instead of paying for them again
+		while new_file_snippet:
+			described = SERVICE._result_collection.find_one(
+				dict(lecture_id=lecture_id, index=progress),
+				dict(description=1)
+			)
+			if described is None:
+				break
+			recent_scripts = append_recent_scripts(recent_scripts, new_file_snippet, described["description"])
+			publish_slide(lecture_id, "gen_description", progress)
+			progress += 1
+			new_file_snippet = find_file_snippet(query=dict(lecture_id=lecture_id,idx=progress))
+
 		if new_file_snippet:
 			new_input = format_script(
 				role="user",
 				message=new_file_snippet["content"],
-				image_url=new_file_snippet.get("png_base64", None),
+				image_url=read_base64(new_file_snippet.get("image_sha256")),
+				image_mime_type=new_file_snippet.get("image_mime_type", "image/png"),
 				)
 			messages = system_summarize + recent_scripts + new_input
 			openai_job_id = get_services()["openai"].trigger(
 				parent_service=SERVICE._queue_name,
 				parent_job_id=job_id,
+				lecture_id=lecture_id,
 				model="gpt-4o-2024-08-06",
 				messages=messages,
 				max_tokens=4096,
@@ -214,18 +284,184 @@ class SERVICE:
 			)
 			ch.basic_ack(delivery_tag = method.delivery_tag)
 		else:
-			parent_connection, parent_channel = get_channel(parent_service)
-			parent_channel.basic_publish(
-				exchange="",
-				routing_key=parent_service,
-				body=str(parent_job_id)
+			finish_stage(lecture_id, "gen_description", total=progress)
+			SERVICE._collection.update_one(
+				dict(_id=job_id),
+				{"$set": dict(
+					progress=progress,
+					completion_time=now(),
+				)}
 			)
-			parent_connection.close()
+			notify_parent(parent_service, parent_job_id)
 			SERVICE._logger.info(f"Conversion Complete For {lecture_id}")
 			ch.basic_ack(delivery_tag = method.delivery_tag)
 			
 		
 
+	@staticmethod
+	def save_description(lecture_id, file_snippet, description):
+		"""Store the description of a slide and announce it to the streaming stages.
+
+		Args:
+			lecture_id (ObjectId): MongoDB ID of the lecture
+			file_snippet (dict): The `lecture.file_snippet` document of the described slide
+			description (str): The generated description of the slide
+		"""
+		script_info = dict(
+			lecture_id=lecture_id,
+			index=file_snippet["idx"],
+			description=description,
+			source_content=dict(
+				text=file_snippet["content"],
+				pic_sha256=file_snippet.get("image_sha256"),
+				pic_mime_type=file_snippet.get("image_mime_type", "image/png"),
+				source_file=[
+					{
+						"file_id": file_snippet["_id"],
+						"file_type": "png",
+						"index": file_snippet["idx"],
+					}
+				],
+			),
+		)
+		# (lecture_id, index) identifies a description, so a redelivery overwrites instead of duplicating
+		SERVICE._result_collection.update_one(
+			dict(lecture_id=lecture_id, index=script_info["index"]),
+			{"$set": script_info},
+			upsert=True
+		)
+		publish_slide(lecture_id, "gen_description", script_info["index"])
+
+	@staticmethod
+	def reuse_descriptions(lecture_id):
+		"""Copy the descriptions of the slides unchanged since the previous version of the lecture.
+
+		Both modes skip the slides that are already described, so only the changed slides
+		and their neighbours (see `revision.record_revision`) are sent to the LLM.
+
+		Args:
+			lecture_id (ObjectId): MongoDB ID of the lecture
+		"""
+		previous_lecture_id, reused = reused_slides(lecture_id)
+		for index, previous_index in reused.items():
+			previous = SERVICE._result_collection.find_one(
+				dict(lecture_id=previous_lecture_id, index=previous_index),
+				dict(description=1)
+			)
+			if previous is None:
+				continue
+			file_snippet = find_file_snippet(query=dict(lecture_id=lecture_id,idx=index))
+			SERVICE.save_description(lecture_id, file_snippet, previous["description"])
+		if reused:
+			SERVICE._logger.info(f"Reused {len(reused)} Descriptions Of {previous_lecture_id} For {lecture_id}")
+
+	@staticmethod
+	def describe_parallel(job):
+		"""Advance a job in parallel mode.
+
+		Up to `DESCRIPTION.FANOUT` slides are described at the same time. Every delivery
+		(the trigger, then one notification per finished LLM query) stores the descriptions
+		that finished, then sends the next slides to the LLM until the fan-out is used up.
+		The LLM queries that are in flight are tracked in the `pending` list of the job.
+
+		Each slide gets the raw text of the `DESCRIPTION.CONTEXT_WINDOW` slides on either
+		side of it as context, instead of the descriptions of the previous slides.
+
+		Args:
+			job (dict): The `preclass.gen_description` job document
+		"""
+		job_id = job["_id"]
+		lecture_id = job["lecture_id"]
+
+		for pending in job["pending"]:
+			openai_job = get_services()["openai"].collection.find_one(dict(_id=pending["openai_job_id"]))
+			if openai_job is None:
+				raise LookupError(f"OpenAI Job {pending['openai_job_id']} Not Found")
+			if "completion_time" not in openai_job:
+				continue
+			file_snippet = find_file_snippet(query=dict(lecture_id=lecture_id,idx=pending["index"]))
+			SERVICE.save_description(lecture_id, file_snippet, openai_job["response"])
+			SERVICE._collection.update_one(
+				dict(_id=job_id),
+				{"$pull": dict(pending=dict(index=pending["index"]))}
+			)
+		job = SERVICE._collection.find_one(dict(_id=job_id))
+
+		progress = job["progress"]
+		while len(job["pending"]) < DESCRIPTION.FANOUT:
+			file_snippet = find_file_snippet(query=dict(lecture_id=lecture_id,idx=progress+1))
+			if file_snippet is None:
+				break
+			index = file_snippet["idx"]
+			described = SERVICE._result_collection.find_one(
+				dict(lecture_id=lecture_id, index=index),
+				dict(_id=1)
+			)
+			openai_job_id = None
+			if described:
+				# Described by an earlier run, only the event has to be published again
+				publish_slide(lecture_id, "gen_description", index)
+			else:
+				neighbours = find_file_snippets(
+					query=dict(
+						lecture_id=lecture_id,
+						idx={
+							"$gte": index - DESCRIPTION.CONTEXT_WINDOW,
+							"$lte": index + DESCRIPTION.CONTEXT_WINDOW,
+							"$ne": index,
+						},
+					),
+					projection=dict(idx=1, content=1),
+					sort=[("idx", 1)],
+				)
+				new_input = format_script(
+					role="user",
+					message=file_snippet["content"],
+					image_url=read_base64(file_snippet.get("image_sha256")),
+					image_mime_type=file_snippet.get("image_mime_type", "image/png"),
+					)
+				messages = system_summarize + format_neighbour_context(file_snippet, neighbours) + new_input
+				openai_job_id = get_services()["openai"].trigger(
+					parent_service=SERVICE._queue_name,
+					parent_job_id=job_id,
+					lecture_id=lecture_id,
+					model="gpt-4o-2024-08-06",
+					messages=messages,
+					max_tokens=4096,
+					use_cache=True
+					)
+			update = {"$set": dict(progress=index)}
+			if openai_job_id:
+				update["$push"] = dict(pending=dict(index=index, openai_job_id=openai_job_id))
+			# Only advance from the progress this delivery started from, so that two
+			# deliveries handled at the same time never both take the same slide
+			claimed = SERVICE._collection.find_one_and_update(
+				dict(_id=job_id, progress=progress),
+				update,
+				return_document=ReturnDocument.AFTER,
+			)
+			if claimed is None:
+				SERVICE._logger.info(f"Slide {index} Of {lecture_id} Was Taken By Another Delivery")
+				job = SERVICE._collection.find_one(dict(_id=job_id))
+			else:
+				job = claimed
+			progress = job["progress"]
+
+		if job["pending"] or find_file_snippet(query=dict(lecture_id=lecture_id,idx=progress+1)):
+			return
+
+		total = progress + 1
+		finish_stage(lecture_id, "gen_description", total=total)
+		SERVICE._collection.update_one(
+			dict(_id=job_id),
+			{"$set": dict(
+				progress=total,
+				completion_time=now(),
+			)}
+		)
+		notify_parent(job["parent_service"], job["parent_job_id"])
+		SERVICE._logger.info(f"Conversion Complete For {lecture_id}")
+
 	@staticmethod
 	def launch_worker():
 		"""Launch the RabbitMQ worker to process description generation jobs.
@@ -235,10 +471,21 @@ class SERVICE:
 		"""
 		try:
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
 			
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						SERVICE.callback,
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+					),
+					queue_name=SERVICE._queue_name,
+					collection=SERVICE._collection,
+					logger=SERVICE._logger,
+					on_dead_letter=dead_letter_handler(SERVICE._collection, "gen_description"),
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
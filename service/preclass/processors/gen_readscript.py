@@ -1,12 +1,17 @@
 import sys
 import os
-from config import MONGO
+import json
+from config import MONGO, READSCRIPT
+from service.monitor import instrument
 from pymongo import MongoClient
 from bson import ObjectId
 from tqdm import tqdm
-from service.preclass.model import AgendaStruct, ReadScript
-from utils import get_channel, get_logger, now, preclass_context_size as context_size
+from service.preclass.model import AgendaStruct, ReadScript, prefetch_pages
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure, preclass_context_size as context_size
 from service import get_services
+from data.blob import read_base64
+from service.preclass.stream import iter_slides, wait_for_stage, publish_slide, finish_stage, dead_letter_handler, use_connection
+from service.preclass.revision import reused_slides
 
 class PPTScriptGenerator:
 	"""
@@ -19,12 +24,15 @@ class PPTScriptGenerator:
 
 	Attributes:
 		agenda (AgendaStruct): The agenda structure containing PPT slides and content
+		lecture_id (ObjectId): Lecture the LLM queries are accounted to
 		prompt_script (str): System prompt for the LLM to generate teaching scripts
 		system (list): System message configuration for LLM interactions
 	"""
 
-	def __init__(self, agenda: AgendaStruct) -> None:
+	def __init__(self, agenda: AgendaStruct = None, lecture_id: ObjectId = None) -> None:
 		self.agenda = agenda
+		self.lecture_id = lecture_id
+		self.recent_scripts = []
 
 		self.prompt_script = "This agent speaks Chinese. Lecture Script Writer's primary function is to analyze PowerPoint (PPT) slides based on user inputs and the texts extracted from those slides. It then generates a script for teachers to teach students about the content illustrated on the page, assuming the role of the teacher who also made the slides. The script is intended for the teacher to read out loud, directly engaging with the audience without referring to itself as an external entity. It focuses on educational content, suitable for classroom settings or self-study. It emphasizes clarity, accuracy, and engagement in explanations, avoiding overly technical jargon unless necessary. The agent is not allowed to ask the user any questions even if the provided information is insufficient or unclear, ensuring the responses have to be a script. The script for each slide is limited to no more than two sentences, leaving most of the details to be discussed when interacting with the student's questions. The scripts for each slide has to be consistant to the previouse slide and it is important to make sure the agent's generated return can be directly joined as a fluent and continued script without any further adjustment. The agent should also never assume what is one the next slide before processing it. It adopts a friendly and supportive tone, encouraging learning and curiosity."
 
@@ -37,61 +45,203 @@ class PPTScriptGenerator:
 			}
 		]
 
+		self.smoothing_format = dict(
+			type="json_schema",
+			json_schema=dict(
+				name="smoothed_scripts",
+				strict=True,
+				schema=dict(
+					type="object",
+					properties=dict(
+						scripts=dict(type="array", items=dict(type="string")),
+					),
+					required=["scripts"],
+					additionalProperties=False,
+				),
+			),
+		)
 
-	def extract(self):
+	def generate_script(self, source_content, script=None):
 		"""
-		Processes the agenda structure and generates scripts for all PPT slides.
+		Generates the teaching script of the next slide, continuing from the slides before it.
 
-		Traverses through the agenda using DFS, generates teaching scripts for each PPT slide
-		while maintaining conversation context between consecutive slides.
+		Args:
+			source_content (dict): Source content of the slide with its `text` and optional `pic_sha256`
+			script (str, optional): A script generated earlier for this slide. It is only
+				added to the conversation context instead of being generated again.
 
 		Returns:
-			AgendaStruct: The processed agenda with generated scripts attached to PPT nodes
+			str: The teaching script of the slide
 		"""
-		recent_scripts = []
+		text = source_content["text"]
+		png = read_base64(source_content.get("pic_sha256"))
+		formatted_input = self.format_script(
+			role="user",
+			message=text,
+			image_url=png,
+			image_mime_type=source_content.get("pic_mime_type", "image/png"),
+			)
+		if script is None:
+			script = self.iterate_call_script(
+				self.recent_scripts,
+				formatted_input
+				)
+		formatted_input[0]["content"] = formatted_input[0]["content"][:1]
+		self.recent_scripts += formatted_input
+		self.recent_scripts += self.format_script(
+			role="assistant",
+			message=script,
+			)
+		self.recent_scripts = self.recent_scripts[-2*context_size:]
+		return script
 
-		agenda = self.agenda
+	def extract_parallel(self, fanout=READSCRIPT.FANOUT, existing=None):
+		"""
+		Generates the scripts of all PPT slides in two parallel passes.
 
-		ppt_num = 0
-		def cnt_ppt_num(node):
-			nonlocal ppt_num
-			if node.type=="ppt":
-				ppt_num+=1
-		agenda.dfs_recursive_call(cnt_ppt_num)
-		bar = tqdm(total=ppt_num, desc="Script Generating")
-		
-		def generate_script(node):
-			nonlocal recent_scripts
+		1. Every slide is drafted independently from its content and the outline of its
+		   section, with up to `fanout` drafts in flight.
+		2. Batches of `READSCRIPT.SMOOTH_BATCH` consecutive drafts are rewritten by a
+		   cheaper text-only model so that each script continues from the previous one.
+		   A batch whose reply does not match its drafts keeps the drafts.
+
+		Args:
+			fanout (int, optional): Maximum number of LLM queries in flight
+			existing (dict, optional): Scripts generated earlier, by slide index. These
+				slides are neither drafted nor smoothed again.
+
+		Returns:
+			dict: The script of every slide by slide index
+		"""
+		existing = existing or dict()
+
+		pages = []
+		def collect(node, sections):
 			if node.type=="ppt":
-				source_content = SERVICE._script_collection.find_one(dict(
-					_id=node.content["_id"]
-				))["source_content"]
-				text = source_content["text"]
-				png = source_content.get("pic",None)
-				formatted_input = self.format_script(
+				pages.append((node, sections))
+			else:
+				for child in node.children:
+					collect(child, sections + [node])
+		collect(self.agenda, [])
+		descriptions = prefetch_pages(SERVICE._script_collection, self.agenda, projection=dict(source_content=1))
+
+		queries = []
+		draft_pages = []
+		for node, sections in pages:
+			if node.content["index"] in existing:
+				continue
+			source_content = descriptions[node.content["_id"]]["source_content"]
+			messages = (
+				self.system
+				+ self.format_script(role="user", message=self.format_outline(node, sections))
+				+ self.format_script(
 					role="user",
-					message=text,
-					image_url=png,
-					)
-				script = self.iterate_call_script(
-					recent_scripts,
-					formatted_input
-					)
-				formatted_input[0]["content"] = formatted_input[0]["content"][:1]
-				recent_scripts += formatted_input
-				recent_scripts += self.format_script(
-					role="assistant",
-					message=script,
+					message=source_content["text"],
+					image_url=read_base64(source_content.get("pic_sha256")),
+					image_mime_type=source_content.get("pic_mime_type", "image/png"),
 					)
-				recent_scripts = recent_scripts[-2*context_size:]
-				node.function.append(
-					ReadScript(
-						script=script
-					)
-				)
-				bar.update()
-		agenda.dfs_recursive_call(generate_script)
-		return agenda
+			)
+			queries.append(dict(
+				model="gpt-4o-2024-08-06",
+				messages=messages,
+				max_tokens=4096,
+				use_cache=True,
+				lecture_id=self.lecture_id,
+			))
+			draft_pages.append(node)
+
+		drafts = get_services()["openai"].map_sync(
+			queries,
+			parent_service=SERVICE._queue_name,
+			fanout=fanout,
+		)
+		scripts = dict(existing)
+		for node, draft in zip(draft_pages, drafts):
+			if draft is None:
+				raise TimeoutError(f"Drafting the script of slide {node.content['index']} timed out")
+			scripts[node.content["index"]] = draft
+
+		# Smooth the transitions of the drafts, each batch also sees the script before it
+		order = [node.content["index"] for node, _ in pages]
+		drafted = [i for i in order if i not in existing]
+		batches = [drafted[i:i+READSCRIPT.SMOOTH_BATCH] for i in range(0, len(drafted), READSCRIPT.SMOOTH_BATCH)]
+		queries = []
+		for batch in batches:
+			position = order.index(batch[0])
+			previous = scripts[order[position-1]] if position else None
+			queries.append(dict(
+				model=READSCRIPT.SMOOTH_MODEL,
+				messages=self.format_smoothing(previous, [scripts[i] for i in batch]),
+				max_tokens=4096,
+				use_cache=True,
+				lecture_id=self.lecture_id,
+				response_format=self.smoothing_format,
+			))
+		smoothed = get_services()["openai"].map_sync(
+			queries,
+			parent_service=SERVICE._queue_name,
+			fanout=fanout,
+		)
+		for batch, reply in zip(batches, smoothed):
+			try:
+				batch_scripts = json.loads(reply)["scripts"]
+			except (TypeError, ValueError, KeyError):
+				continue
+			if len(batch_scripts) != len(batch) or not all(isinstance(script, str) and script for script in batch_scripts):
+				continue
+			for index, script in zip(batch, batch_scripts):
+				scripts[index] = script
+		return scripts
+
+	def format_outline(self, node, sections):
+		"""
+		Describes the place of a slide in the lecture outline, as context for drafting its script.
+
+		Args:
+			node (PPTPageStruct): The slide
+			sections (list): The sections containing the slide, from the root section down
+
+		Returns:
+			str: The outline context of the slide
+		"""
+		path = " > ".join(section.title for section in sections)
+		siblings = "\n".join(
+			("-> " if child is node else "- ") + child.formalize().lstrip("- ")
+			for child in sections[-1].children
+		) if sections else ""
+		return (
+			f"The next slide is in the section \"{path}\" of the lecture. "
+			f"The slides of this section are listed below, the next slide is marked with \"->\". "
+			f"Write the script of the next slide only, as part of this section.\n{siblings}"
+		)
+
+	def format_smoothing(self, previous, drafts):
+		"""
+		Builds the messages asking to smooth the transitions between consecutive drafts.
+
+		Args:
+			previous (str): The script before the first draft, None for the first slide
+			drafts (list[str]): Consecutive scripts drafted independently
+
+		Returns:
+			list: Messages for the smoothing query
+		"""
+		prompt = (
+			"The following teaching scripts belong to consecutive slides of a lecture. They were written "
+			"independently, so the transitions between them are not fluent and they may repeat greetings "
+			"or introductions. Rewrite them so that each script continues fluently from the one before it "
+			"and all of them can be read out one after another. Only adjust the openings, the transitions "
+			"and repeated content. Keep the language, the content and the length of every script. Return "
+			f"exactly {len(drafts)} scripts in the same order."
+		)
+		content = ""
+		if previous:
+			content += f"Script of the previous slide (do not return it):\n{previous}\n\n"
+		content += "\n\n".join(f"Script {i+1}:\n{draft}" for i, draft in enumerate(drafts))
+		return (
+			self.format_script(role="system", message=prompt)
+			+ self.format_script(role="user", message=content)
+		)
 
 	def iterate_call_script(self, agent_messages, new_messages, timeout=300):
 		"""
@@ -115,7 +265,8 @@ class PPTScriptGenerator:
 			model="gpt-4o-2024-08-06",
 			messages=messages,
 			max_tokens=4096,
-			use_cache=True
+			use_cache=True,
+			lecture_id=self.lecture_id,
 		)
 
 		response = get_services()["openai"].get_response_sync(openai_job_id)
@@ -124,7 +275,7 @@ class PPTScriptGenerator:
 
 		raise TimeoutError(f"OpenAI response timed out after {timeout} seconds")
 
-	def format_script(self, role: str, message: str, image_url: str = None):
+	def format_script(self, role: str, message: str, image_url: str = None, image_mime_type: str = "image/png"):
 		"""
 		Formats messages for LLM input in the required structure.
 
@@ -132,6 +283,7 @@ class PPTScriptGenerator:
 			role (str): Role of the message sender ('user' or 'assistant')
 			message (str): The text content of the message
 			image_url (str, optional): Base64 encoded image URL if present
+			image_mime_type (str, optional): MIME type of the image
 
 		Returns:
 			list: Formatted message structure for LLM input
@@ -158,7 +310,7 @@ class PPTScriptGenerator:
 						),
 					dict(
 						type="image_url",
-						image_url=dict(url=f"data:image/png;base64,{image_url}")
+						image_url=dict(url=f"data:{image_mime_type};base64,{image_url}")
 						)
 				],
 			)
@@ -211,7 +363,8 @@ class SERVICE:
 	def trigger(
 			parent_service: str,
 			lecture_id: ObjectId,
-			parent_job_id: ObjectId
+			parent_job_id: ObjectId,
+			parallel: bool = None
 			) -> str:
 		"""
 		Triggers a new script generation job.
@@ -220,6 +373,9 @@ class SERVICE:
 			parent_service (str): Name of the parent service
 			lecture_id (ObjectId): ID of the lecture to process
 			parent_job_id (ObjectId): ID of the parent job
+			parallel (bool, optional): Generate the scripts in two parallel passes once the
+				whole agenda is available, see `PPTScriptGenerator.extract_parallel`.
+				Defaults to `READSCRIPT.PARALLEL`
 
 		Returns:
 			str: Generated job ID
@@ -233,7 +389,8 @@ class SERVICE:
 				created_time = now(),
 				lecture_id=lecture_id,
 				parent_job_id=parent_job_id,
-				result_readscript=None
+				result_readscript=None,
+				parallel=READSCRIPT.PARALLEL if parallel is None else parallel,
 			)
 		).inserted_id
 
@@ -241,7 +398,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -272,31 +430,186 @@ class SERVICE:
 		parent_service = job["parent_service"]
 		parent_job_id = job["parent_job_id"]
 		SERVICE._logger.debug(f"Recieved PreClass GEN_DESCRIPTION Job - {lecture_id}")
-		showfile_job = SERVICE._pre_collection.find_one(dict(lecture_id=lecture_id))
-		scripts = PPTScriptGenerator(
-		agenda=AgendaStruct.from_dict(showfile_job["result_showfile"])
-		).extract()
+
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"ReadScript Generation Already Done For {lecture_id}")
+			# The result is written before the stage event, a delivery may have died in between
+			if job.get("page_count") is not None:
+				finish_stage(lecture_id, "gen_readscript", total=job["page_count"])
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+
+		SERVICE.reuse_scripts(lecture_id)
+
+		if job.get("parallel"):
+			SERVICE.generate_parallel(lecture_id)
+		else:
+			# Write the scripts in page order as soon as gen_structure has placed each page,
+			# the slides before it are all placed by then and the agenda order is the page order.
+			generator = PPTScriptGenerator(lecture_id=lecture_id)
+			# Resume after the last slide checkpointed by an earlier delivery, if any
+			checkpoint = job.get("checkpoint") or dict(next_index=0, recent_scripts=[])
+			generator.recent_scripts = checkpoint["recent_scripts"]
+			existing = {
+				result["index"]: result["script"]
+				for result in SERVICE._result_collection.find(dict(lecture_id=lecture_id), dict(index=1, script=1))
+			}
+			descriptions = dict()
+			for index, _ in tqdm(iter_slides(lecture_id, "gen_structure", start=checkpoint["next_index"]), desc="Script Generating"):
+				if index not in descriptions:
+					# gen_description is usually ahead, so every description written so far from
+					# this slide on is fetched at once instead of one query per slide
+					descriptions.update(
+						(description["index"], description["source_content"])
+						for description in SERVICE._script_collection.find(
+							dict(lecture_id=lecture_id, index={"$gte": index}),
+							dict(index=1, source_content=1)
+						)
+					)
+				source_content = descriptions.pop(index)
+				if index in existing:
+					generator.generate_script(source_content, script=existing[index])
+				else:
+					SERVICE._result_collection.update_one(
+						dict(
+							lecture_id=lecture_id,
+							index=index,
+						),
+						{"$set": dict(
+							script=generator.generate_script(source_content),
+							time=now(),
+						)},
+						upsert=True
+					)
+				publish_slide(lecture_id, "gen_readscript", index)
+				SERVICE._collection.update_one(
+					dict(_id=job_id),
+					{"$set": dict(
+						checkpoint=dict(
+							next_index=index + 1,
+							recent_scripts=generator.recent_scripts,
+						),
+					)}
+				)
+
+		# The agenda with the files attached is only available once gen_showfile is done
+		wait_for_stage(lecture_id, "gen_showfile")
+		showfile_job = SERVICE._pre_collection.find_one(dict(
+			lecture_id=lecture_id,
+			result_showfile={"$ne": None},
+		))
+		if showfile_job is None:
+			raise LookupError(f"No showfile result found for lecture_id: {lecture_id}")
+		scripts = AgendaStruct.from_dict(showfile_job["result_showfile"])
+
+		page_count = 0
+		results = {
+			result["index"]: result["script"]
+			for result in SERVICE._result_collection.find(dict(lecture_id=lecture_id), dict(index=1, script=1))
+		}
+		def attach_script(node):
+			nonlocal page_count
+			if node.type=="ppt":
+				node.function.append(
+					ReadScript(
+						script=results[node.content["index"]]
+					)
+				)
+				page_count+=1
+		scripts.dfs_recursive_call(attach_script)
 	
 		SERVICE._collection.update_one(
 			dict(_id=job_id),
 			{"$set":dict(
-				completed_time=now(),
-				result_readscript=scripts.to_dict()
+				completion_time=now(),
+				result_readscript=scripts.to_dict(),
+				page_count=page_count,
 			)}
 		)
+		# Consumers read the result as soon as the stage is finished, so it is published last
+		finish_stage(lecture_id, "gen_readscript", total=page_count)
 
-		parent_connection, parent_channel = get_channel(parent_service)
-		parent_channel.basic_publish(
-			exchange="",
-			routing_key=parent_service,
-			body=str(parent_job_id)
-		)
-		parent_connection.close()
+		notify_parent(parent_service, parent_job_id)
 		SERVICE._logger.info(f"ReadScript Generation Complete For {lecture_id}")
 		ch.basic_ack(delivery_tag = method.delivery_tag)
 			
 		
 
+	@staticmethod
+	def reuse_scripts(lecture_id):
+		"""
+		Copies the scripts of the slides unchanged since the previous version of the lecture.
+
+		Both modes keep the scripts that are already written, so only the changed slides
+		and their neighbours (see `revision.record_revision`) are sent to the LLM.
+
+		Args:
+			lecture_id (ObjectId): ID of the lecture to process
+		"""
+		previous_lecture_id, reused = reused_slides(lecture_id)
+		for index, previous_index in reused.items():
+			previous = SERVICE._result_collection.find_one(dict(
+				lecture_id=previous_lecture_id,
+				index=previous_index,
+			))
+			if previous is None:
+				continue
+			SERVICE._result_collection.update_one(
+				dict(
+					lecture_id=lecture_id,
+					index=index,
+				),
+				{"$setOnInsert": dict(
+					script=previous["script"],
+					time=now(),
+				)},
+				upsert=True
+			)
+
+	@staticmethod
+	def generate_parallel(lecture_id):
+		"""
+		Generates the scripts of a lecture with `PPTScriptGenerator.extract_parallel`.
+
+		Unlike the default mode, the drafts need the outline of every section, so this
+		waits for the whole agenda instead of streaming the slides placed by gen_structure.
+
+		Args:
+			lecture_id (ObjectId): ID of the lecture to process
+		"""
+		wait_for_stage(lecture_id, "gen_showfile")
+		showfile_job = SERVICE._pre_collection.find_one(dict(
+			lecture_id=lecture_id,
+			result_showfile={"$ne": None},
+		))
+		if showfile_job is None:
+			raise LookupError(f"No showfile result found for lecture_id: {lecture_id}")
+		existing = {
+			result["index"]: result["script"]
+			for result in SERVICE._result_collection.find(dict(lecture_id=lecture_id))
+		}
+		scripts = PPTScriptGenerator(
+			agenda=AgendaStruct.from_dict(showfile_job["result_showfile"]),
+			lecture_id=lecture_id,
+		).extract_parallel(existing=existing)
+
+		for index in sorted(scripts):
+			if index not in existing:
+				SERVICE._result_collection.update_one(
+					dict(
+						lecture_id=lecture_id,
+						index=index,
+					),
+					{"$set": dict(
+						script=scripts[index],
+						time=now(),
+					)},
+					upsert=True
+				)
+			publish_slide(lecture_id, "gen_readscript", index)
+
 	@staticmethod
 	def launch_worker():
 		"""
@@ -307,10 +620,23 @@ class SERVICE:
 		"""
 		try:
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
+			# Keeps the heartbeats answered while the callback waits for an upstream stage
+			use_connection(connection)
 			
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						SERVICE.callback,
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+					),
+					queue_name=SERVICE._queue_name,
+					collection=SERVICE._collection,
+					logger=SERVICE._logger,
+					on_dead_letter=dead_letter_handler(SERVICE._collection, "gen_readscript"),
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
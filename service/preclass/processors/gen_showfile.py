@@ -1,10 +1,12 @@
 import sys
 import os
 from bson import ObjectId
-from service.preclass.model import AgendaStruct, ShowFile
+from service.preclass.model import AgendaStruct, ShowFile, prefetch_pages
 from pymongo import MongoClient
-from utils import get_channel, get_logger, now
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure
 from config import MONGO
+from service.monitor import instrument
+from service.preclass.stream import finish_stage, dead_letter_handler
 
 class SourceFileBinder:
 	"""
@@ -23,17 +25,20 @@ class SourceFileBinder:
 		Returns:
 			AgendaStruct: The processed agenda with bound source files
 		"""
+		agenda = self.agenda
+		descriptions = prefetch_pages(
+			SERVICE._script_collection,
+			agenda,
+			projection={"source_content.source_file": 1},
+		)
 		def bind_source_source(node):
 			if node.type=="ppt":
-				source_content = SERVICE._script_collection.find_one(dict(
-					_id=node.content["_id"]
-				))["source_content"]
+				source_content = descriptions[node.content["_id"]]["source_content"]
 				node.function.append(
 					ShowFile(
 						file_id=source_content["source_file"][0]["index"]
 					)
 				)
-		agenda = self.agenda
 		agenda.dfs_recursive_call(bind_source_source)
 		return agenda
 
@@ -99,7 +104,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -124,27 +130,44 @@ class SERVICE:
 		parent_service = job["parent_service"]
 		parent_job_id = job["parent_job_id"]
 		SERVICE._logger.debug(f"Recieved PreClass GEN_SHOWFILE Job - {lecture_id}")
-		pre_job = SERVICE._pre_collection.find_one(dict(lecture_id=lecture_id))
+
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"ShowFile Generation Already Done For {lecture_id}")
+			# The result is written before the stage event, a delivery may have died in between
+			if job.get("page_count") is not None:
+				finish_stage(lecture_id, "gen_showfile", total=job["page_count"])
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+		pre_job = SERVICE._pre_collection.find_one(dict(
+			lecture_id=lecture_id,
+			result_structure={"$ne": None},
+		))
 		agenda = AgendaStruct.from_dict(pre_job["result_structure"])
 
 		scripts = SourceFileBinder(
 			agenda=agenda
 		).extract()
 
+		page_count = 0
+		def cnt_ppt_num(node):
+			nonlocal page_count
+			if node.type=="ppt":
+				page_count+=1
+		scripts.dfs_recursive_call(cnt_ppt_num)
+
 		SERVICE._collection.update_one(
 				dict(_id=job_id),
 				{"$set": dict(
 					result_showfile=scripts.to_dict(),
-					completion_time=now()
+					completion_time=now(),
+					page_count=page_count,
 				)}
 			)
-		parent_connection, parent_channel = get_channel(parent_service)
-		parent_channel.basic_publish(
-			exchange="",
-			routing_key=parent_service,
-			body=str(parent_job_id)
-		)
-		parent_connection.close()
+		# Consumers read the result as soon as the stage is finished, so it is published last
+		finish_stage(lecture_id, "gen_showfile", total=page_count)
+		notify_parent(parent_service, parent_job_id)
 		SERVICE._logger.info(f"ShowFile Generation Complete For {lecture_id}")
 		ch.basic_ack(delivery_tag = method.delivery_tag)
 		
@@ -158,10 +181,21 @@ class SERVICE:
 		"""
 		try:
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
 			
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						SERVICE.callback,
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+					),
+					queue_name=SERVICE._queue_name,
+					collection=SERVICE._collection,
+					logger=SERVICE._logger,
+					on_dead_letter=dead_letter_handler(SERVICE._collection, "gen_showfile"),
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
@@ -1,16 +1,20 @@
 from service.preclass.model import AgendaStruct, PPTPageStruct
 import os
 import sys
+import re
+import json
 
 from pymongo import MongoClient
 from bson import ObjectId
 
-from utils import get_channel, get_logger, now, preclass_context_size as context_size
-from config import MONGO
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure, preclass_context_size as context_size
+from config import MONGO, STRUCTURE
+from service.monitor import instrument
 
 from service import get_services
 from tqdm import tqdm
 from data.lecture import find_info
+from service.preclass.stream import iter_slides, publish_slide, finish_stage, dead_letter_handler, use_connection
 
 class Structurelizor:
 	"""A class that generates hierarchical structure from PowerPoint presentation scripts.
@@ -22,18 +26,36 @@ class Structurelizor:
 	Attributes:
 		input_scripts: List of PowerPoint page scripts to process
 		root_title: Title of the root agenda/section
+		on_page_placed: Callback invoked after each page is inserted into the structure
+		chunk_size: Number of pages placed by a single LLM call
+		lecture_id: Lecture the LLM queries are accounted to
 		prompt: System prompt for the LLM to generate structured outlines
 	"""
 
-	def __init__(self, root_agenda_title, input_scripts):
+	def __init__(self, root_agenda_title, input_scripts, on_page_placed=None, chunk_size=STRUCTURE.CHUNK_SIZE, structure=None, lecture_id=None):
 		"""Initialize the Structurelizor.
 
 		Args:
 			root_agenda_title (str): Title for the root section of the structure
-			input_scripts (list): List of PowerPoint page scripts to process
+			input_scripts (iterable): PowerPoint page scripts to process, in page order.
+				May be a generator that yields pages as they become available; a page is
+				placed once the `context_size` pages after it are available.
+			on_page_placed (callable, optional): Called as `on_page_placed(page, structure)`
+				after `page` is inserted into the partial `structure`
+			chunk_size (int, optional): Number of pages placed by a single LLM call. Pages
+				whose placement in the returned outline is invalid are placed one at a time.
+				Set to 1 to place every page with its own call.
+			structure (AgendaStruct, optional): A partial structure to resume from, e.g. a
+				checkpoint saved from `on_page_placed`. `input_scripts` then starts with the
+				first page that is not placed in it.
+			lecture_id (ObjectId, optional): Lecture the LLM queries are accounted to
 		"""
 		self.input_scripts = input_scripts
+		self.structure = structure
+		self.lecture_id = lecture_id
 		self.root_title = root_agenda_title
+		self.on_page_placed = on_page_placed
+		self.chunk_size = chunk_size
 		self.prompt = """
 This GPT focus solely on creating and organizing index outlines for documents or presentations. This involves structuring content accurately and concisely, using "-" to denote all elements, including different sections and sub-sections, while strictly adhering to the input content without making inferences or alterations. The primary role here is to organize outlines by introducing sections and subsections based on their thematic significance and hierarchical order. It's crucial that only the updated outline is outputted, with no additional words or explanations, ensuring users receive a clean, precise outline that directly reflects the content's organization and thematic division, facilitating straightforward navigation.
 During each interaction with the user, this GPT is only allowed to do two things: append the given pages to the existing subsections or create a new subsection that goes under an existing section/subsection and append into it. When the pages shows different focus(e.g. when a page is the cover and some other pages are introduction of a course, they should go under different subsections).
@@ -41,23 +63,57 @@ When creating a new subsection, it should make sure that there are more than one
 It is not allowed to abandon any pages. It is only allowed to add subsections and add tabs(`    `) to the user's given pages as an indication of a page is under a section. This means this GPT has to copy the exact words within user's given outline and concatenate new contents after it. It is not allow to do and replacement or short alias.
 In the resulting outline, the pages still have to be ordered by their page number(labled as P[number]). The Page number for each page should also be included in the output as `- P[number]: [title of powerpoint page]`.
 """.strip()
+		self.protocol = STRUCTURE.PROTOCOL
+		if self.protocol == "json":
+			self.prompt += """
+Instead of outputting the updated outline, reply with the placement of every current page in JSON. `page` is the page number and `path` lists the titles of the sections the page goes under, from the first section below the root section down to the section that the page is appended to. Copy the exact titles of existing sections; a title that does not exist yet creates a new subsection under the previous title in the path. Never put the root section or a page in the path.
+"""
+		self.response_format = dict(
+			type="json_schema",
+			json_schema=dict(
+				name="outline_placement",
+				strict=True,
+				schema=dict(
+					type="object",
+					properties=dict(
+						placements=dict(
+							type="array",
+							items=dict(
+								type="object",
+								properties=dict(
+									page=dict(type="integer"),
+									path=dict(type="array", items=dict(type="string")),
+								),
+								required=["page", "path"],
+								additionalProperties=False,
+							),
+						),
+					),
+					required=["placements"],
+					additionalProperties=False,
+				),
+			),
+		)
 		self.system = [
 			{
 				"role": "system",
 				"content": [
-					{"type": "text", "text": self.prompt},
+					{"type": "text", "text": self.prompt.strip()},
 				],
 			}
 		]
 
 	def format_prompt(self, history, current_page, future_page):
 		line = "\n"
+		if isinstance(current_page, list):
+			current = "Current Pages:\n" + line.join([str(page) for page in current_page])
+		else:
+			current = "Current Page:\n" + str(current_page)
 		prompt = f"""
 Current Outline:
 {history}
 
-Current Page:
-{str(current_page)}
+{current}
 
 Future Pages:
 {line.join([str(page) for page in future_page])}
@@ -80,6 +136,113 @@ Future Pages:
 				return trace
 		return None
 	
+	def parse_json_traces(self, prediction, current_pages):
+		"""Read the traces of the current pages from a JSON placement reply.
+
+		Args:
+			prediction (str): Reply following `self.response_format`
+			current_pages (list): The pages whose placement was asked
+
+		Returns:
+			list: The trace of each page, None for the pages missing from the reply
+		"""
+		try:
+			placements = json.loads(prediction)["placements"]
+			paths = {placement["page"]: placement["path"] for placement in placements}
+		except (ValueError, KeyError, TypeError):
+			return [None] * len(current_pages)
+		traces = []
+		for page in current_pages:
+			path = paths.get(page.content["index"])
+			if not isinstance(path, list):
+				traces.append(None)
+				continue
+			traces.append([self.root_title] + [str(title) for title in path] + [str(page)])
+		return traces
+
+	def repair_trace(self, trace):
+		"""Fix the near misses of a trace locally instead of asking again.
+
+		- Titles are stripped of the leading `- ` and surrounding whitespace
+		- A dropped root section is added back, a repeated one is removed
+		- Pages are removed from the sections leading to the page (a wrong indent
+		  puts a page under the previous page), since a page cannot be the children of another page
+
+		Args:
+			trace (list): Section titles from the root section down to the page, None if not found
+
+		Returns:
+			list: The repaired trace, None if the page was not found or has no section left to repair
+		"""
+		if not trace:
+			return None
+		page = trace[-1]
+		sections = [title.strip().lstrip("-").strip() for title in trace[:-1]]
+		while sections and sections[0] == self.root_title:
+			sections = sections[1:]
+		sections = [title for title in sections if title and not re.match(r"P\d+\s*:", title)]
+		return [self.root_title] + sections + [page]
+
+	def fallback_trace(self, structure, page):
+		"""Deterministic trace that appends a page to the last open section of the structure.
+
+		Args:
+			structure (AgendaStruct): The partial structure
+			page (PPTPageStruct): The page to place
+
+		Returns:
+			list: Trace to insert `page` with `AgendaStruct.insert_page`
+		"""
+		trace = [structure.title]
+		node = structure
+		while node.children and node.children[-1].type == "node":
+			node = node.children[-1]
+			trace.append(node.title)
+		return trace + [str(page)]
+
+	def request_traces(self, history, current_pages, future_page, use_cache=True):
+		"""Ask for the placement of the current pages and return their repaired traces.
+
+		With `STRUCTURE.PROTOCOL` set to `json` the reply follows `self.response_format`,
+		otherwise it is the updated outline as free text, cut at the first future page.
+
+		Args:
+			history (str): Trace of the partial structure
+			current_pages (list): The pages to place
+			future_page (list): The pages following them, as lookahead
+			use_cache (bool): Whether a cached reply can be used
+
+		Returns:
+			list: The trace of each page, None for the pages whose trace cannot be found
+		"""
+		prompt = self.format_prompt(
+			history=history,
+			current_page=current_pages if len(current_pages) > 1 else current_pages[0],
+			future_page=future_page
+		)
+		if self.protocol == "json":
+			prediction = self.call_generation(
+				prompt,
+				use_cache=use_cache,
+				response_format=self.response_format
+				)
+			traces = self.parse_json_traces(prediction, current_pages)
+		else:
+			if future_page:
+				prediction = self.call_generation(
+					prompt,
+					use_cache=use_cache,
+					stop=str(future_page[0]).split(":")[0]+":"
+					)
+			else:
+				prediction = self.call_generation(
+					prompt,
+					use_cache=use_cache
+					)
+			parsed = [self.parse_tab(line) for line in prediction.split("\n")]
+			traces = [self.find_trace(parsed, target_page=str(page)) for page in current_pages]
+		return [self.repair_trace(trace) for trace in traces]
+
 	def call_generation(self, content, return_formatter=lambda x: x, use_cache=True, timeout=300, **kwargs):
 		"""
 		Call OpenAI generation with waiting capability.
@@ -99,6 +262,7 @@ Future Pages:
 			messages=messages,
 			max_tokens=4096,
 			use_cache=use_cache,
+			lecture_id=self.lecture_id,
 			**kwargs
 		)
 		response = get_services()["openai"].get_response_sync(openai_job_id, timeout=timeout)
@@ -120,24 +284,29 @@ Future Pages:
 		Returns:
 			AgendaStruct: Hierarchical structure of the presentation content
 		"""
-		scripts = self.input_scripts
+		scripts = iter(self.input_scripts)
 
 		stringified_scripts = []
-		for script in scripts:
-			stringified_scripts.append(
-				PPTPageStruct(
-					page = dict(
-						_id=script["_id"],
-						index=script["index"],
-						description=script["description"],
-					),
-					stringified = self.script2string(script)
+		def fill_pages(count):
+			# Pull pages from the input until `count` are buffered or the input is exhausted
+			while len(stringified_scripts) < count:
+				script = next(scripts, None)
+				if script is None:
+					return
+				stringified_scripts.append(
+					PPTPageStruct(
+						page = dict(
+							_id=script["_id"],
+							index=script["index"],
+							description=script["description"],
+						),
+						stringified = self.script2string(script)
+					)
 				)
-			)
 
-		structurelized = AgendaStruct(title=self.root_title)
+		structurelized = self.structure or AgendaStruct(title=self.root_title)
 
-		bar = tqdm(total=len(stringified_scripts))
+		bar = tqdm(total=len(self.input_scripts) if hasattr(self.input_scripts, "__len__") else None)
 
 		def pop_page():
 			page = stringified_scripts.pop(0)
@@ -146,51 +315,55 @@ Future Pages:
 		def structure_page():
 			history = structurelized.get_structure_trace()
 			current_page, future_page = pop_page()
-			trace = None
-			prompt = self.format_prompt(
+			for attempt in range(STRUCTURE.MAX_RETRIES + 1):
+				if attempt:
+					SERVICE._logger.warning(f"Retrying Placement Of Page {current_page.content['index']} Of {self.lecture_id}, Attempt {attempt + 1}")
+				trace = self.request_traces(
+					history=history,
+					current_pages=[current_page],
+					future_page=future_page,
+					use_cache=attempt==0,
+				)[0]
+				if trace and structurelized.insert_page(current_page, trace):
+					break
+			else:
+				# Keep the page in the current section rather than paying for more retries
+				SERVICE._logger.warning(f"Falling Back To The Current Section For Page {current_page.content['index']} Of {self.lecture_id}")
+				structurelized.insert_page(current_page, self.fallback_trace(structurelized, current_page))
+			if self.on_page_placed:
+				self.on_page_placed(current_page, structurelized)
+
+		def structure_chunk():
+			# Place the next `chunk_size` pages with a single call. A page whose trace is
+			# missing or invalid is placed on its own, the pages after it keep their traces
+			history = structurelized.get_structure_trace()
+			current_pages = stringified_scripts[:self.chunk_size]
+			future_page = stringified_scripts[self.chunk_size:self.chunk_size+context_size]
+			traces = self.request_traces(
 				history=history,
-				current_page=current_page,
-				future_page=future_page
+				current_pages=current_pages,
+				future_page=future_page,
 			)
-			use_cache=True
-			while not trace:
-				if use_cache==False:
-					print("Retrying")
-				if future_page:
-					prediction = self.call_generation(
-						prompt,
-						use_cache=use_cache,
-						stop=str(future_page[0]).split(":")[0]+":"
-						)
-					if str(current_page) not in prediction:
-						use_cache=False
-						continue
-				else:
-					prediction = self.call_generation(
-						prompt,
-						use_cache=use_cache
-						)
-				parsed = [self.parse_tab(line) for line in prediction.split("\n")]
-
-				trace = self.find_trace(parsed, target_page=str(current_page))
-				if trace[0].strip() != self.root_title:
-					tail = "\nThe new sections have to go under a subsection within the root section of " + self.root_title
-					if not prompt.endswith(tail):
-						prompt = prompt + tail
-						trace = None
-						continue
-					else:
-						trace = [self.root_title] + trace
-				if structurelized.insert_page(current_page, trace):
-					break
+
+			for k, current_page in enumerate(current_pages):
+				trace = traces[k] if k < len(traces) else None
+				if trace and structurelized.insert_page(current_page, trace):
+					stringified_scripts.pop(0)
+					if self.on_page_placed:
+						self.on_page_placed(current_page, structurelized)
 				else:
-					use_cache=False
-					trace=None
-					continue
+					structure_page()
+			return len(current_pages)
 
+		fill_pages(self.chunk_size + context_size)
 		while stringified_scripts:
-			structure_page()
-			bar.update(1)
+			if self.chunk_size > 1 and len(stringified_scripts) > 1:
+				placed = structure_chunk()
+			else:
+				structure_page()
+				placed = 1
+			bar.update(placed)
+			fill_pages(self.chunk_size + context_size)
 		
 		return structurelized
 
@@ -256,7 +429,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -281,22 +455,73 @@ class SERVICE:
 		parent_job_id = job["parent_job_id"]
 		SERVICE._logger.debug(f"Recieved PreClass GEN_STRUCTURE Job - {lecture_id}")
 
-		# get results of gen_description
-		pre_results = list(SERVICE._pre_result_collection.find({"lecture_id": lecture_id}))
-		
-		if not pre_results:
-			SERVICE._logger.warning(f"No pre-results found for lecture_id: {lecture_id}")
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"Structure Generation Already Done For {lecture_id}")
+			# The result is written before the stage event, a delivery may have died in between
+			if job.get("page_count") is not None:
+				finish_stage(lecture_id, "gen_structure", total=job["page_count"])
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
 			return
+
+		# Resume from the structure checkpointed by an earlier delivery, if any
+		checkpoint = job.get("checkpoint")
+		if checkpoint:
+			SERVICE._logger.info(f"Resuming Structure Generation For {lecture_id} From Page {checkpoint['next_index']}")
+
+		# Stream the results of gen_description in page order while it is still running
+		def iter_pre_results():
+			start = checkpoint["next_index"] if checkpoint else 0
+			for index, _ in iter_slides(lecture_id, "gen_description", start=start):
+				pre_result = SERVICE._pre_result_collection.find_one(dict(lecture_id=lecture_id, index=index))
+				if pre_result is None:
+					raise LookupError(f"No pre-result found for lecture_id: {lecture_id}, index: {index}")
+				yield pre_result
+
+		def publish_placement(page, structure):
+			# Sub-sections are flattened into the top-level sections at the end,
+			# so the top-level section is what downstream stages need to know.
+			publish_slide(
+				lecture_id,
+				"gen_structure",
+				page.content["index"],
+				section=len(structure.children) - 1,
+				top_level=structure.children[-1] is page,
+			)
+			# A redelivery places the pages after this one only
+			SERVICE._collection.update_one(
+				dict(_id=job_id),
+				{"$set": dict(
+					checkpoint=dict(
+						structure=structure.to_dict(),
+						next_index=page.content["index"] + 1,
+					),
+				)}
+			)
 		
 		basename = find_info(dict(_id=lecture_id))["lecture_name"]
 
 		structurelized = Structurelizor(
 			root_agenda_title=basename,
-			input_scripts=pre_results,
+			input_scripts=iter_pre_results(),
+			on_page_placed=publish_placement,
+			structure=AgendaStruct.from_dict(checkpoint["structure"]) if checkpoint else None,
+			lecture_id=lecture_id,
 			).extract()
 	
+		if not structurelized.children:
+			raise LookupError(f"No pre-results found for lecture_id: {lecture_id}")
+
 		for i in range(len(structurelized.children)):
 			structurelized.children[i].flatten()
+
+		page_count = 0
+		def cnt_ppt_num(node):
+			nonlocal page_count
+			if node.type=="ppt":
+				page_count+=1
+		structurelized.dfs_recursive_call(cnt_ppt_num)
 		
 		SERVICE._collection.update_one(
 			dict(_id=job_id),
@@ -304,16 +529,13 @@ class SERVICE:
 				completion_time=now(),
 				result_structure=structurelized.to_dict(),
 				raw_text=structurelized.serialize(),
+				page_count=page_count,
 			)}
 		)
+		# Consumers read the result as soon as the stage is finished, so it is published last
+		finish_stage(lecture_id, "gen_structure", total=page_count)
 
-		parent_connection, parent_channel = get_channel(parent_service)
-		parent_channel.basic_publish(
-			exchange="",
-			routing_key=parent_service,
-			body=str(parent_job_id)
-		)
-		parent_connection.close()
+		notify_parent(parent_service, parent_job_id)
 		SERVICE._logger.info(f"Structure Generation Complete For {lecture_id}")
 		ch.basic_ack(delivery_tag = method.delivery_tag)
 	
@@ -322,10 +544,23 @@ class SERVICE:
 	def launch_worker():
 		try:
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
+			# Keeps the heartbeats answered while the callback waits for an upstream stage
+			use_connection(connection)
 			
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						SERVICE.callback,
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+					),
+					queue_name=SERVICE._queue_name,
+					collection=SERVICE._collection,
+					logger=SERVICE._logger,
+					on_dead_letter=dead_letter_handler(SERVICE._collection, "gen_structure"),
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
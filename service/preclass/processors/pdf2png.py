@@ -1,40 +1,313 @@
 import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from pymongo import MongoClient
 from bson import ObjectId
 
-from utils import get_channel, get_logger, now
-from config import MONGO
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure, buffer_path, find_seed_file
+from config import MONGO, RENDER, RENDITION
+from service.monitor import instrument
+from data.lecture import upsert_file_snippets
+from data.blob import blob_store
+from service.preclass.processors.ppt2text import extract_slides
+from service.preclass.revision import text_fingerprint, record_revision
+from service.preclass.stream import dead_letter_handler
 
 import fitz  # PyMuPDF
 
-def convert_pdf_to_png(input_file, output_dir):
+# MIME type and file extension of every supported output format
+IMAGE_FORMATS = dict(
+	png=("image/png", "png"),
+	jpeg=("image/jpeg", "jpg"),
+	webp=("image/webp", "webp"),
+)
+
+def write_atomic(path, data):
+	"""
+	Write a file through a temporary file in the same directory, so that `path` is either complete or missing.
+
+	The temporary file has a unique name, so concurrent writers of the same path (e.g. two
+	threads rendering the same slide) never share it.
+
+	Args:
+		path (str): Path of the file to write
+		data (bytes): Content of the file
+	"""
+	fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		os.replace(temp_path, path)
+	except BaseException:
+		os.remove(temp_path)
+		raise
+
+def render_page_range(input_file, output_dir, page_range, dpi, colorspace, alpha, image_format, quality):
+	"""
+	Render a range of pages of a PDF file with its own document handle.
+
+	Args:
+		input_file (str): Path to the input PDF file
+		output_dir (str): Directory where the images will be saved
+		page_range (list): Indexes of the pages to render
+		dpi (int): Resolution of the images
+		colorspace (str): `RGB`, `GRAY` or `CMYK`
+		alpha (bool): Whether to keep an alpha channel (not supported by JPEG)
+		image_format (str): A key of `IMAGE_FORMATS`
+		quality (int): Quality of the lossy formats, from 1 to 100
 	"""
-	Convert a PDF file to a series of PNG images, one for each page.
+	_, extension = IMAGE_FORMATS[image_format]
+	doc = fitz.open(input_file)
+	for page_num in page_range:
+		page = doc.load_page(page_num)  # Load the current page
+		pix = page.get_pixmap(  # Render page to an image
+			dpi=dpi,
+			colorspace=getattr(fitz, f"cs{colorspace}"),
+			alpha=alpha and image_format != "jpeg",
+		)
+		if image_format == "webp":
+			data = pix.pil_tobytes(format="WEBP", quality=quality)  # Needs Pillow
+		elif image_format == "jpeg":
+			data = pix.tobytes("jpeg", jpg_quality=quality)
+		else:
+			data = pix.tobytes("png")
+		write_atomic(os.path.join(output_dir, f'{page_num + 1}.{extension}'), data)
+	doc.close()
+
+def convert_pdf_to_png(
+		input_file,
+		output_dir,
+		dpi=RENDER.DPI,
+		colorspace=RENDER.COLORSPACE,
+		alpha=RENDER.ALPHA,
+		image_format=RENDER.FORMAT,
+		quality=RENDER.QUALITY,
+		workers=RENDER.WORKERS,
+		pages=None,
+		):
+	"""
+	Convert a PDF file to a series of images, one for each page.
+
+	The pages are split into contiguous ranges rendered by a pool of `workers` processes.
 
 	Args:
 		input_file (str): Path to the input PDF file
-		output_dir (str): Directory where the PNG images will be saved
+		output_dir (str): Directory where the images will be saved, as `{page number}.{extension}`
+		dpi (int, optional): Resolution of the images
+		colorspace (str, optional): `RGB`, `GRAY` or `CMYK`
+		alpha (bool, optional): Whether to keep an alpha channel
+		image_format (str, optional): `png`, `jpeg` or `webp`
+		quality (int, optional): Quality of the lossy formats, from 1 to 100
+		workers (int, optional): Number of rendering processes
+		pages (list, optional): Indexes of the pages to render, defaults to every page
 
 	Returns:
-		None
+		int: Number of pages of the PDF file
 	"""
 	# Ensure the output directory exists
 	if not os.path.exists(output_dir):
 		os.makedirs(output_dir)
 
-	# Open the PDF file
 	doc = fitz.open(input_file)
+	page_count = len(doc)
+	doc.close()
 
-	# Iterate through each page of the PDF
-	for page_num in range(len(doc)):
-		page = doc.load_page(page_num)  # Load the current page
-		pix = page.get_pixmap()  # Render page to an image
-		output_path = os.path.join(output_dir, f'{page_num + 1}.png')  # Define output path for the image
-		pix.save(output_path)  # Save the image
+	page_nums = list(range(page_count)) if pages is None else pages
+	chunk_size = max(1, -(-len(page_nums) // max(1, workers)))
+	page_ranges = [page_nums[start:start + chunk_size] for start in range(0, len(page_nums), chunk_size)]
+	options = dict(
+		dpi=dpi,
+		colorspace=colorspace,
+		alpha=alpha,
+		image_format=image_format,
+		quality=quality,
+	)
+	if len(page_ranges) <= 1:
+		for page_range in page_ranges:
+			render_page_range(input_file, output_dir, page_range, **options)
+	else:
+		with ProcessPoolExecutor(max_workers=len(page_ranges)) as pool:
+			futures = [
+				pool.submit(render_page_range, input_file, output_dir, page_range, **options)
+				for page_range in page_ranges
+			]
+			for future in futures:
+				future.result()
 
 	print(f"Conversion completed. Images are saved in '{output_dir}'.")
+	return page_count
+
+def dhash_page(page):
+	"""
+	64-bit difference hash of the rendering of a page.
+
+	The page is rendered in gray at 36x32 pixels and averaged down to 9x8 cells. Every
+	bit tells whether a cell is brighter than its right neighbour, so small rendering
+	differences flip few bits while an edited slide flips many.
+
+	Args:
+		page (fitz.Page): The page to hash
+
+	Returns:
+		str: The hash as 16 hex digits
+	"""
+	pix = page.get_pixmap(
+		matrix=fitz.Matrix(36 / page.rect.width, 32 / page.rect.height),
+		colorspace=fitz.csGRAY,
+		alpha=False,
+		)
+	cells = [[0] * 9 for _ in range(8)]
+	counts = [[0] * 9 for _ in range(8)]
+	samples = pix.samples
+	for y in range(pix.height):
+		for x in range(pix.width):
+			cells[y * 8 // pix.height][x * 9 // pix.width] += samples[y * pix.stride + x]
+			counts[y * 8 // pix.height][x * 9 // pix.width] += 1
+	bits = 0
+	for row, count in zip(cells, counts):
+		for x in range(8):
+			bits = (bits << 1) | (row[x] * count[x + 1] > row[x + 1] * count[x])
+	return f"{bits:016x}"
+
+def dhash_pages(input_file):
+	"""
+	Returns:
+		list: The `dhash_page` of every page of a PDF file
+	"""
+	doc = fitz.open(input_file)
+	hashes = [dhash_page(page) for page in doc]
+	doc.close()
+	return hashes
+
+def extract_pdf_slides(input_file):
+	"""Extract the text and text blocks of every page of a PDF file.
+
+	Used instead of `ppt2text.extract_slides` when the seed of a lecture is not a `.pptx`
+	(a `.ppt` converted to PDF, or a PDF itself). PDFs carry no speaker notes.
+
+	Returns:
+		list: One dict per page with the same keys as `ppt2text.extract_slides`
+	"""
+	doc = fitz.open(input_file)
+	slides = []
+	for page in doc:
+		width, height = page.rect.width, page.rect.height
+		blocks = [
+			dict(
+				text=text.strip(),
+				left=x0 / width,
+				top=y0 / height,
+				width=(x1 - x0) / width,
+				height=(y1 - y0) / height,
+			)
+			for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks")
+			if block_type == 0 and text.strip()
+		]
+		slides.append(dict(
+			content=page.get_text().strip(),
+			notes="",
+			blocks=blocks,
+		))
+	doc.close()
+	return slides
+
+def attach_png_to_snippets(png_dir, page_count, lecture_id, image_format=RENDER.FORMAT, slides=None, image_hashes=None):
+	"""
+	Store the rendered page images in the blob store and reference them from the file
+	snippets of a lecture by their SHA-256 digest.
+
+	The snippets of all pages are upserted by page index with a single bulk write, so this
+	works whether or not the text of the pages has already been extracted.
+
+	Args:
+		png_dir (str): Directory holding the images rendered by `convert_pdf_to_png`
+		page_count (int): Number of rendered pages
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		image_format (str, optional): Format the images were rendered in
+		slides (list, optional): The slides extracted by `ppt2text.extract_slides` or
+			`extract_pdf_slides`, written in the same bulk write as the images. Pages
+			without a slide get an empty `content`.
+		image_hashes (list, optional): The `dhash_page` of every page. With them, every
+			snippet gets the `fingerprint` used to match the slides of a revised deck.
+
+	Returns:
+		None
+	"""
+	mime_type, extension = IMAGE_FORMATS[image_format]
+	snippets = []
+	for page_num in range(page_count):
+		snippet = dict(
+			idx=page_num,
+			image_sha256=blob_store.put_file(os.path.join(png_dir, f'{page_num + 1}.{extension}')),
+			image_mime_type=mime_type,
+		)
+		if slides and page_num < len(slides):
+			snippet.update(slides[page_num])
+		else:
+			snippet.update(content="", notes="", blocks=[])
+		if image_hashes:
+			snippet["fingerprint"] = dict(
+				text=text_fingerprint(snippet.get("content")),
+				image=image_hashes[page_num],
+			)
+		snippets.append(snippet)
+	upsert_file_snippets(
+		lecture_id=lecture_id,
+		file_type="pptx",
+		snippets=snippets,
+	)
+
+
+def rendition_path(lecture_id, page_num, tier):
+	"""
+	Path of a slide rendition cached on disk.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		page_num (int): Index of the slide, from 0
+		tier (str): A key of `RENDITION.TIERS`
+
+	Returns:
+		str: The path, which may not be rendered yet
+	"""
+	_, extension = IMAGE_FORMATS[RENDITION.TIERS[tier].get("image_format", RENDER.FORMAT)]
+	return buffer_path(lecture_id, "renditions", tier, f'{page_num + 1}.{extension}')
+
+def get_rendition(lecture_id, page_num, tier):
+	"""
+	Get a slide rendition, rendering and caching it on its first request.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		page_num (int): Index of the slide, from 0
+		tier (str): A key of `RENDITION.TIERS`
+
+	Returns:
+		tuple: Path of the rendition and its MIME type
+
+	Raises:
+		KeyError: If the tier does not exist
+		IndexError: If the deck has no slide `page_num`
+	"""
+	options = RENDITION.TIERS[tier]
+	mime_type, _ = IMAGE_FORMATS[options.get("image_format", RENDER.FORMAT)]
+	path = rendition_path(lecture_id, page_num, tier)
+	if not os.path.exists(path):
+		input_file = buffer_path(lecture_id, "pdf", "seed_file.pdf")
+		doc = fitz.open(input_file)
+		page_count = len(doc)
+		doc.close()
+		if not 0 <= page_num < page_count:
+			raise IndexError(f"Lecture {lecture_id} has no slide {page_num}")
+		convert_pdf_to_png(
+			input_file=input_file,
+			output_dir=os.path.dirname(path),
+			pages=[page_num],
+			**options
+			)
+	return path, mime_type
 
 
 class SERVICE:
@@ -91,7 +364,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -117,10 +391,14 @@ class SERVICE:
 		lecture_id, parent_service, parent_job_id = job["lecture_id"], job["parent_service"], job["parent_job_id"]
 		SERVICE._logger.debug(f"Recieved PreClass PDF2PNG Job - {lecture_id}")
 
-		convert_pdf_to_png(
-			input_file=f"buffer/{lecture_id}/pdf/seed_file.pdf",
-			output_dir=f"buffer/{lecture_id}/pngs"
-			)
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"Conversion Already Done For {lecture_id}")
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+
+		SERVICE.process(lecture_id)
 
 		SERVICE._collection.update_one(
 			dict(_id=job_id),
@@ -129,15 +407,48 @@ class SERVICE:
 			)}
 		)
 		SERVICE._logger.info(f"Conversion Complete For {lecture_id}")
-		parent_connection, parent_channel = get_channel(parent_service)
-		parent_channel.basic_publish(
-			exchange="",
-			routing_key=parent_service,
-			body=str(parent_job_id)
-		)
-		parent_connection.close()
+		notify_parent(parent_service, parent_job_id)
 		ch.basic_ack(delivery_tag = method.delivery_tag)
 
+	@staticmethod
+	def process(lecture_id):
+		"""
+		Render the slides of a lecture and attach their text and images to its file snippets.
+
+		Args:
+			lecture_id (ObjectId): MongoDB ObjectId of the lecture, whose PDF is converted
+
+		Returns:
+			None
+		"""
+		# The deck is parsed once, on a thread of its own while the pages render in the process pool
+		seed_file = find_seed_file(lecture_id)
+		with ThreadPoolExecutor(max_workers=2) as extractor:
+			if seed_file and seed_file.lower().endswith(".pptx"):
+				slides = extractor.submit(extract_slides, seed_file)
+			else:
+				# python-pptx only reads .pptx, the text of other seeds comes from their PDF
+				slides = extractor.submit(extract_pdf_slides, buffer_path(lecture_id, "pdf", "seed_file.pdf"))
+			image_hashes = extractor.submit(dhash_pages, buffer_path(lecture_id, "pdf", "seed_file.pdf"))
+
+			# Only the tiers needed by the pipeline are rendered now, see `get_rendition` for the others
+			for tier in dict.fromkeys(RENDITION.EAGER + [RENDITION.LLM_TIER]):
+				page_count = convert_pdf_to_png(
+					input_file=buffer_path(lecture_id, "pdf", "seed_file.pdf"),
+					output_dir=buffer_path(lecture_id, "renditions", tier),
+					**RENDITION.TIERS[tier]
+					)
+			attach_png_to_snippets(
+				png_dir=buffer_path(lecture_id, "renditions", RENDITION.LLM_TIER),
+				page_count=page_count,
+				lecture_id=lecture_id,
+				image_format=RENDITION.TIERS[RENDITION.LLM_TIER].get("image_format", RENDER.FORMAT),
+				slides=slides.result(),
+				image_hashes=image_hashes.result(),
+				)
+		# Which slides of a revised deck can take their results from its previous version
+		record_revision(lecture_id)
+
 	@staticmethod
 	def launch_worker():
 		"""
@@ -149,10 +460,21 @@ class SERVICE:
 		"""
 		try:
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
 			
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						SERVICE.callback,
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+					),
+					queue_name=SERVICE._queue_name,
+					collection=SERVICE._collection,
+					logger=SERVICE._logger,
+					on_dead_letter=dead_letter_handler(SERVICE._collection, "pdf2png"),
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
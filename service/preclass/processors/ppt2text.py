@@ -6,79 +6,79 @@ from bson import ObjectId
 
 from pptx import Presentation
 
-from utils import get_channel, get_logger, now
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure, find_seed_file
 from config import MONGO
-from data.lecture import insert_file_snippet
+from service.monitor import instrument
+from data.lecture import upsert_file_snippets
 
-import base64
 
-def png_to_base64(png_file_path):
-	"""
-	Converts a PNG file to a Base64-encoded string.
+def extract_slides(ppt_path: str) -> list:
+	"""Walk a PowerPoint deck once and extract the text, speaker notes and text blocks of every slide.
 
-	Parameters:
-	png_file_path: The relative or absolute path to the PNG image file.
+	Args:
+		ppt_path (str): Path to the PowerPoint file
 
 	Returns:
-	A Base64-encoded string of the PNG image.
+		list: One dict per slide with
+			- content (str): The text of the slide, one paragraph per line and a blank line between shapes
+			- notes (str): The speaker notes of the slide
+			- blocks (list): The text of every shape with its `left`, `top`, `width` and `height`
+			  as fractions of the slide size
 	"""
-	try:
-		# Open the PNG file in binary read mode
-		with open(png_file_path, 'rb') as image_file:
-			# Read the file's contents and encode it to Base64
-			encoded_string = base64.b64encode(image_file.read())
-		# Decode the Base64 bytes object to a string and return it
-		return encoded_string.decode('utf-8')
-	except FileNotFoundError:
-		# Return an error message if the file is not found
-		return "The specified file was not found. Please check the path is correct."
-	except Exception as e:
-		# Return a generic error message for any other exceptions
-		return f"An error occurred during the conversion: {str(e)}"
+	presentation = Presentation(ppt_path)
+	slide_width, slide_height = presentation.slide_width, presentation.slide_height
+
+	slides = []
+	for slide in presentation.slides:
+		content = ""
+		blocks = []
+		for shape in slide.shapes:
+			if shape.has_text_frame:
+				text = "\n".join(paragraph.text for paragraph in shape.text_frame.paragraphs)
+				content += text + "\n\n"
+				# Placeholders inherited from the layout have no geometry of their own
+				if shape.left is not None and shape.top is not None:
+					blocks.append(dict(
+						text=text.strip(),
+						left=shape.left / slide_width,
+						top=shape.top / slide_height,
+						width=(shape.width or 0) / slide_width,
+						height=(shape.height or 0) / slide_height,
+					))
+
+		notes = ""
+		if slide.has_notes_slide and slide.notes_slide.notes_text_frame is not None:
+			notes = slide.notes_slide.notes_text_frame.text
+
+		slides.append(dict(
+			content=content.strip(),
+			notes=notes.strip(),
+			blocks=blocks,
+		))
+	return slides
 
 def extract_text_from_ppt(
 	ppt_path: str,
-	png_path: str,
 	lecture_id: ObjectId,
 	) -> None:
-	"""Extract text and images from PowerPoint slides and store them in the database.
+	"""Extract text from PowerPoint slides and store it in the database.
 
 	Args:
 		ppt_path (str): Path to the PowerPoint file
-		png_path (str): Directory path where PNG images will be stored
 		lecture_id (ObjectId): MongoDB ObjectId of the lecture
 
-	The function processes each slide to:
-	- Extract text content from shapes
-	- Convert slide to PNG image
-	- Store both text and image in the database
+	The slides are parsed by `extract_slides` and their snippets are written with a single
+	bulk write. The PDF2PNG service extracts the slides itself while it renders them, so
+	this service only runs when the text is needed without the images.
 	"""
-
-	# Load the presentation
-	presentation = Presentation(ppt_path)
-
-	for slide_number, slide in enumerate(presentation.slides):
-		slide_dir = os.path.join(png_path, str(slide_number + 1))
-		slide_dir = slide_dir.replace("\\", "/")
-
-		content = ""
-		png = f"{slide_dir}.png"
-		png_base64 = png_to_base64(png)
-
-		# Extract text
-		for shape in slide.shapes:
-			if shape.has_text_frame:
-				for paragraph in shape.text_frame.paragraphs:
-					content += paragraph.text + "\n"
-				content += "\n"
-
-		insert_file_snippet(
-			idx=slide_number,
-			content=content.strip(),
-			png_base64=png_base64,
-			lecture_id=lecture_id,
-			file_type="pptx"
-		)
+	upsert_file_snippets(
+		lecture_id=lecture_id,
+		file_type="pptx",
+		snippets=[
+			dict(idx=slide_number, **slide)
+			for slide_number, slide in enumerate(extract_slides(ppt_path))
+		],
+	)
 
 class SERVICE:
 	"""Service class for handling PowerPoint to text conversion tasks.
@@ -137,7 +137,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -159,9 +160,15 @@ class SERVICE:
 		lecture_id, parent_service, parent_job_id = job["lecture_id"], job["parent_service"], job["parent_job_id"]
 		SERVICE._logger.debug(f"Recieved PreClass PPT2TEXT Job - {lecture_id}")
 
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"Conversion Already Done For {lecture_id}")
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+
 		extract_text_from_ppt(
-			ppt_path=f"buffer/{lecture_id}/seed_file.pptx",
-			png_path=f"buffer/{lecture_id}/pngs",
+			ppt_path=find_seed_file(lecture_id),
 			lecture_id=lecture_id
 			)
 
@@ -172,13 +179,7 @@ class SERVICE:
 			)}
 		)
 		SERVICE._logger.info(f"Conversion Complete For {lecture_id}")
-		parent_connection, parent_channel = get_channel(parent_service)
-		parent_channel.basic_publish(
-			exchange="",
-			routing_key=parent_service,
-			body=str(parent_job_id)
-		)
-		parent_connection.close()
+		notify_parent(parent_service, parent_job_id)
 		ch.basic_ack(delivery_tag = method.delivery_tag)
 
 	@staticmethod
@@ -190,10 +191,20 @@ class SERVICE:
 		"""
 		try:
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
 			
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=retry_on_failure(
+					instrument(
+						SERVICE.callback,
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+					),
+					queue_name=SERVICE._queue_name,
+					collection=SERVICE._collection,
+					logger=SERVICE._logger,
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
@@ -6,14 +6,19 @@ import subprocess
 from pymongo import MongoClient
 from bson import ObjectId
 
-from utils import get_channel, get_logger, now
-from config import MONGO
+from utils import get_channel, get_logger, message_properties, now, notify_parent, declare_retry_queues, retry_on_failure, run_in_threads, buffer_path, find_seed_file
+from config import MONGO, CONVERTER
+from service.monitor import instrument
+from service.preclass.processors.converter import ConverterPool
+from service.preclass.stream import dead_letter_handler
 
 class SERVICE:
 	"""A service class that handles PowerPoint to PDF conversion tasks.
 	
 	This service interfaces with MongoDB for job storage and RabbitMQ for job queue management.
-	It uses a Docker container with LibreOffice to perform the actual PPTX to PDF conversion.
+	The conversion is done by a pool of long-running LibreOffice processes (see `ConverterPool`).
+	When LibreOffice or its UNO bindings are not installed on the worker host, or the pool fails,
+	it falls back to a Docker container with LibreOffice.
 	"""
 	_collection = MongoClient(
 		MONGO.HOST,
@@ -21,6 +26,8 @@ class SERVICE:
 		).preclass.pptx2pdf
 	_queue_name = "preclass-pptx2pdf"
 
+	_converter_pool = None
+
 	_logger = get_logger(
 		__name__=__name__,
 		__file__=__file__,
@@ -58,7 +65,8 @@ class SERVICE:
 		channel.basic_publish(
 			exchange="",
 			routing_key=SERVICE._queue_name,
-			body=str(job_id)
+			body=str(job_id),
+			properties=message_properties()
 		)
 		connection.close()
 		
@@ -82,30 +90,89 @@ class SERVICE:
 		job = SERVICE._collection.find_one(dict(_id=job_id))
 		lecture_id, parent_service, parent_job_id = job["lecture_id"], job["parent_service"], job["parent_job_id"]
 		SERVICE._logger.debug(f"Recieved PreClass PPTX2PDF Job - {lecture_id}")
+
+		# A redelivered job that already finished only has to hand control back
+		if "completion_time" in job:
+			SERVICE._logger.info(f"Conversion Already Done For {lecture_id}")
+			notify_parent(parent_service, parent_job_id)
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+			return
+		SERVICE.convert(lecture_id)
+
+		SERVICE._collection.update_one(
+			dict(_id=job_id),
+			{"$set": dict(
+				completion_time=now()
+			)}
+		)
+		SERVICE._logger.info(f"Conversion Complete For {lecture_id}")
+		notify_parent(parent_service, parent_job_id)
+		ch.basic_ack(delivery_tag = method.delivery_tag)
+
+	@staticmethod
+	def convert(lecture_id):
+		"""Converts the seed file of a lecture to `buffer/{lecture_id}/pdf/seed_file.pdf`.
+
+		The converter pool of the worker is used when it was started, with a one-off
+		Docker container as fallback.
+
+		Args:
+			lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		"""
+		seed_file = find_seed_file(lecture_id)
+		if seed_file is None:
+			raise FileNotFoundError(f"No seed file found for lecture {lecture_id}")
+		os.makedirs(buffer_path(lecture_id, "pdf"), exist_ok=True)
+		output_file = buffer_path(lecture_id, "pdf", "seed_file.pdf")
+
+		if SERVICE._converter_pool:
+			try:
+				SERVICE._converter_pool.convert(seed_file, output_file)
+				return
+			except Exception:
+				SERVICE._logger.exception(f"Converter Pool Failed For {lecture_id}, Falling Back To Docker")
+		SERVICE.convert_with_docker(seed_file)
+
+	@staticmethod
+	def convert_with_docker(seed_file):
+		"""Converts a presentation with a one-off Docker container running LibreOffice.
+
+		The PDF is written to the `pdf` directory next to the presentation.
+
+		Args:
+			seed_file (str): Absolute path of the presentation
+		"""
 		docker_command = [
 			'docker', 'run', '--rm',
-			'-v', f'{os.getcwd()}/buffer/{lecture_id}:/data',
-			'preclass-converter',
-			'libreoffice', '--headless', '--convert-to', 'pdf', '--outdir', 'pdf', 'seed_file.pptx'
+			'-v', f'{os.path.dirname(seed_file)}:/data',
+			CONVERTER.DOCKER_IMAGE,
+			'libreoffice', '--headless', '--convert-to', 'pdf', '--outdir', 'pdf', os.path.basename(seed_file)
 		]
+		subprocess.run(docker_command, check=True, timeout=CONVERTER.TIMEOUT)
 
-		result = subprocess.run(docker_command, check=True)
-		if result.returncode == 0:
-			SERVICE._collection.update_one(
-				dict(_id=job_id),
-				{"$set": dict(
-					completion_time=now()
-				)}
-			)
-			SERVICE._logger.info(f"Conversion Complete For {lecture_id}")
-			parent_connection, parent_channel = get_channel(parent_service)
-			parent_channel.basic_publish(
-				exchange="",
-				routing_key=parent_service,
-				body=str(parent_job_id)
-			)
-			parent_connection.close()
-			ch.basic_ack(delivery_tag = method.delivery_tag)
+	@staticmethod
+	def start_converter_pool(size=CONVERTER.POOL_SIZE):
+		"""Starts the converter pool used by `convert`, when LibreOffice is available.
+
+		A pool that cannot be started is logged and left out, `convert` then converts
+		with Docker.
+
+		Args:
+			size (int): Number of converter processes
+
+		Returns:
+			bool: Whether the pool was started
+		"""
+		SERVICE._converter_pool = None
+		if not ConverterPool.available():
+			SERVICE._logger.warning("LibreOffice UNO Bindings Not Found, Converting With Docker")
+			return False
+		try:
+			SERVICE._converter_pool = ConverterPool(size=size)
+		except Exception:
+			SERVICE._logger.warning("Converter Pool Failed To Start, Converting With Docker", exc_info=True)
+			return False
+		return True
 
 	@staticmethod
 	def launch_worker():
@@ -118,17 +185,39 @@ class SERVICE:
 			KeyboardInterrupt: When the worker is manually stopped
 		"""
 		try:
+			workers = CONVERTER.POOL_SIZE if SERVICE.start_converter_pool() else 1
+
 			connection, channel = get_channel(SERVICE._queue_name)
+			declare_retry_queues(channel, SERVICE._queue_name)
 			
+			# One delivery per converter process is handled at a time
 			channel.basic_consume(
 				queue=SERVICE._queue_name,
-				on_message_callback=SERVICE.callback,
+				on_message_callback=run_in_threads(
+					retry_on_failure(
+						instrument(
+							SERVICE.callback,
+							queue_name=SERVICE._queue_name,
+							collection=SERVICE._collection,
+						),
+						queue_name=SERVICE._queue_name,
+						collection=SERVICE._collection,
+						logger=SERVICE._logger,
+						on_dead_letter=dead_letter_handler(SERVICE._collection, "pptx2pdf"),
+					),
+					connection=connection,
+					channel=channel,
+					workers=workers,
+					logger=SERVICE._logger,
+				),
 				auto_ack=False,
 			)
 			SERVICE._logger.info('Worker Launched. To exit press CTRL+C')
 			channel.start_consuming()
 		except KeyboardInterrupt:
 			SERVICE._logger.warning('Shutting Off Worker')
+			if SERVICE._converter_pool:
+				SERVICE._converter_pool.close()
 			try:
 				sys.exit(0)
 			except SystemExit:
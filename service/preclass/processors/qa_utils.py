@@ -1,3 +1,6 @@
+import json
+
+
 def get_question_type(q):
     """
     Determines if a question is multiple or single choice and strips the choice indicator.
@@ -201,4 +204,94 @@ def parse_qa(questions):
             cnt += 1
         else:
             continue    
-    return theme_qas
\ No newline at end of file
+    return theme_qas
+
+
+QA_TYPES = ("single choice", "multiple choice")
+
+# Structured output requested from the LLM, read back by `parse_qa_json`
+QA_RESPONSE_FORMAT = dict(
+    type="json_schema",
+    json_schema=dict(
+        name="questions",
+        strict=True,
+        schema=dict(
+            type="object",
+            properties=dict(
+                questions=dict(
+                    type="array",
+                    items=dict(
+                        type="object",
+                        properties=dict(
+                            question=dict(type="string"),
+                            question_type=dict(type="string", enum=list(QA_TYPES)),
+                            selects=dict(type="array", items=dict(type="string")),
+                            answer=dict(type="array", items=dict(type="string", enum=["A", "B", "C", "D", "E"])),
+                            reference=dict(type="string"),
+                        ),
+                        required=["question", "question_type", "selects", "answer", "reference"],
+                        additionalProperties=False,
+                    ),
+                ),
+            ),
+            required=["questions"],
+            additionalProperties=False,
+        ),
+    ),
+)
+
+def parse_qa_json(questions):
+    """
+    Parses a reply following `QA_RESPONSE_FORMAT` into structured question-answer objects.
+
+    Questions that are malformed (no question text, fewer than 2 selects, an answer outside
+    of the selects) are dropped. The question type follows the number of answers.
+
+    Args:
+        questions (str): JSON reply of the LLM
+
+    Returns:
+        list: List of dictionaries with the same keys as `parse_qa`, empty if the reply is not valid JSON
+    """
+    try:
+        items = json.loads(questions)["questions"]
+    except (ValueError, KeyError, TypeError):
+        return []
+    if not isinstance(items, list):
+        return []
+
+    theme_qas = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        q = item.get("question")
+        selects = item.get("selects")
+        answer = item.get("answer")
+        ref = item.get("reference", "")
+        if not isinstance(q, str) or not q.strip():
+            continue
+        if not isinstance(selects, list) or not 2 <= len(selects) <= 5 or not all(isinstance(select, str) for select in selects):
+            continue
+        if not isinstance(answer, list) or not all(isinstance(ans, str) for ans in answer):
+            continue
+        ans = sorted(set(split_ans("".join(answer))))
+        if not ans or ans[-1] >= len(selects):
+            continue
+        question_type = QA_TYPES[len(ans) > 1]
+        theme_qas.append({'question': q.strip(), 'question_type': question_type, 'selects': selects, 'answer': ans, 'reference': ref if isinstance(ref, str) else ""})
+    return theme_qas
+
+def parse_qa_reply(questions):
+    """
+    Parses an LLM reply with `parse_qa_json`, falling back to the legacy `parse_qa` for free-text replies.
+
+    Args:
+        questions (str): Reply of the LLM
+
+    Returns:
+        list: List of dictionaries containing parsed QA data, see `parse_qa`
+    """
+    theme_qas = parse_qa_json(questions)
+    if theme_qas:
+        return theme_qas
+    return parse_qa(questions)
@@ -0,0 +1,92 @@
+import re
+import difflib
+import hashlib
+
+from bson import ObjectId
+
+from config import REVISION
+from data.lecture import find_info, find_file_snippets, update_info
+
+def text_fingerprint(text: str) -> str:
+	"""SHA-256 of the text of a slide, ignoring case and whitespace changes."""
+	normalized = re.sub(r"\s+", " ", text or "").strip().lower()
+	return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def hamming_distance(a: str, b: str) -> int:
+	"""Number of differing bits between two hex-encoded hashes."""
+	return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+def match_slides(previous: list, current: list) -> dict:
+	"""Match the slides of a revised deck to the unchanged slides of its previous version.
+
+	The decks are aligned on their text fingerprints, so that inserted and deleted slides
+	do not shift the slides after them. Aligned slides whose renderings differ by more
+	than `REVISION.MAX_IMAGE_DISTANCE` bits are considered changed.
+
+	Args:
+		previous (list): The `fingerprint` of every slide of the previous version, in slide order
+		current (list): The `fingerprint` of every slide of the revised deck, in slide order
+
+	Returns:
+		dict: Maps the index of every unchanged slide to its index in the previous version
+	"""
+	matcher = difflib.SequenceMatcher(
+		a=[fingerprint["text"] for fingerprint in previous],
+		b=[fingerprint["text"] for fingerprint in current],
+		autojunk=False,
+	)
+	matched = dict()
+	for block in matcher.get_matching_blocks():
+		for offset in range(block.size):
+			old, new = block.a + offset, block.b + offset
+			if hamming_distance(previous[old]["image"], current[new]["image"]) <= REVISION.MAX_IMAGE_DISTANCE:
+				matched[new] = old
+	return matched
+
+def record_revision(lecture_id: ObjectId):
+	"""Find the slides of a lecture whose results can be taken from its previous version.
+
+	A slide is reused when it and its `REVISION.NEIGHBOURS` slides on either side are
+	unchanged and in the same order as before, since the neighbours are part of the
+	context its description and script were generated with. The result is stored as
+	`reused_slides` in `lecture.info`, see `reused_slides`.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture, whose slides must be fingerprinted
+	"""
+	previous_lecture_id = find_info(dict(_id=lecture_id)).get("previous_lecture_id")
+	if previous_lecture_id is None:
+		return
+
+	def fingerprints(lecture_id):
+		return [
+			snippet["fingerprint"]
+			for snippet in find_file_snippets(
+				query=dict(lecture_id=lecture_id, fingerprint={"$exists": True}),
+				projection=dict(fingerprint=1),
+				sort=[("idx", 1)],
+			)
+		]
+	current = fingerprints(lecture_id)
+	matched = match_slides(fingerprints(previous_lecture_id), current)
+
+	reused = []
+	for new, old in sorted(matched.items()):
+		neighbours = [
+			n for n in range(new - REVISION.NEIGHBOURS, new + REVISION.NEIGHBOURS + 1)
+			if 0 <= n < len(current)
+		]
+		if all(matched.get(n) == old + (n - new) for n in neighbours):
+			reused.append([new, old])
+	update_info(lecture_id, reused_slides=reused)
+
+def reused_slides(lecture_id: ObjectId):
+	"""
+	Returns:
+		tuple: The ObjectId of the previous version of the lecture (None if it has none) and
+			a dict mapping the index of every reusable slide to its index in that version
+	"""
+	info = find_info(dict(_id=lecture_id), projection=dict(previous_lecture_id=1, reused_slides=1))
+	if info is None or info.get("previous_lecture_id") is None:
+		return None, dict()
+	return info["previous_lecture_id"], {new: old for new, old in info.get("reused_slides", [])}
@@ -0,0 +1,294 @@
+import time
+import threading
+
+from pymongo import MongoClient
+from bson import ObjectId
+
+from config import MONGO, STREAM
+from utils import now, notify_parent
+
+client = MongoClient(
+	MONGO.HOST,
+	MONGO.PORT
+	).preclass
+
+# Waiting stages poll both collections every `STREAM.POLL_INTERVAL`, and the unique keys
+# keep concurrent deliveries from upserting the same event twice
+client.slide_event.create_index([("lecture_id", 1), ("stage", 1), ("index", 1)], unique=True)
+client.stage_event.create_index([("lecture_id", 1), ("stage", 1)], unique=True)
+
+# Connection whose heartbeats are answered while the current thread waits, see `use_connection`
+_local = threading.local()
+
+class StageFailed(RuntimeError):
+	"""Raised while waiting for a stage that gave up on the lecture, see `fail_stage`.
+
+	The awaited results will never come, so `utils.retry_on_failure` dead-letters the
+	waiting job at once instead of retrying it.
+	"""
+	retryable = False
+
+def use_connection(connection):
+	"""Wait with `connection.sleep` instead of `time.sleep` in the calling thread.
+
+	Worker callbacks run inside the pika I/O loop, so a callback waiting for an upstream
+	stage would otherwise leave the heartbeats of its connection unanswered.
+
+	Args:
+		connection (pika.BlockingConnection): The connection of the worker
+	"""
+	_local.connection = connection
+
+def _sleep(seconds):
+	connection = getattr(_local, "connection", None)
+	if connection is None:
+		time.sleep(seconds)
+	else:
+		connection.sleep(seconds)
+
+def publish_slide(
+	lecture_id: ObjectId,
+	stage: str,
+	index: int,
+	**value
+	):
+	"""Announce that a stage has finished a slide.
+
+	Events are keyed by (lecture_id, stage, index), so publishing the same slide
+	again only refreshes its event.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		stage (str): Name of the stage in `PRECLASS_MAIN.PIPELINE`
+		index (int): Index of the finished slide
+		**value: Additional information made available to the consumers of the event
+	"""
+	client.slide_event.update_one(
+		dict(
+			lecture_id=lecture_id,
+			stage=stage,
+			index=index,
+		),
+		{"$set": dict(
+			value=value,
+			time=now(),
+		)},
+		upsert=True
+	)
+
+def finish_stage(
+	lecture_id: ObjectId,
+	stage: str,
+	total: int
+	):
+	"""Announce that a stage has finished every slide of a lecture.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		stage (str): Name of the stage in `PRECLASS_MAIN.PIPELINE`
+		total (int): Number of slides published by the stage
+	"""
+	client.stage_event.update_one(
+		dict(
+			lecture_id=lecture_id,
+			stage=stage,
+		),
+		{
+			"$set": dict(
+				total=total,
+				time=now(),
+			),
+			"$unset": dict(
+				failed="",
+				reason="",
+			),
+		},
+		upsert=True
+	)
+
+def fail_stage(
+	lecture_id: ObjectId,
+	stage: str,
+	reason: str
+	):
+	"""Announce that a stage gave up on a lecture, so that the stages waiting for it raise `StageFailed`.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		stage (str): Name of the stage in `PRECLASS_MAIN.PIPELINE`
+		reason (str): Why the stage failed
+	"""
+	client.stage_event.update_one(
+		dict(
+			lecture_id=lecture_id,
+			stage=stage,
+		),
+		{"$set": dict(
+			failed=True,
+			reason=reason,
+			time=now(),
+		)},
+		upsert=True
+	)
+
+def dead_letter_handler(collection, stage: str):
+	"""Build the `on_dead_letter` callback of a preclass stage worker, see `utils.retry_on_failure`.
+
+	The failure is announced with `fail_stage` and the main job is notified, so that it
+	marks the stage as failed.
+
+	Args:
+		collection: MongoDB collection holding the jobs of the stage
+		stage (str): Name of the stage in `PRECLASS_MAIN.PIPELINE`
+
+	Returns:
+		callable: Called with the ID of the dead-lettered job
+	"""
+	def on_dead_letter(job_id):
+		job = collection.find_one(dict(_id=job_id))
+		fail_stage(job["lecture_id"], stage, job.get("failure_reason"))
+		notify_parent(job["parent_service"], job["parent_job_id"])
+	return on_dead_letter
+
+def _stage_event(lecture_id, stage):
+	"""
+	Returns:
+		dict: The event of a finished stage, None while it is running
+
+	Raises:
+		StageFailed: If the stage gave up on the lecture
+	"""
+	finished = client.stage_event.find_one(dict(
+		lecture_id=lecture_id,
+		stage=stage,
+	))
+	if finished and finished.get("failed"):
+		raise StageFailed(f"Stage {stage} failed for lecture {lecture_id}: {finished.get('reason')}")
+	return finished
+
+def wait_for_slide(
+	lecture_id: ObjectId,
+	stage: str,
+	index: int,
+	timeout: int = STREAM.IDLE_TIMEOUT
+	):
+	"""Block until a stage has finished a slide.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		stage (str): Name of the stage in `PRECLASS_MAIN.PIPELINE`
+		index (int): Index of the awaited slide
+		timeout (int): Maximum time to wait in seconds
+
+	Returns:
+		dict: The value published with the slide, or None if the stage finished
+			with fewer slides (the deck has no slide `index`)
+
+	Raises:
+		TimeoutError: If the slide is not finished within the timeout period
+		StageFailed: If the stage gave up on the lecture
+	"""
+	start_time = time.time()
+	while (time.time() - start_time) < timeout:
+		event = client.slide_event.find_one(dict(
+			lecture_id=lecture_id,
+			stage=stage,
+			index=index,
+		))
+		if event:
+			return event["value"]
+		finished = _stage_event(lecture_id, stage)
+		# Slides are published before their stage finishes, so the event cannot be missed
+		if finished and index >= finished["total"]:
+			return None
+		_sleep(STREAM.POLL_INTERVAL)
+	raise TimeoutError(f"Stage {stage} did not finish slide {index} of lecture {lecture_id} after {timeout} seconds")
+
+def wait_for_stage(
+	lecture_id: ObjectId,
+	stage: str,
+	timeout: int = STREAM.IDLE_TIMEOUT
+	) -> int:
+	"""Block until a stage has finished every slide of a lecture.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		stage (str): Name of the stage in `PRECLASS_MAIN.PIPELINE`
+		timeout (int): Maximum time to wait in seconds
+
+	Returns:
+		int: Number of slides published by the stage
+
+	Raises:
+		TimeoutError: If the stage does not finish within the timeout period
+		StageFailed: If the stage gave up on the lecture
+	"""
+	start_time = time.time()
+	while (time.time() - start_time) < timeout:
+		finished = _stage_event(lecture_id, stage)
+		if finished:
+			return finished["total"]
+		_sleep(STREAM.POLL_INTERVAL)
+	raise TimeoutError(f"Stage {stage} did not finish lecture {lecture_id} after {timeout} seconds")
+
+def iter_slides(
+	lecture_id: ObjectId,
+	stage: str,
+	start: int = 0,
+	timeout: int = STREAM.IDLE_TIMEOUT
+	):
+	"""Iterate over the slides finished by a stage in slide order, as soon as each one is finished.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+		stage (str): Name of the stage in `PRECLASS_MAIN.PIPELINE`
+		start (int): Index of the first slide
+		timeout (int): Maximum time to wait for each slide in seconds
+
+	Yields:
+		tuple: The slide index and the value published with it
+
+	Raises:
+		StageFailed: If the stage gave up on the lecture
+	"""
+	index = start
+	while True:
+		value = wait_for_slide(lecture_id, stage, index, timeout=timeout)
+		if value is None:
+			return
+		yield index, value
+		index += 1
+
+def stage_progress(lecture_id: ObjectId) -> dict:
+	"""Summarize the slide events of every streaming stage of a lecture.
+
+	Args:
+		lecture_id (ObjectId): MongoDB ObjectId of the lecture
+
+	Returns:
+		dict: Maps each stage with events to its `done` slide count, the `first_time` and
+			`last_time` a slide was finished, its `total` once it finished every slide and
+			whether it `failed`
+	"""
+	progress = dict()
+	for record in client.slide_event.aggregate([
+		{"$match": dict(lecture_id=lecture_id)},
+		{"$group": dict(
+			_id="$stage",
+			done={"$sum": 1},
+			first_time={"$min": "$time"},
+			last_time={"$max": "$time"},
+		)},
+	]):
+		progress[record["_id"]] = dict(
+			done=record["done"],
+			first_time=record["first_time"],
+			last_time=record["last_time"],
+			total=None,
+			failed=False,
+		)
+	for finished in client.stage_event.find(dict(lecture_id=lecture_id)):
+		progress.setdefault(finished["stage"], dict(done=finished.get("total") or 0, first_time=None, last_time=finished["time"]))
+		progress[finished["stage"]]["total"] = finished.get("total")
+		progress[finished["stage"]]["failed"] = finished.get("failed", False)
+	return progress
@@ -1,12 +1,17 @@
 import os
+import time
 import shutil
+import hashlib
 import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 import pika
+from bson import ObjectId
 from datetime import datetime
 from colorama import Fore, Style, init
 
-from config import LOG
+from config import LOG, QUEUE, BUFFER, BLOB
 
 preclass_context_size = 3
 
@@ -113,6 +118,63 @@ def change_file_path(input_file, new_directory, new_base_name):
 	shutil.move(input_file, new_file_path)
 	return new_file_path
 
+def move_file_with_sha256(input_file, new_directory, new_base_name):
+	"""
+	Move a file like `change_file_path`, computing its SHA-256 on the way.
+
+	The file is copied chunk by chunk into the new location and hashed as the chunks go
+	by, so that it is only read once. The original is removed afterwards.
+
+	Parameters:
+	input_file (str): The original file path with the extension.
+	new_directory (str): The new directory where the file should be moved.
+	new_base_name (str): The new base name for the file (without extension).
+
+	Returns:
+	tuple: The new file path with the original extension and the hex digest of the file.
+	"""
+	_, extension = os.path.splitext(input_file)
+	os.makedirs(new_directory, exist_ok=True)
+	new_file_path = os.path.join(new_directory, new_base_name + extension)
+
+	sha256 = hashlib.sha256()
+	with open(input_file, 'rb') as src, open(new_file_path, 'wb') as dst:
+		for chunk in iter(lambda: src.read(BLOB.CHUNK_SIZE), b""):
+			sha256.update(chunk)
+			dst.write(chunk)
+	shutil.copystat(input_file, new_file_path)
+	os.remove(input_file)
+	return new_file_path, sha256.hexdigest()
+
+def buffer_path(lecture_id, *paths):
+	"""
+	Path of a working file of a lecture, under `BUFFER.ROOT`.
+
+	Parameters:
+		lecture_id (ObjectId): ID of the lecture.
+		*paths (str): Path components below the buffer directory of the lecture.
+
+	Returns:
+		str: The absolute path.
+	"""
+	return os.path.join(BUFFER.ROOT, str(lecture_id), *paths)
+
+def find_seed_file(lecture_id):
+	"""
+	Path of the source presentation of a lecture, whatever its extension.
+
+	Parameters:
+		lecture_id (ObjectId): ID of the lecture.
+
+	Returns:
+		str: The absolute path, None if the lecture has no seed file.
+	"""
+	directory = buffer_path(lecture_id)
+	for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+		if os.path.splitext(filename)[0] == "seed_file":
+			return os.path.join(directory, filename)
+	return None
+
 def get_channel(queue_name):
 	connection = pika.BlockingConnection(
 		pika.ConnectionParameters(host='localhost'))
@@ -122,4 +184,213 @@ def get_channel(queue_name):
 		queue=queue_name,
 		durable=True
 	)
-	return connection, channel
\ No newline at end of file
+	return connection, channel
+
+def message_properties(**kwargs):
+	"""
+	Properties attached to every published job message.
+
+	The `x-enqueued-at` header records when the message entered the queue, so that
+	the consuming worker can measure the time it spent waiting (see `service.monitor.instrument`).
+
+	Parameters:
+		**kwargs: Additional keyword arguments for `pika.BasicProperties`.
+
+	Returns:
+		pika.BasicProperties: The message properties.
+	"""
+	headers = kwargs.pop("headers", {})
+	headers.setdefault("x-enqueued-at", time.time())
+	return pika.BasicProperties(
+		headers=headers,
+		**kwargs
+	)
+
+def notify_parent(parent_service, parent_job_id):
+	"""
+	Publish `parent_job_id` to the queue of `parent_service` to hand control back to it.
+
+	Parameters:
+		parent_service (str): Queue name of the parent service.
+		parent_job_id (ObjectId): ID of the parent job to resume.
+	"""
+	parent_connection, parent_channel = get_channel(parent_service)
+	parent_channel.basic_publish(
+		exchange="",
+		routing_key=parent_service,
+		body=str(parent_job_id),
+		properties=message_properties()
+	)
+	parent_connection.close()
+
+def retry_delay(attempt):
+	"""
+	Delay in milliseconds before the given retry attempt is redelivered.
+
+	The delay grows exponentially with the attempt number and is capped at
+	`QUEUE.RETRY_MAX_DELAY` seconds.
+	"""
+	delay = QUEUE.RETRY_BASE_DELAY * QUEUE.RETRY_BACKOFF ** (attempt - 1)
+	return int(min(delay, QUEUE.RETRY_MAX_DELAY) * 1000)
+
+def declare_retry_queues(channel, queue_name):
+	"""
+	Declare the retry and dead-letter queues that back a worker queue.
+
+	Every retry attempt owns a queue `{queue_name}.retry.{attempt}` whose
+	messages expire after `retry_delay(attempt)` and are then dead-lettered
+	back onto `queue_name`. Jobs that exhausted `QUEUE.MAX_ATTEMPTS` are
+	parked in `{queue_name}.dead` for manual inspection.
+
+	Notes:
+		RabbitMQ refuses to re-declare a queue with different arguments, so the
+		retry queues have to be deleted after changing the delays in `QUEUE`.
+	"""
+	for attempt in range(1, QUEUE.MAX_ATTEMPTS):
+		channel.queue_declare(
+			queue=f"{queue_name}.retry.{attempt}",
+			durable=True,
+			arguments={
+				"x-message-ttl": retry_delay(attempt),
+				"x-dead-letter-exchange": "",
+				"x-dead-letter-routing-key": queue_name,
+			}
+		)
+	channel.queue_declare(
+		queue=f"{queue_name}.dead",
+		durable=True
+	)
+
+def retry_on_failure(callback, queue_name, collection, logger, on_dead_letter=None):
+	"""
+	Wrap a worker callback so that failed jobs are retried with backoff.
+
+	An exception raised by `callback` no longer kills the worker or leaves the
+	message unacked. The message is re-published to the retry queue of its next
+	attempt (see `declare_retry_queues`) and acked, so healthy jobs behind it keep
+	flowing. After `QUEUE.MAX_ATTEMPTS` failures it goes to the dead-letter queue,
+	at once if the exception has a false `retryable` attribute.
+	Each failure is recorded on the job document stored in `collection`.
+
+	Parameters:
+		callback (callable): The `on_message_callback` of the worker.
+		queue_name (str): Name of the queue consumed by the worker.
+		collection: MongoDB collection holding the jobs of the worker.
+		logger (logging.Logger): Logger of the worker.
+		on_dead_letter (callable, optional): Called with the job ID once the job is
+			dead-lettered and its failure recorded.
+
+	Returns:
+		callable: The wrapped callback.
+	"""
+	@functools.wraps(callback)
+	def wrapper(ch, method, properties, body):
+		try:
+			return callback(ch, method, properties, body)
+		except Exception as e:
+			headers = dict(properties.headers or {})
+			attempt = headers.get("x-attempt", 0) + 1
+			reason = f"{type(e).__name__}: {e}"
+			dead = attempt >= QUEUE.MAX_ATTEMPTS or not getattr(e, "retryable", True)
+			routing_key = f"{queue_name}.dead" if dead else f"{queue_name}.retry.{attempt}"
+			logger.exception(f"Job {body.decode()} Failed On Attempt {attempt}, Moving To {routing_key}")
+
+			# The job re-enters the work queue only once its backoff has expired
+			enqueued_at = time.time() + (0 if dead else retry_delay(attempt) / 1000)
+			headers.update({"x-attempt": attempt, "x-failure-reason": reason, "x-enqueued-at": enqueued_at})
+			ch.basic_publish(
+				exchange="",
+				routing_key=routing_key,
+				body=body,
+				properties=message_properties(
+					headers=headers,
+					delivery_mode=2,
+				)
+			)
+
+			failure = dict(
+				reason=reason,
+				attempt=attempt,
+				time=now(),
+			)
+			update = {"$push": dict(failures=failure)}
+			if dead:
+				update["$set"] = dict(
+					dead_lettered=True,
+					failure_reason=reason,
+				)
+			try:
+				collection.update_one(dict(_id=ObjectId(body.decode())), update)
+			except Exception:
+				logger.exception(f"Unable To Record Failure Of Job {body.decode()}")
+			if dead and on_dead_letter is not None:
+				try:
+					on_dead_letter(ObjectId(body.decode()))
+				except Exception:
+					logger.exception(f"Unable To Report Dead-Lettered Job {body.decode()}")
+			ch.basic_ack(delivery_tag = method.delivery_tag)
+	return wrapper
+
+class ThreadsafeChannel:
+	"""
+	Proxy of a `pika.BlockingChannel` that can be used from other threads than the one
+	running the connection's I/O loop.
+
+	`basic_ack` and `basic_publish` are scheduled on the connection thread through
+	`add_callback_threadsafe` instead of being called directly, which pika does not allow.
+
+	Parameters:
+		connection (pika.BlockingConnection): The connection owning `channel`.
+		channel (pika.BlockingChannel): The channel to proxy.
+	"""
+	def __init__(self, connection, channel):
+		self._connection = connection
+		self._channel = channel
+
+	def basic_ack(self, *args, **kwargs):
+		self._connection.add_callback_threadsafe(
+			functools.partial(self._channel.basic_ack, *args, **kwargs)
+		)
+
+	def basic_publish(self, *args, **kwargs):
+		self._connection.add_callback_threadsafe(
+			functools.partial(self._channel.basic_publish, *args, **kwargs)
+		)
+
+def run_in_threads(callback, connection, channel, workers, logger):
+	"""
+	Wrap a worker callback so that up to `workers` deliveries are processed concurrently.
+
+	Each delivery is handed to a thread pool and receives a `ThreadsafeChannel`, so
+	`callback` can ack and publish as usual. The channel prefetch is limited to
+	`workers` so that RabbitMQ keeps the remaining messages for other workers.
+	An exception that escapes `callback` (even from `retry_on_failure`) is logged and
+	the delivery is requeued, instead of being lost with its thread.
+
+	Parameters:
+		callback (callable): The `on_message_callback` of the worker.
+		connection (pika.BlockingConnection): The connection of the worker.
+		channel (pika.BlockingChannel): The channel consumed by the worker.
+		workers (int): Number of deliveries processed at the same time.
+		logger (logging.Logger): Logger of the worker.
+
+	Returns:
+		callable: The wrapped callback.
+	"""
+	channel.basic_qos(prefetch_count=workers)
+	executor = ThreadPoolExecutor(max_workers=workers)
+
+	@functools.wraps(callback)
+	def wrapper(ch, method, properties, body):
+		future = executor.submit(callback, ThreadsafeChannel(connection, ch), method, properties, body)
+
+		def on_done(future):
+			error = future.exception()
+			if error is not None:
+				logger.error(f"Job {body.decode()} Escaped Its Callback, Requeueing", exc_info=error)
+				connection.add_callback_threadsafe(
+					functools.partial(ch.basic_nack, delivery_tag=method.delivery_tag, requeue=True)
+				)
+		future.add_done_callback(on_done)
+	return wrapper
+